@@ -3,7 +3,8 @@ from argparse import Namespace
 from textual.app import App, ComposeResult
 from textual.widgets import Footer
 
-from .engine import Engine
+from .engine import start_engine
+from .startup import STARTUP_PROFILE
 from .ui import KeysUI, NavigationUI
 
 
@@ -31,11 +32,10 @@ class MSApp(App):
 
     def __init__(self, args: Namespace):
         super().__init__()
-        self.sequencer = Engine(loc=args.dir)
-        self.sequencer.detach()
-        self.sequencer.init_data()
-        self.keys_ui = KeysUI(sequencer=self.sequencer, loc=args.dir)
-        self.navigation_ui = NavigationUI(sequencer=self.sequencer, loc=args.dir)
+        self.sequencer = start_engine(loc=args.dir)
+        with STARTUP_PROFILE.phase(name="create ui"):
+            self.keys_ui = KeysUI(sequencer=self.sequencer, loc=args.dir)
+            self.navigation_ui = NavigationUI(sequencer=self.sequencer, loc=args.dir)
         self.navigation_ui.keys_ui = self.keys_ui
         self.keys_ui.navigation_ui = self.navigation_ui
 
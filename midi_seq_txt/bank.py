@@ -0,0 +1,147 @@
+import os
+import threading
+from queue import Queue
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .functionalities import MMusic
+from .presets import read_preset_type
+
+# mtime (ns), size
+Signature = Tuple[int, int]
+
+
+class MusicBank:
+    """
+    This class keeps parsed music presets ready for switching songs without a stall.
+    A background thread loads every candidate and reloads the ones changed on disk.
+    The music to switch to next is also rendered there, so the switch is a single copy.
+    Files are only looked at on that thread, the engine compares signatures in memory.
+    """
+
+    def __init__(
+        self,
+        loc: str,
+        names: List[str],
+        on_loaded: Callable[[], None],
+        render: Optional[Callable[[MMusic], bytes]] = None,
+    ):
+        self.loc = loc
+        self.names = names
+        self.on_loaded = on_loaded
+        self.render = render
+        # None for presets that could not be read
+        self.music: Dict[str, Tuple[Signature, Optional[MMusic]]] = dict()
+        # Only the music to switch to next, None if it could not be rendered
+        self.rendered: Dict[str, Tuple[Signature, Optional[bytes]]] = dict()
+        self.render_name: Optional[str] = None
+        # Signature of each file when the thread last fetched it (None if missing),
+        # a name requested again is left out until it is fetched again.
+        self.signatures: Dict[str, Optional[Signature]] = dict()
+        self.lock = threading.Lock()
+        self.requests: "Queue[str]" = Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self) -> None:
+        for name in self.names:
+            self.requests.put(name)
+        self.thread.start()
+
+    def get_path(self, name: str) -> str:
+        return f"{self.loc}/{MMusic.__name__}/{name}.yaml"
+
+    def get_signature(self, name: str) -> Optional[Signature]:
+        try:
+            stat = os.stat(self.get_path(name=name))
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def prefetch(self, name: str) -> None:
+        """Parses the music again if it changed, and renders it for the next switch."""
+        with self.lock:
+            self.render_name = name
+            self.signatures.pop(name, None)
+        self.requests.put(name)
+
+    def run(self) -> None:
+        while True:
+            name = self.requests.get()
+            try:
+                self.fetch(name=name)
+            finally:
+                self.on_loaded()
+
+    def fetch(self, name: str) -> None:
+        signature = self.get_signature(name=name)
+        with self.lock:
+            cached = self.music.get(name)
+        if signature is not None:
+            if cached is None or cached[0] != signature:
+                cached = (signature, self.parse(name=name))
+                with self.lock:
+                    self.music[name] = cached
+            self.fetch_rendered(name=name, signature=signature, music=cached[1])
+        with self.lock:
+            self.signatures[name] = signature
+
+    def parse(self, name: str) -> Optional[MMusic]:
+        try:
+            preset = read_preset_type(file_path=self.get_path(name=name))
+            if isinstance(preset, MMusic):
+                return preset
+        except Exception:
+            # A broken preset must neither stop the bank nor be parsed again until it changes.
+            pass
+        return None
+
+    def fetch_rendered(self, name: str, signature: Signature, music: Optional[MMusic]) -> None:
+        with self.lock:
+            rendered = self.rendered.get(name)
+            is_next = name == self.render_name
+        if self.render is None or music is None or not is_next:
+            return
+        if rendered is not None and rendered[0] == signature:
+            return
+        cells: Optional[bytes] = None
+        try:
+            cells = self.render(music)
+        except Exception:
+            # The switch then loads the parsed music in place.
+            pass
+        with self.lock:
+            self.rendered = {name: (signature, cells)}
+
+    def is_ready(self, name: str) -> bool:
+        """True once the file was parsed (or found missing or broken) and the next one rendered."""
+        with self.lock:
+            if name not in self.signatures:
+                return False
+            signature = self.signatures[name]
+            cached = self.music.get(name)
+            rendered = self.rendered.get(name)
+            is_next = name == self.render_name
+        if signature is None:
+            return True
+        if cached is None or cached[0] != signature:
+            return False
+        if self.render is None or cached[1] is None or not is_next:
+            return True
+        return rendered is not None and rendered[0] == signature
+
+    def get(self, name: str) -> Optional[MMusic]:
+        """Returns the music, if it is loaded as the file was when last fetched."""
+        with self.lock:
+            signature = self.signatures.get(name)
+            cached = self.music.get(name)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        return None
+
+    def get_rendered(self, name: str) -> Optional[bytes]:
+        """Returns the rendered cells of the music, as the file was when last fetched."""
+        with self.lock:
+            signature = self.signatures.get(name)
+            rendered = self.rendered.get(name)
+        if rendered is not None and rendered[0] == signature:
+            return rendered[1]
+        return None
@@ -0,0 +1,523 @@
+import argparse
+import pickle
+import random
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+from copy import deepcopy
+from multiprocessing import Queue
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Tuple
+
+import attrs
+
+from .clock import MIDI_CLOCK, MIDI_CLOCK_PPQN, MIDI_START, Clock, ClockFollower
+from .coalesce import CCCoalescer
+from .compiler import CompiledEvent, PartCompiler
+from .configs import InitConfig
+from .functionalities import MMusic, MOutCache, MOutFunctionality, MusicData
+from .ipc import IPCPipe, decode_out_mode, encode_out_mode
+from .ring import InMessage
+from .scheduler import Scheduler
+from .store import StoreView, create_store, np
+
+if TYPE_CHECKING:
+    from .sequencer import MiDiIn
+
+
+def summarize(name: str, cpu: float, wall: float, lateness: List[float]) -> Dict[str, float]:
+    return {
+        f"{name}_cpu_pct": round(100 * cpu / wall, 2),
+        f"{name}_late_mean_ms": round(1000 * statistics.mean(lateness), 4),
+        f"{name}_late_max_ms": round(1000 * max(lateness), 4),
+        f"{name}_jitter_ms": round(1000 * statistics.pstdev(lateness), 4),
+    }
+
+
+def run_poll_loop(deadlines: List[int]) -> List[float]:
+    lateness: List[float] = list()
+    sleep = InitConfig().sleep
+    while len(lateness) < len(deadlines):
+        time_ns = Clock.now_ns()
+        if time_ns >= deadlines[len(lateness)]:
+            lateness.append((time_ns - deadlines[len(lateness)]) / 10**9)
+        time.sleep(sleep)
+    return lateness
+
+
+def run_deadline_loop(deadlines: List[int]) -> List[float]:
+    lateness: List[float] = list()
+    scheduler = Scheduler()
+    while len(lateness) < len(deadlines):
+        scheduler.wait_until(deadline=deadlines[len(lateness)])
+        time_ns = Clock.now_ns()
+        if time_ns >= deadlines[len(lateness)]:
+            lateness.append((time_ns - deadlines[len(lateness)]) / 10**9)
+    return lateness
+
+
+def bench_scheduler(duration: float = 2.0, interval: float = 0.0125) -> Dict[str, float]:
+    """Busy-poll loop vs deadline scheduler on a stream of 16th notes at 300 BPM."""
+    results: Dict[str, float] = dict()
+    loops: Dict[str, Callable[[List[int]], List[float]]] = {
+        "poll": run_poll_loop,
+        "deadline": run_deadline_loop,
+    }
+    for name, loop in loops.items():
+        interval_ns = int(interval * 10**9)
+        start = Clock.now_ns() + interval_ns
+        deadlines = [start + i * interval_ns for i in range(int(duration / interval))]
+        cpu_start, wall_start = time.process_time(), Clock.now()
+        lateness = loop(deadlines)
+        cpu, wall = time.process_time() - cpu_start, Clock.now() - wall_start
+        results.update(summarize(name=name, cpu=cpu, wall=wall, lateness=lateness))
+    return results
+
+
+def get_as_message_uncached(out_mode: MOutFunctionality) -> List[int]:
+    # The string based path every note took before the out mode cache.
+    values_int: List[int] = list()
+    if out_mode._exe_ < len(out_mode.indexes):
+        values_str = out_mode.get_row_values(exe=out_mode._exe_)
+        labels_str = out_mode.get_labels()
+        for i, value_str in enumerate(values_str):
+            if labels_str[i] not in MOutCache.skip_labels:
+                values_int.append(int(value_str))
+    out_mode._exe_ += 1
+    return values_int
+
+
+def bench_out_message(n_messages: int = 20000) -> Dict[str, float]:
+    """Messages per second of the string based path vs the compiled out mode cache."""
+    from .init import VOICE_1_OUT
+
+    results: Dict[str, float] = dict()
+    messages: Dict[str, Callable[[MOutFunctionality], object]] = {
+        "uncached": get_as_message_uncached,
+        "cached": lambda out_mode: out_mode.get_as_bytes(message=out_mode.get_as_message(), ch=1),
+    }
+    out_mode = VOICE_1_OUT.new(lock=False)
+    for name, message in messages.items():
+        start = Clock.now()
+        for i in range(n_messages):
+            out_mode._exe_ = i % len(out_mode.indexes)
+            message(out_mode)
+        results[f"{name}_msg_per_s"] = round(n_messages / (Clock.now() - start))
+    return results
+
+
+def bench_ipc(n_messages: int = 5000) -> Dict[str, float]:
+    """Pickled out mode dicts over a queue vs packed structs over a pipe."""
+    from .init import VOICE_1_OUT
+
+    out_mode = VOICE_1_OUT.new(lock=False)
+    queue: Queue[Dict[str, Any]] = Queue()
+    pipe = IPCPipe()
+    transports: Dict[str, Tuple[Callable[[], None], Callable[[], object]]] = {
+        "queue": (lambda: queue.put(attrs.asdict(out_mode)), queue.get),
+        "pipe": (
+            lambda: pipe.send(
+                encode_out_mode(mode_id=0, position=(0, 1, 1, 1), indexes=out_mode.indexes)
+            ),
+            lambda: decode_out_mode(pipe.recv()),
+        ),
+    }
+    results: Dict[str, float] = dict()
+    for name, (send, recv) in transports.items():
+        latency: List[float] = list()
+        start = Clock.now()
+        for _ in range(n_messages):
+            sent = Clock.now()
+            send()
+            recv()
+            latency.append(Clock.now() - sent)
+        results[f"{name}_msg_per_s"] = round(n_messages / (Clock.now() - start))
+        results[f"{name}_latency_us"] = round(10**6 * statistics.mean(latency), 2)
+    results["queue_bytes"] = len(pickle.dumps(attrs.asdict(out_mode)))
+    results["pipe_bytes"] = len(
+        encode_out_mode(mode_id=0, position=(0, 1, 1, 1), indexes=out_mode.indexes)
+    )
+    return results
+
+
+def iterate_music(data: MusicData) -> int:
+    n_notes = 0
+    for midi in data.keys():
+        for channel in data[midi].keys():
+            for part in data[midi][channel].keys():
+                for step in data[midi][channel][part].keys():
+                    for valid_out_mode in data[midi][channel][part][step].keys():
+                        n_notes += data[midi][channel][part][step][valid_out_mode][0][0] > 0
+    return n_notes
+
+
+def bench_music() -> Dict[str, float]:
+    """
+    Nested dict music vs the shared store (NumPy backed when numpy is installed).
+    The presets and out mode caches both share are built before anything is measured,
+    and every scan counts the notes of the same cells.
+    """
+    from .init import init_io_modes_and_instruments_mem, init_mappings_mem, init_music_mem
+
+    out_modes, _, _, _ = init_io_modes_and_instruments_mem()
+    store = create_store(out_modes=out_modes)
+    builds: Dict[str, Callable[[], MMusic]] = {
+        "dict": lambda: init_music_mem(mappings=init_mappings_mem()),
+        "store": lambda: init_music_mem(mappings=init_mappings_mem(), store=store),
+    }
+    for build in builds.values():
+        build()
+    results: Dict[str, float] = dict()
+    n_notes: Dict[str, int] = dict()
+    for name, build in builds.items():
+        tracemalloc.start()
+        start = Clock.now()
+        music = build()
+        results[f"{name}_init_ms"] = round(1000 * (Clock.now() - start), 3)
+        results[f"{name}_heap_kb"] = round(tracemalloc.get_traced_memory()[0] / 1024, 1)
+        tracemalloc.stop()
+        start = Clock.now()
+        n_notes[name] = iterate_music(data=music.data)
+        results[f"{name}_scan_ms"] = round(1000 * (Clock.now() - start), 3)
+        start = Clock.now()
+        music.data.to_dict() if isinstance(music.data, StoreView) else deepcopy(music.data)
+        results[f"{name}_snapshot_ms"] = round(1000 * (Clock.now() - start), 3)
+    if np is not None:
+        from .numpy_store import NumpySequenceStore
+
+        assert isinstance(store, NumpySequenceStore)
+        start = Clock.now()
+        present = np.flatnonzero(store.present)
+        n_notes["array"] = int(np.count_nonzero(store.cells[present, 0, 0] > 0))
+        results["store_array_scan_ms"] = round(1000 * (Clock.now() - start), 3)
+    assert len(set(n_notes.values())) == 1, n_notes
+    results["store_shared_kb"] = round(store.shm.size / 1024, 1)
+    return results
+
+
+def bench_occupancy(n_loops: int = 20) -> Dict[str, float]:
+    """Full scan of the music grid vs the occupancy index, as done on every play start."""
+    from .init import init_io_modes_and_instruments_mem, init_mappings_mem, init_music_mem
+
+    out_modes, _, _, _ = init_io_modes_and_instruments_mem()
+    store = create_store(out_modes=out_modes)
+    music = init_music_mem(mappings=init_mappings_mem(), store=store)
+    valid_out_mode = store.valid_out_modes[0]
+    for part in [1, 3]:
+        for step in [1, 5, 9, 13]:
+            indexes = deepcopy(out_modes[valid_out_mode].indexes)
+            vis_exe, vis_field = out_modes[valid_out_mode].get_vis_ind()
+            indexes[vis_exe][vis_field] = 1
+            store.write(position=(0, 1, part, step, valid_out_mode), indexes=indexes)
+    lookups: Dict[str, Callable[[], Any]] = {
+        "scan": lambda: iterate_music(data=music.data),
+        "index": store.get_occupied,
+    }
+    results: Dict[str, float] = dict()
+    for name, lookup in lookups.items():
+        start = Clock.now()
+        for _ in range(n_loops):
+            lookup()
+        results[f"{name}_ms"] = round(1000 * (Clock.now() - start) / n_loops, 3)
+    results["occupied_parts"] = len(store.get_occupied())
+    return results
+
+
+def bench_compiler(n_loops: int = 20) -> Dict[str, float]:
+    """Compiling a full loop of one output from scratch vs with unchanged parts cached."""
+    from .init import init_io_modes_and_instruments_mem, init_mappings_mem, init_music_mem
+
+    config = InitConfig()
+    out_modes, _, _, _ = init_io_modes_and_instruments_mem()
+    store = create_store(out_modes=out_modes)
+    init_music_mem(mappings=init_mappings_mem(), store=store)
+    valid_out_mode = store.valid_out_modes[0]
+    out_mode = out_modes[valid_out_mode].new(lock=False)
+    out_mode.set_indexes_with_lab_and_off(lab="Note", sub_ind=1, exe=None)
+    out_mode.set_indexes_with_lab_and_off(lab="Length", sub_ind=1, exe=0)
+    play_positions: Dict[int, Dict[int, Dict[int, bool]]] = {0: {1: dict()}}
+    for part in range(1, config.n_parts + 1):
+        play_positions[0][1][part] = True
+        for step in range(1, config.n_steps + 1):
+            store.write(position=(0, 1, part, step, valid_out_mode), indexes=out_mode.indexes)
+    quant_ticks = config.ppqn // config.n_quants
+    step_ticks = quant_ticks * config.n_quants
+    compiler = PartCompiler(
+        port_id=0,
+        midi_id=0,
+        store=store,
+        out_modes=out_modes,
+        allowed_valid_out_modes=store.valid_out_modes,
+        quant_ticks=quant_ticks,
+        step_ticks=step_ticks,
+    )
+    results: Dict[str, float] = dict()
+    for name in ["cold", "cached", "one_part_changed"]:
+        start = Clock.now()
+        for _ in range(n_loops):
+            if name == "cold":
+                compiler.parts.clear()
+            elif name == "one_part_changed":
+                store.write(position=(0, 1, 1, 1, valid_out_mode), indexes=out_mode.indexes)
+            _, events = compiler.compile_loop(
+                play_positions=play_positions,
+                loop_tick=0,
+                from_tick=0,
+                part_ticks=step_ticks * config.n_steps,
+            )
+        results[f"{name}_ms"] = round(1000 * (Clock.now() - start) / n_loops, 3)
+    results["events_per_loop"] = len(events)
+    return results
+
+
+def create_midi_in() -> Tuple[tempfile.TemporaryDirectory, "MiDiIn"]:
+    """An input of a sequencer with its data in a temporary directory, and the directory."""
+    from .functionalities import MMiDi
+    from .sequencer import MiDiIn, Sequencer
+
+    tmp_dir = tempfile.TemporaryDirectory()
+    sequencer = Sequencer(loc=tmp_dir.name)
+    # Recorded on the first output, as the engine does with its outputs.
+    sequencer.midi_outs_ids = [0]
+    sequencer.init_data()
+    midi_in = MiDiIn(midi=MMiDi(midi_id=4, port_id=0, port_name="", is_out=False))
+    midi_in.sequencer = sequencer
+    midi_in.reset_in_modes()
+    return tmp_dir, midi_in
+
+
+def play_input(midi_in: "MiDiIn", messages: List[List[int]]) -> int:
+    """Pushes messages stamped now into an input and returns the number of notes it ended."""
+    time_ns = Clock.now_ns()
+    for message in messages:
+        midi_in.ring.push(message=message, ns=time_ns)
+    return len(midi_in.run_message_bus(out_midi=0, out_channel=1))
+
+
+def bench_held_notes(n_loops: int = 20) -> Dict[str, float]:
+    """Every key of two channels held at once, then released in reverse order."""
+    tmp_dir, midi_in = create_midi_in()
+    notes = [(channel, key) for channel in [0, 1] for key in range(128)]
+    durations: Dict[str, List[float]] = {"press": list(), "release": list()}
+    for _ in range(n_loops):
+        start = Clock.now()
+        play_input(midi_in=midi_in, messages=[[0x90 | ch, key, 100] for ch, key in notes])
+        durations["press"].append(Clock.now() - start)
+        start = Clock.now()
+        n_ended = play_input(
+            midi_in=midi_in, messages=[[0x80 | ch, key, 0] for ch, key in reversed(notes)]
+        )
+        durations["release"].append(Clock.now() - start)
+        assert n_ended == len(notes)
+    tmp_dir.cleanup()
+    results: Dict[str, float] = {"held_notes": len(notes)}
+    for name, duration in durations.items():
+        results[f"{name}_ms"] = round(1000 * statistics.mean(duration), 3)
+    return results
+
+
+def bench_input_batches(n_notes: int = 2000, batch: int = 333) -> Dict[str, float]:
+    """Overlapping notes drained in batches that split notes, as after a busy engine loop."""
+    tmp_dir, midi_in = create_midi_in()
+    messages: List[List[int]] = [[0x90, 0, 100]]
+    for note in range(1, n_notes):
+        messages.append([0x90, note % 128, 100])
+        messages.append([0x80, (note - 1) % 128, 0])
+    messages.append([0x80, (n_notes - 1) % 128, 0])
+    n_ended = 0
+    start = Clock.now()
+    for i in range(0, len(messages), batch):
+        n_ended += play_input(midi_in=midi_in, messages=messages[i : i + batch])
+    duration = Clock.now() - start
+    tmp_dir.cleanup()
+    assert n_ended == n_notes
+    return {
+        "msg_per_s": round(len(messages) / duration),
+        "us_per_msg": round(10**6 * duration / len(messages), 3),
+    }
+
+
+def run_input_burst(
+    n_messages: int, interval: float, note_every: int
+) -> Tuple[List[float], List[float], int]:
+    """
+    Replays a controller burst into an input, as the rtmidi callback does, while the engine
+    drains it, translates it and records the steps. A note off follows each note on.
+    Returns for each note the time from its note on and from its note off until its step
+    was recorded, and the number of recorded steps.
+    """
+    from .const import ValidButtons, ValidSettings
+
+    tmp_dir, midi_in = create_midi_in()
+    sequencer = midi_in.sequencer
+    assert sequencer is not None
+    sequencer.settings[ValidSettings.RECORD].set_value(ValidButtons.ON)
+    scheduler = Scheduler()
+    midi_in.on_input = scheduler.notify
+    # note on and note off sent times (ns)
+    sent: List[Tuple[int, int]] = list()
+    in_poll_ns = int(InitConfig().in_poll * 10**9)
+
+    def controller() -> None:
+        start = Clock.now_ns()
+        for i in range(n_messages):
+            while Clock.now_ns() < start + int(i * interval * 10**9):
+                time.sleep(interval / 4)
+            message = [0xB0, 74, i % 128]
+            if i % note_every == 0:
+                message = [0x90, 60, 100]
+                sent.append((Clock.now_ns(), -1))
+            elif i % note_every == 1:
+                message = [0x80, 60, 0]
+                sent[-1] = (sent[-1][0], Clock.now_ns())
+            midi_in.receive((message, interval if i else 0.0))
+
+    from_on: List[float] = list()
+    from_off: List[float] = list()
+    n_steps = 0
+    thread = threading.Thread(target=controller)
+    thread.start()
+    while thread.is_alive() or len(midi_in.ring) or len(midi_in.coalescer.held):
+        deadline = midi_in.get_next_deadline()
+        scheduler.wait_until(deadline=deadline or Clock.now_ns() + in_poll_ns)
+        for _, _, out_mode in midi_in.run_message_bus(out_midi=0, out_channel=1):
+            sequencer.set_step(out_mode=out_mode)
+            time_ns = Clock.now_ns()
+            note_on_ns, note_off_ns = sent[len(from_on)]
+            from_on.append((time_ns - note_on_ns) / 10**9)
+            from_off.append((time_ns - note_off_ns) / 10**9)
+            n_steps += 1
+    thread.join()
+    tmp_dir.cleanup()
+    return from_on, from_off, n_steps
+
+
+def bench_midi_in(n_messages: int = 2000, interval: float = 0.001) -> Dict[str, float]:
+    """
+    Note to recorded step latency under a 1 kHz controller burst with notes mixed in,
+    through translate_ins_to_outs and set_step.
+    """
+    results: Dict[str, float] = dict()
+    start, cpu_start = Clock.now(), time.process_time()
+    from_on, from_off, n_steps = run_input_burst(
+        n_messages=n_messages, interval=interval, note_every=10
+    )
+    results["cpu_pct"] = round(100 * (time.process_time() - cpu_start) / (Clock.now() - start), 2)
+    results["recorded_steps"] = n_steps
+    for name, latency in [("note_on", from_on), ("note_off", from_off)]:
+        results[f"{name}_to_step_mean_ms"] = round(1000 * statistics.mean(latency), 4)
+        results[f"{name}_to_step_max_ms"] = round(1000 * max(latency), 4)
+    return results
+
+
+def bench_coalesce(n_messages: int = 4000, batch: int = 1) -> Dict[str, float]:
+    """Messages left of two knobs turned at 2 kHz, drained in batches, and of CC bursts."""
+    config = InitConfig()
+    knobs: List[InMessage] = [([0xB0, 74 + i % 2, i % 128], i * 500_000) for i in range(n_messages)]
+    bursts: List[CompiledEvent] = [
+        (tick, 0, 0xB0, 74, value) for tick in range(n_messages // 8) for value in range(8)
+    ]
+    results: Dict[str, float] = dict()
+    for name, in_window, out_ticks in [("off", -1.0, -1), ("on", config.in_cc_window, 0)]:
+        coalescer_in: CCCoalescer[InMessage] = CCCoalescer(window=in_window * 10**9)
+        coalescer_out: CCCoalescer[CompiledEvent] = CCCoalescer(window=out_ticks)
+        start = Clock.now()
+        n_in = sum(
+            len(
+                coalescer_in.coalesce_in(
+                    messages=knobs[i : i + batch], now_ns=knobs[min(i + batch, n_messages) - 1][1]
+                )
+            )
+            for i in range(0, n_messages, batch)
+        )
+        n_in += len(coalescer_in.coalesce_in(messages=list(), now_ns=2**62))
+        n_out = sum(
+            len(coalescer_out.coalesce_compiled(events=bursts[i : i + 8], tick=bursts[i][0]))
+            for i in range(0, len(bursts), 8)
+        )
+        results[f"{name}_in_messages"] = n_in
+        results[f"{name}_out_messages"] = n_out
+        results[f"{name}_dropped"] = coalescer_in.dropped + coalescer_out.dropped
+        results[f"{name}_us_per_msg"] = round(
+            10**6 * (Clock.now() - start) / (n_messages + len(bursts)), 3
+        )
+    return results
+
+
+def record_clock(beats: int = 32, jitter: float = 0.0005, seed: int = 0) -> List[Tuple[int, int]]:
+    """
+    True and received times (ns) of MIDI clock pulses at 120 BPM speeding up to 126 BPM,
+    as received over USB: on 1 ms frames, with jitter.
+    """
+    rng = random.Random(seed)
+    pulses: List[Tuple[int, int]] = list()
+    true_ns = 0.0
+    for pulse in range(beats * MIDI_CLOCK_PPQN):
+        tempo = 120 + 6 * min(1.0, max(0.0, pulse / (MIDI_CLOCK_PPQN * beats / 2) - 0.5))
+        true_ns += 60 * 10**9 / (tempo * MIDI_CLOCK_PPQN)
+        frame_ns = -(-int(true_ns) // 10**6) * 10**6
+        pulses.append((int(true_ns), frame_ns + int(abs(rng.gauss(0, jitter)) * 10**9)))
+    return pulses
+
+
+def bench_clock(beats: int = 32) -> Dict[str, float]:
+    """
+    Phase error of the next pulse predicted after each pulse of a replayed USB clock,
+    following the last pulse interval (raw) vs the phase locked loop. The mean holds the
+    latency of the USB frames, the jitter is what the loop filters out.
+    """
+    config = InitConfig()
+    pulses = record_clock(beats=beats)
+    results: Dict[str, float] = dict()
+    for name, phase_gain, period_gain in [
+        ("raw", 1.0, 1.0),
+        ("pll", config.clock_phase_gain, config.clock_period_gain),
+    ]:
+        follower = ClockFollower(ppqn=config.ppqn)
+        follower.phase_gain, follower.period_gain = phase_gain, period_gain
+        follower.receive(status=MIDI_START, ns=0)
+        clock = Clock()
+        errors: List[float] = list()
+        for pulse, (_, received_ns) in enumerate(pulses[:-1]):
+            follower.receive(status=MIDI_CLOCK, ns=received_ns)
+            if follower.timebase is not None and pulse >= MIDI_CLOCK_PPQN:
+                clock.set_timebase(timebase=follower.timebase)
+                next_ns = clock.tick_to_ns((pulse + 1) * follower.ticks_per_pulse)
+                errors.append((next_ns - pulses[pulse + 1][0]) / 10**9)
+        results[f"{name}_phase_mean_ms"] = round(1000 * statistics.mean(errors), 4)
+        results[f"{name}_phase_jitter_ms"] = round(1000 * statistics.pstdev(errors), 4)
+        results[f"{name}_phase_max_ms"] = round(1000 * max(map(abs, errors)), 4)
+        results[f"{name}_tempo"] = follower.get_tempo()
+    return results
+
+
+BENCHMARKS: Dict[str, Callable[[], Dict[str, float]]] = {
+    "scheduler": bench_scheduler,
+    "out_message": bench_out_message,
+    "ipc": bench_ipc,
+    "music": bench_music,
+    "occupancy": bench_occupancy,
+    "compiler": bench_compiler,
+    "midi_in": bench_midi_in,
+    "held_notes": bench_held_notes,
+    "in_batches": bench_input_batches,
+    "coalesce": bench_coalesce,
+    "clock": bench_clock,
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--bench",
+        "-b",
+        choices=["all"] + list(BENCHMARKS.keys()),
+        help="Benchmark to run (default: %(default)s)",
+        default="all",
+    )
+    args = parser.parse_args()
+    for name, bench in BENCHMARKS.items():
+        if args.bench in ["all", name]:
+            for key, value in bench().items():
+                print(f"{name:>10} {key:<28} {value}")
@@ -1,10 +1,14 @@
 import argparse
+from typing import TYPE_CHECKING, Union
 
-from midi_seq_txt.app import MSApp
-from midi_seq_txt.presets import read_all_presets, write_all_presets
+from midi_seq_txt.startup import APP_IMPORTS, STARTUP_IMPORTS, STARTUP_PROFILE
 
+if TYPE_CHECKING:
+    from midi_seq_txt.app import MSApp
+    from midi_seq_txt.engine import Engine
 
-def main() -> MSApp:
+
+def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--command",
@@ -20,12 +24,46 @@ def main() -> MSApp:
         help="This software working directory (default: %(default)s)",
         default="./presets",
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "--timing",
+        "-t",
+        action="store_true",
+        help="Report cold and warm load times of presets (with command presets)",
+    )
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="Report the time spent in each import and init phase of startup",
+    )
+    return parser.parse_args()
+
+
+def main() -> Union["MSApp", "Engine"]:
+    args = parse_args()
+    # Imported here, so the profile can break the import time down.
+    STARTUP_PROFILE.import_modules(imports=STARTUP_IMPORTS)
+    if args.command == "headless":
+        # The engine process plays without the UI (nor textual) in this one.
+        from midi_seq_txt.engine import start_engine
+
+        engine = start_engine(loc=args.dir)
+        if args.profile_startup:
+            print(STARTUP_PROFILE.report())
+        return engine
+    STARTUP_PROFILE.import_modules(imports=APP_IMPORTS)
+    from midi_seq_txt.app import MSApp
+    from midi_seq_txt.presets import read_all_presets, time_all_presets, write_all_presets
+
     ui = MSApp(args)
+    if args.profile_startup:
+        print(STARTUP_PROFILE.report())
     if args.command == "app":
         ui.run()
     elif args.command == "presets":
         write_all_presets(args)
         read_all_presets(args)
+        if args.timing:
+            for file_path, (cold, warm) in time_all_presets(args).items():
+                print(f"{file_path:<48} cold {1000 * cold:9.3f} ms warm {1000 * warm:9.3f} ms")
         ui.sequencer.process.kill()
     return ui
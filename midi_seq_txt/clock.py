@@ -0,0 +1,184 @@
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from .configs import InitConfig
+
+# MIDI real time messages and pulses per quarter note of the MIDI clock
+MIDI_CLOCK = 0xF8
+MIDI_START = 0xFA
+MIDI_CONTINUE = 0xFB
+MIDI_STOP = 0xFC
+MIDI_CLOCK_PPQN = 24
+# anchor ns, anchor tick, tick length num, den
+Timebase = Tuple[int, int, int, int]
+
+
+class Clock:
+    """
+    This class maps integer ticks to monotonic nanoseconds from a single anchor.
+    Changing the tick length moves the anchor to the current tick, so ticks never drift.
+    """
+
+    def __init__(self):
+        self.internal_config = InitConfig()
+        self.anchor_ns: int = 0
+        self.anchor_tick: int = 0
+        self.tick_num: int = 60 * 10**9
+        self.tick_den: int = self.internal_config.init_tempo * self.internal_config.ppqn
+        self.late_count: int = 0
+        self.late_sum_ns: int = 0
+        self.late_max_ns: int = 0
+        self.late_last_ns: int = 0
+
+    @staticmethod
+    def now_ns() -> int:
+        return time.perf_counter_ns()
+
+    @staticmethod
+    def now() -> float:
+        return time.perf_counter()
+
+    def is_running(self) -> bool:
+        return self.anchor_ns > 0
+
+    def start(self, at_ns: int) -> None:
+        self.anchor_ns = at_ns
+        self.anchor_tick = 0
+
+    def stop(self) -> None:
+        self.anchor_ns = 0
+        self.anchor_tick = 0
+
+    def set_timebase(self, timebase: Timebase) -> None:
+        self.anchor_ns, self.anchor_tick, self.tick_num, self.tick_den = timebase
+
+    def set_tempo(self, tempo: int) -> None:
+        self.set_tick_length(num=60 * 10**9, den=tempo * self.internal_config.ppqn)
+
+    def set_tick_length(self, num: int, den: int) -> None:
+        """One tick lasts num / den nanoseconds."""
+        if num * self.tick_den != den * self.tick_num and self.is_running():
+            tick = self.ns_to_tick(self.now_ns())
+            self.anchor_ns = self.tick_to_ns(tick)
+            self.anchor_tick = tick
+        self.tick_num = num
+        self.tick_den = den
+
+    def tick_to_ns(self, tick: int) -> int:
+        # Rounded up, so that ns_to_tick(tick_to_ns(tick)) == tick.
+        return self.anchor_ns - (self.anchor_tick - tick) * self.tick_num // self.tick_den
+
+    def ns_to_tick(self, ns: int) -> int:
+        return self.anchor_tick + (ns - self.anchor_ns) * self.tick_den // self.tick_num
+
+    def record_lateness(self, tick: int, ns: int) -> int:
+        late_ns = ns - self.tick_to_ns(tick)
+        self.late_count += 1
+        self.late_sum_ns += late_ns
+        self.late_last_ns = late_ns
+        if late_ns > self.late_max_ns:
+            self.late_max_ns = late_ns
+        return late_ns
+
+    def get_lateness(self) -> Dict[str, float]:
+        mean_ns = self.late_sum_ns / self.late_count if self.late_count else 0.0
+        return {
+            "count": self.late_count,
+            "mean_ms": mean_ns / 10**6,
+            "max_ms": self.late_max_ns / 10**6,
+            "last_ms": self.late_last_ns / 10**6,
+        }
+
+
+class ClockFollower:
+    """
+    This class follows an external 24 ppqn MIDI clock with a phase locked loop.
+    Every pulse pulls the estimated pulse time and period towards the jittery arrival
+    time, and publishes a timebase that maps the song position of the pulse to it.
+    The engine applies the timebase on its own passes, pulses never wake it up,
+    only start, stop and continue do.
+    """
+
+    def __init__(self, ppqn: int, on_transport: Optional[Callable[[], None]] = None):
+        self.internal_config = InitConfig()
+        if ppqn % MIDI_CLOCK_PPQN:
+            raise ValueError(f"PPQN {ppqn} is not divisible by {MIDI_CLOCK_PPQN} clock pulses!")
+        self.ticks_per_pulse = ppqn // MIDI_CLOCK_PPQN
+        self.phase_gain = self.internal_config.clock_phase_gain
+        self.period_gain = self.internal_config.clock_period_gain
+        self.on_transport = on_transport
+        # estimated time of the last pulse and period (ns), 0 until two pulses arrived
+        self.pulse_ns: float = 0.0
+        self.period_ns: float = 0.0
+        # pulses since start, -1 before the first pulse of the song
+        self.song_pulse = -1
+        # whether the song was started from its beginning, not continued
+        self.from_start = False
+        self.pending = False
+        self.playing = False
+        self.timebase: Optional[Timebase] = None
+        # counts starts and stops, so none is missed between two engine passes
+        self.transports = 0
+        self.resyncs = 0
+
+    def receive(self, status: int, ns: int) -> None:
+        if status == MIDI_CLOCK:
+            self.pulse(ns=ns)
+        elif status in [MIDI_START, MIDI_CONTINUE]:
+            # The song (re)starts at the next pulse.
+            self.from_start = status == MIDI_START
+            if self.from_start:
+                self.song_pulse = -1
+            self.pending = True
+        elif status == MIDI_STOP:
+            self.pending = False
+            self.playing = False
+            self.transports += 1
+            self.on_transport() if self.on_transport is not None else None
+
+    def pulse(self, ns: int) -> None:
+        self.track(ns=ns)
+        if self.pending:
+            self.pending = False
+            self.playing = True
+            self.song_pulse += 1
+            self.publish()
+            self.transports += 1
+            self.on_transport() if self.on_transport is not None else None
+        elif self.playing:
+            self.song_pulse += 1
+            self.publish()
+
+    def track(self, ns: int) -> None:
+        if self.period_ns <= 0:
+            if self.pulse_ns > 0:
+                self.period_ns = ns - self.pulse_ns
+            self.pulse_ns = ns
+            return
+        error = ns - self.pulse_ns - self.period_ns
+        if error > self.internal_config.clock_max_gap * self.period_ns:
+            # The clock was paused, the period is kept and the phase starts over.
+            self.resyncs += 1
+            self.pulse_ns = ns
+            return
+        # A pulse delivered late is followed by one delivered early, outliers are clipped.
+        error = min(max(error, -self.period_ns / 2), self.period_ns / 2)
+        self.pulse_ns += self.period_ns + self.phase_gain * error
+        self.period_ns += self.period_gain * error
+
+    def publish(self) -> None:
+        self.timebase = (
+            round(self.pulse_ns),
+            self.song_pulse * self.ticks_per_pulse,
+            round(self.get_period_ns()),
+            self.ticks_per_pulse,
+        )
+
+    def get_period_ns(self) -> float:
+        # Before a period was measured, the song runs at the initial tempo.
+        if self.period_ns > 0:
+            return self.period_ns
+        return 60 * 10**9 / (self.internal_config.init_tempo * MIDI_CLOCK_PPQN)
+
+    def get_tempo(self) -> int:
+        return max(1, round(60 * 10**9 / (self.get_period_ns() * MIDI_CLOCK_PPQN)))
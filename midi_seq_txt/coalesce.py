@@ -0,0 +1,105 @@
+from typing import Dict, Generic, List, Optional, Sequence, Tuple, TypeVar
+
+from .compiler import CompiledEvent
+from .ring import InMessage
+
+# Bank select, data entry and (N)RPN, whose values only make sense all together.
+PARAMETER_CONTROLLERS = frozenset([0, 6, 32, 38, 96, 97, 98, 99, 100, 101])
+
+Item = TypeVar("Item")
+
+
+class CCCoalescer(Generic[Item]):
+    """
+    This class thins out the control changes of one port per (channel, controller).
+    The first value of a window passes at once. The latest one that followed it within
+    the window is held and passes when the window ends, the ones in between are dropped
+    and counted. Windows are kept across calls, so messages drained one by one coalesce
+    as well. Any other message of a channel closes the windows of its controllers first,
+    so the order of notes, program changes and controllers stays as it was.
+    The window is in the unit of the times, a negative one turns coalescing off.
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self.received = 0
+        self.dropped = 0
+        # (channel, controller) -> start of its open window
+        self.windows: Dict[Tuple[int, int], float] = dict()
+        # (channel, controller) -> latest item of its open window, not passed on yet
+        self.held: Dict[Tuple[int, int], Item] = dict()
+
+    def select(
+        self,
+        items: Sequence[Item],
+        messages: Sequence[Tuple[int, int]],
+        times: Sequence[float],
+        until: float,
+    ) -> List[Item]:
+        """
+        Returns the items passed on, given the (status, data 1) message and time of each.
+        The windows that end before until, the earliest time of the items to come, close.
+        """
+        self.received += len(items)
+        if self.window < 0:
+            return list(items)
+        passed: List[Item] = list()
+        for item, (status, data_1), time in zip(items, messages, times):
+            self.close(passed=passed, keys=self.get_ended(until=time))
+            if status & 0xF0 == 0xB0 and data_1 not in PARAMETER_CONTROLLERS:
+                key = (status & 0x0F, data_1)
+                if key in self.windows:
+                    self.dropped += key in self.held
+                    self.held[key] = item
+                    continue
+                self.windows[key] = time
+            elif 0xF0 <= status < 0xF8:
+                self.close(passed=passed, keys=list(self.windows))
+            elif status < 0xF0:
+                self.close(
+                    passed=passed, keys=[key for key in self.windows if key[0] == status & 0x0F]
+                )
+            passed.append(item)
+        self.close(passed=passed, keys=self.get_ended(until=until))
+        return passed
+
+    def get_ended(self, until: float) -> List[Tuple[int, int]]:
+        return [key for key, start in self.windows.items() if start + self.window < until]
+
+    def close(self, passed: List[Item], keys: List[Tuple[int, int]]) -> None:
+        for key in keys:
+            del self.windows[key]
+            if key in self.held:
+                passed.append(self.held.pop(key))
+
+    def get_window_end(self) -> Optional[float]:
+        """End of the first window holding an item, which passes right after it."""
+        ends = [self.windows[key] + self.window for key in self.held]
+        return min(ends) if len(ends) else None
+
+    def coalesce_in(
+        self: "CCCoalescer[InMessage]", messages: List[InMessage], now_ns: int
+    ) -> List[InMessage]:
+        """Drained input messages stamped with their arrival, the window is in ns."""
+        return self.select(
+            items=messages,
+            messages=[
+                (message[0], message[1] if len(message) > 1 else 0) for message, _ in messages
+            ],
+            times=[ns for _, ns in messages],
+            until=now_ns,
+        )
+
+    def coalesce_compiled(
+        self: "CCCoalescer[CompiledEvent]", events: List[CompiledEvent], tick: int
+    ) -> List[CompiledEvent]:
+        """Compiled events due at tick, the window is in ticks."""
+        return self.select(
+            items=events,
+            messages=[(status, data_1) for _, _, status, data_1, _ in events],
+            times=[event_tick for event_tick, _, _, _, _ in events],
+            until=tick + 1,
+        )
+
+    def get_counts(self) -> Dict[str, int]:
+        return {"received": self.received, "dropped": self.dropped}
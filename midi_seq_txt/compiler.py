@@ -0,0 +1,149 @@
+from operator import itemgetter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from .functionalities import MOutFunctionality
+from .store import SequenceStore, Slab
+
+# tick, port, status, data1, data2
+CompiledEvent = Tuple[int, int, int, int, int]
+# tick of the step an event belongs to (relative to its part), event
+PartEvent = Tuple[int, CompiledEvent]
+PlayPositions = Dict[int, Dict[int, Dict[int, bool]]]
+# loop tick, from tick, (slab, version) of every compiled part
+LoopKey = Tuple[int, int, Tuple[Tuple[Slab, int], ...]]
+
+
+def is_note_off(event: CompiledEvent) -> bool:
+    _, _, status, _, data_2 = event
+    return status & 0xF0 == 0x80 or (status & 0xF0 == 0x90 and data_2 == 0)
+
+
+def cut_events(events: Iterable[CompiledEvent], from_tick: int) -> List[CompiledEvent]:
+    """Drops tick sorted events from a tick on, except note offs of notes started before it."""
+    kept: List[CompiledEvent] = list()
+    dropped_notes: Set[Tuple[int, int, int]] = set()
+    for event in events:
+        tick, port, status, data_1, _ = event
+        note = (port, status & 0x0F, data_1)
+        if tick < from_tick:
+            kept.append(event)
+        elif is_note_off(event):
+            if note in dropped_notes:
+                dropped_notes.discard(note)
+            else:
+                kept.append(event)
+        elif status & 0xF0 == 0x90:
+            dropped_notes.add(note)
+    return kept
+
+
+class PartCompiler:
+    """
+    This class compiles parts of the music grid into flat, tick sorted MIDI events
+    of one output, follow up messages (note offs) included.
+    A part is compiled again only after its version in the store changed.
+    """
+
+    def __init__(
+        self,
+        port_id: int,
+        midi_id: int,
+        store: SequenceStore,
+        out_modes: Dict[str, MOutFunctionality],
+        allowed_valid_out_modes: List[str],
+        quant_ticks: int,
+        step_ticks: int,
+    ):
+        self.port_id = port_id
+        self.midi_id = midi_id
+        self.store = store
+        self.out_modes = out_modes
+        self.allowed_valid_out_modes = allowed_valid_out_modes
+        self.quant_ticks = quant_ticks
+        self.step_ticks = step_ticks
+        self.parts: Dict[Slab, Tuple[int, List[PartEvent]]] = dict()
+
+    def get_slabs(self, play_positions: PlayPositions) -> List[Slab]:
+        slabs: List[Slab] = list()
+        for channel in play_positions.get(self.midi_id, dict()).keys():
+            for part in play_positions[self.midi_id][channel].keys():
+                slabs.append((self.midi_id, channel, part))
+        return slabs
+
+    def get_loop_key(
+        self, play_positions: PlayPositions, loop_tick: int, from_tick: int
+    ) -> LoopKey:
+        versions = tuple(
+            (slab, self.store.get_version(slab=slab))
+            for slab in self.get_slabs(play_positions=play_positions)
+        )
+        return loop_tick, from_tick, versions
+
+    def compile_loop(
+        self,
+        play_positions: PlayPositions,
+        loop_tick: int,
+        from_tick: int,
+        part_ticks: int,
+        until_tick: Optional[int] = None,
+    ) -> Tuple[LoopKey, List[CompiledEvent]]:
+        versions: List[Tuple[Slab, int]] = list()
+        events: List[CompiledEvent] = list()
+        for slab in self.get_slabs(play_positions=play_positions):
+            version, part_events = self.compile_part(slab=slab)
+            versions.append((slab, version))
+            part_tick = loop_tick + part_ticks * (slab[2] - 1)
+            for step_tick, (tick, port, status, data_1, data_2) in part_events:
+                if part_tick + step_tick >= from_tick and (
+                    until_tick is None or part_tick + step_tick < until_tick
+                ):
+                    events.append((part_tick + tick, port, status, data_1, data_2))
+        # Stable, so a note off ends before a note on of the same tick starts.
+        events.sort(key=itemgetter(0))
+        return (loop_tick, from_tick, tuple(versions)), events
+
+    def compile_stale_part(self, play_positions: PlayPositions) -> bool:
+        """Compiles the first part that changed since it was compiled, False if none did."""
+        for slab in self.get_slabs(play_positions=play_positions):
+            compiled = self.parts.get(slab)
+            if compiled is None or compiled[0] != self.store.get_version(slab=slab):
+                self.compile_part(slab=slab)
+                return True
+        return False
+
+    def compile_part(self, slab: Slab) -> Tuple[int, List[PartEvent]]:
+        compiled = self.parts.get(slab)
+        if compiled is not None and compiled[0] == self.store.get_version(slab=slab):
+            return compiled
+        version, steps = self.store.read_slab(slab=slab)
+        part_events: List[PartEvent] = list()
+        for step, valid_out_mode, indexes in steps:
+            if valid_out_mode in self.allowed_valid_out_modes:
+                part_events += self.compile_step(
+                    step_tick=(step - 1) * self.step_ticks,
+                    channel=slab[1],
+                    proto=self.out_modes[valid_out_mode],
+                    indexes=indexes,
+                )
+        part_events.sort(key=lambda part_event: part_event[1][0])
+        self.parts[slab] = (version, part_events)
+        return version, part_events
+
+    def compile_step(
+        self, step_tick: int, channel: int, proto: MOutFunctionality, indexes: List[List[int]]
+    ) -> List[PartEvent]:
+        step_events: List[PartEvent] = list()
+        if proto.is_button_na(indexes=indexes):
+            return step_events
+        cache = proto.get_cache()
+        tick = step_tick
+        for row in indexes:
+            message = cache.get_message(row=row)
+            if len(message) < 3 or min(message) < 0:
+                break
+            status, data_1, data_2 = cache.get_bytes(message=message, ch=channel)
+            step_events.append((step_tick, (tick, self.port_id, status, data_1, data_2)))
+            if len(message) == 3:
+                break
+            tick += message[3] * self.quant_ticks
+        return step_events
@@ -4,6 +4,17 @@ from attrs import define
 @define
 class InitConfig:
     sleep: float = 0.0001
+    max_sleep: float = 0.1
+    spin_sleep: float = 0.0005
+    in_poll: float = 0.001
+    in_ring_size: int = 1024
+    in_cc_window: float = 0.01
+    out_cc_ticks: int = 0
+    clock_phase_gain: float = 0.2
+    clock_period_gain: float = 0.01
+    clock_max_gap: int = 4
+    port_scan: float = 2.0
+    store_read_timeout: float = 1.0
     init_tempo: int = 60
     n_steps: int = 16
     n_parts: int = 16
@@ -17,6 +28,7 @@ class InitConfig:
     n_buttons: int = 8
     init_time: float = 0.0
     n_quants: int = 4
+    ppqn: int = 96
     velocity_min: int = 0
     velocity_step: int = 15
     velocity_max: int = 125
@@ -1,13 +1,26 @@
 import random
-import time
-from multiprocessing import Process, Queue
-from typing import Any, Dict, List, Tuple
-
-import attrs
+import threading
+from collections import deque
+from multiprocessing import Event, Process, Queue
+from typing import Deque, Dict, List, Optional, Tuple
 
+from .bank import MusicBank
 from .const import ValidButtons, ValidSettings
-from .functionalities import MMiDi, MOutFunctionality, SFunctionality
+from .functionalities import MMiDi, MOutEvent, MOutFunctionality, SFunctionality
+from .ipc import (
+    OUT_MODE,
+    SETTING,
+    IPCPipe,
+    decode_header,
+    decode_out_mode,
+    decode_setting,
+    encode_out_mode,
+    encode_setting,
+)
+from .ports import PORT_REGISTRY
+from .scheduler import Scheduler
 from .sequencer import MiDiIn, MiDiOut, Sequencer
+from .startup import STARTUP_PROFILE
 
 
 class Engine(Sequencer):
@@ -26,9 +39,17 @@ class Engine(Sequencer):
         from midi_seq_txt.sequencer import DEBUG
 
         self.process = Process(target=self.start, args=(DEBUG,))
-        self.detached_func_queue: Queue[Dict[str, Any]] = Queue()
-        self.attached_func_queue: Queue[Dict[str, Any]] = Queue()
+        self.detached_func_pipe = IPCPipe()
+        self.attached_func_pipe = IPCPipe()
         self.current_step_id: Queue[int] = Queue()
+        self.current_step: int = -1
+        self.func_inbox: Deque[bytes] = deque()
+        self.scheduler = Scheduler()
+        # Set once the detached process filled the shared store.
+        self.data_ready = Event()
+        self.ports_changed = False
+        self.transports = 0
+        self.debug = False
 
     def create_midi_ins(self) -> Dict[int, MiDiIn]:
         midis: Dict[int, MMiDi] = self.mappings.init_midi_ins()
@@ -53,96 +74,260 @@ class Engine(Sequencer):
 
     def detach(self) -> None:
         self.process.start()
+        self.attached = True
+
+    def init_data(self) -> None:
+        super().init_data()
+        if self.attached:
+            self.wait_data_ready()
+        else:
+            self.data_ready.set()
+
+    def wait_data_ready(self) -> None:
+        while not self.data_ready.wait(timeout=self.internal_config.max_sleep):
+            if not self.process.is_alive() and not self.data_ready.is_set():
+                raise RuntimeError("Engine process ended before it filled the store!")
 
     def start(self, debug: bool = False) -> None:
         self.detached = True
+        self.debug = debug
         import midi_seq_txt.sequencer
 
         setattr(midi_seq_txt.sequencer, "DEBUG", debug)
         self.init_data()
+        self.music_bank = MusicBank(
+            loc=self.loc,
+            names=[str(name) for name in self.settings[ValidSettings.MUS_NAME].values],
+            on_loaded=self.scheduler.notify,
+            render=self.render_music,
+        )
+        self.music_bank.start()
+        PORT_REGISTRY.start(on_changed=self.on_ports_changed)
         for midi_id in self.midi_ins.keys():
-            self.midi_ins[midi_id].attach(sequencer=self)
+            self.midi_ins[midi_id].attach(sequencer=self, on_input=self.scheduler.notify)
         for midi_id in self.midi_outs.keys():
             self.midi_outs[midi_id].attach(sequencer=self)
+        for midi_id in self.midi_ins.keys():
+            self.midi_ins[midi_id].reset_thru(midi_outs=self.midi_outs)
         self.run_sequencer_schedule()
 
     def run_sequencer_schedule(self) -> None:
+        listener = threading.Thread(target=self.listen_func_pipe, daemon=True)
+        listener.start()
         while True:
-            midi_channel_out_modes: List[Tuple[int, int, MOutFunctionality]] = list()
-            out_midi, out_channel, _, _, _ = self.get_current_e_pos()
-            for in_midi in self.midi_ins.keys():
-                for out_midi, channel, out_mode in self.midi_ins[in_midi].run_message_bus(
-                    out_midi=out_midi, out_channel=out_channel
-                ):
-                    self.set_step(out_mode=out_mode)
-                    self.send_out_mode(out_mode=out_mode)
-                    midi_channel_out_modes.append((out_midi, out_channel, out_mode))
-            self.ingest_func_data(
-                midi_channel_out_modes=midi_channel_out_modes,
-                out_midi=out_midi,
-                out_channel=out_channel,
+            self.run_sequencer_pass()
+            self.scheduler.wait_until(deadline=self.get_next_deadline())
+
+    def listen_func_pipe(self) -> None:
+        while True:
+            self.func_inbox.append(self.detached_func_pipe.recv())
+            self.scheduler.notify()
+
+    def get_next_deadline(self) -> Optional[int]:
+        time_ns = self.clock.now_ns()
+        if len(self.func_inbox):
+            return time_ns
+        deadlines: List[int] = list()
+        for in_midi in self.midi_ins.keys():
+            deadline = self.midi_ins[in_midi].get_next_deadline()
+            if deadline is not None:
+                deadlines.append(deadline)
+        for out_midi in self.midi_outs.keys():
+            deadline = self.midi_outs[out_midi].get_next_deadline()
+            if deadline is not None:
+                deadlines.append(deadline)
+        switch_tick = self.get_music_switch_tick()
+        if switch_tick is not None:
+            deadlines.append(self.clock.tick_to_ns(switch_tick))
+        if len(deadlines):
+            return min(deadlines)
+        return None
+
+    def get_music_switch_tick(self) -> Optional[int]:
+        # The store is switched one step early, the events of that step are compiled already.
+        if self.pending_music is None or self.music_bank is None:
+            return None
+        if not self.music_bank.is_ready(name=self.pending_music):
+            return None
+        if self.pending_tick is None:
+            return self.clock.ns_to_tick(self.clock.now_ns())
+        return self.pending_tick - self.step_ticks
+
+    def switch_music(self) -> None:
+        switch_tick = self.get_music_switch_tick()
+        if switch_tick is None or self.pending_music is None or self.music_bank is None:
+            return
+        tick_now = self.clock.ns_to_tick(self.clock.now_ns())
+        if self.pending_tick is not None and tick_now >= self.pending_tick:
+            # Loaded too late for its boundary, so it waits for the next one.
+            self.pending_tick = self.get_next_part_tick()
+            return
+        if tick_now < switch_tick:
+            return
+        music = self.music_bank.get(name=self.pending_music)
+        if music is not None:
+            self.set_music(
+                music=music, rendered=self.music_bank.get_rendered(name=self.pending_music)
             )
-            while len(midi_channel_out_modes):
-                out_midi, out_channel, out_mode = midi_channel_out_modes.pop()
-                self.midi_outs[out_midi].unscheduled_step.append((out_channel, out_mode))
-            min_step: int = 2 * self.internal_config.n_steps
-            for out_midi in self.midi_outs.keys():
-                if len(self.midi_outs[out_midi].scheduled_steps):
-                    min_step_tick = min(self.midi_outs[out_midi].scheduled_steps.keys())
-                    step = int(min_step_tick / self.step_interval)
-                    if step < min_step:
-                        min_step = step
-            if min_step <= self.internal_config.n_steps:
-                self.current_step_id.put(min_step)
-            for out_midi in self.midi_outs.keys():
-                self.midi_outs[out_midi].run_message_bus()
-            time.sleep(self.internal_config.sleep)
-
-    def ingest_func_data(
-        self,
-        midi_channel_out_modes: List[Tuple[int, int, MOutFunctionality]],
-        out_midi: int,
-        out_channel: int,
-    ) -> None:
-        if self.detached:
-            queue = self.detached_func_queue
-        else:
-            queue = self.attached_func_queue
-        if not queue.empty():
-            func_dict: Dict[str, Any] = self.detached_func_queue.get()
-            if "indexes" in func_dict:
-                out_mode = self.convert_to_out_mode(func_dict)
-                midi_channel_out_modes.append((out_midi, out_channel, out_mode))
+            if self.pending_tick is not None:
+                for out_midi in self.midi_outs.keys():
+                    self.midi_outs[out_midi].reschedule(from_tick=self.pending_tick)
+        self.pending_music = None
+        self.pending_tick = None
+
+    def on_ports_changed(self) -> None:
+        self.ports_changed = True
+        self.scheduler.notify()
+
+    def reattach_ports(self) -> None:
+        if not self.ports_changed:
+            return
+        self.ports_changed = False
+        self.port_names_comb = PORT_REGISTRY.get_port_names_comb()
+        for in_midi in self.midi_ins.keys():
+            self.midi_ins[in_midi].reattach(port_names_comb=self.port_names_comb)
+        for out_midi in self.midi_outs.keys():
+            self.midi_outs[out_midi].reattach(port_names_comb=self.port_names_comb)
+        self.attach_new_ports()
+
+    def attach_new_ports(self) -> None:
+        """Creates the inputs and outputs of the mappings whose devices were plugged in."""
+        new_ins = [
+            MiDiIn(midi=midi)
+            for midi_id, midi in self.mappings.init_midi_ins().items()
+            if midi_id not in self.midi_ins
+        ]
+        new_outs = [
+            MiDiOut(midi=midi)
+            for midi_id, midi in self.mappings.init_midi_outs().items()
+            if midi_id not in self.midi_outs
+        ]
+        for midi_out in new_outs:
+            midi_out.attach(sequencer=self)
+            self.midi_outs[midi_out.midi_id] = midi_out
+        for midi_in in new_ins:
+            midi_in.attach(sequencer=self, on_input=self.scheduler.notify)
+            self.midi_ins[midi_in.midi_id] = midi_in
+        if len(new_ins) or len(new_outs):
+            self.midi_outs_ids = sorted(self.midi_outs.keys())
+            self.midi_ins_ids = sorted(self.midi_ins.keys())
+            for in_midi in self.midi_ins.keys():
+                self.midi_ins[in_midi].reset_thru(midi_outs=self.midi_outs)
+
+    def follow_transport(self) -> None:
+        """Stops and (re)starts the loops with the start, stop and continue of the clock."""
+        if self.clock_follower is None or self.clock_follower.transports == self.transports:
+            return
+        self.transports = self.clock_follower.transports
+        self.clock_playing = self.clock_follower.playing
+        for out_midi in self.midi_outs.keys():
+            self.midi_outs[out_midi].stop_loop(restart=self.clock_playing)
+        if self.clock_playing:
+            self.reset_intervals()
+            tick = self.clock_follower.song_pulse * self.clock_follower.ticks_per_pulse
+            if self.clock_follower.from_start:
+                self.loop_tick = 0
+                self.loop_ticks = 0
+            elif self.loop_ticks:
+                # Continued within the loop it stopped in, whichever loop was compiled ahead.
+                self.loop_tick = tick - (tick - self.loop_tick) % self.loop_ticks
+
+    def run_sequencer_pass(self) -> None:
+        self.reattach_ports()
+        self.follow_transport()
+        self.switch_music()
+        midi_channel_out_modes: List[Tuple[int, int, MOutEvent]] = list()
+        out_midi, out_channel, _, _, _ = self.get_current_e_pos()
+        for in_midi in self.midi_ins.keys():
+            for out_midi, channel, out_mode in self.midi_ins[in_midi].run_message_bus(
+                out_midi=out_midi, out_channel=out_channel
+            ):
                 self.set_step(out_mode=out_mode)
-            else:
-                setting = self.convert_to_setting(func_dict)
+                self.send_out_mode(out_mode=out_mode)
+                midi_channel_out_modes.append((out_midi, out_channel, out_mode.new_event()))
+        self.ingest_func_data(midi_channel_out_modes=midi_channel_out_modes)
+        # In arrival order, a later event of the same step plays after an earlier one.
+        for out_midi, out_channel, event in midi_channel_out_modes:
+            self.midi_outs[out_midi].unscheduled_step.append((out_channel, event))
+        for out_midi in self.midi_outs.keys():
+            self.midi_outs[out_midi].run_message_bus()
+        self.send_current_step()
+
+    def send_current_step(self) -> None:
+        min_step_tick: Optional[int] = None
+        for out_midi in self.midi_outs.keys():
+            step_tick = self.midi_outs[out_midi].peek()
+            if step_tick is not None and (min_step_tick is None or step_tick < min_step_tick):
+                min_step_tick = step_tick
+        min_step = 0
+        if min_step_tick is not None:
+            min_step = (min_step_tick - self.loop_tick) % self.part_ticks // self.step_ticks + 1
+        if min_step != self.current_step:
+            self.current_step = min_step
+            self.current_step_id.put(min_step)
+            self.debug_stats() if self.debug else None
+
+    def get_stats(self) -> Dict[str, Dict[str, float]]:
+        """Lateness of the outputs, counts of the inputs and of the output coalescers."""
+        stats: Dict[str, Dict[str, float]] = {"lateness": self.clock.get_lateness()}
+        for in_midi in self.midi_ins.keys():
+            stats[f"in.{in_midi}"] = dict(self.midi_ins[in_midi].get_counts())
+        for out_midi in self.midi_outs.keys():
+            stats[f"out.{out_midi}"] = dict(self.midi_outs[out_midi].coalescer.get_counts())
+        return stats
+
+    def debug_stats(self) -> None:
+        import json
+
+        fh = open(f"{self.__class__.__name__}.stats.{self.detached}.json", "w")
+        json.dump(self.get_stats(), indent=2, sort_keys=True, fp=fh)
+        fh.close()
+
+    def ingest_func_data(self, midi_channel_out_modes: List[Tuple[int, int, MOutEvent]]) -> None:
+        if len(self.func_inbox):
+            func_data = self.func_inbox.popleft()
+            kind, _ = decode_header(func_data)
+            if kind == OUT_MODE:
+                out_midi, out_channel, event = self.convert_to_event(func_data)
+                midi_channel_out_modes.append((out_midi, out_channel, event))
+                self.set_step(out_mode=event, write=False)
+            elif kind == SETTING:
+                setting = self.convert_to_setting(func_data)
                 self.set_option(option=setting)
 
-    def convert_to_setting(self, setting_dict: Dict[str, Any]) -> SFunctionality:
-        valid_setting = ValidSettings(setting_dict["name"])
+    def convert_to_setting(self, setting_data: bytes) -> SFunctionality:
+        valid_setting, ind = decode_setting(setting_data)
         setting_value = self.settings[valid_setting]
-        setting_value.update_with_ind(int(setting_dict["ind"]))
+        setting_value.update_with_ind(ind)
         return setting_value
 
-    def convert_to_out_mode(self, out_mode_dict: Dict[str, Any]) -> MOutFunctionality:
-        valid_out_mode = out_mode_dict["name"]
-        out_mode_value = self.out_modes[valid_out_mode].new(lock=False)
-        out_mode_value.set_indexes(out_mode_dict["indexes"])
-        return out_mode_value
+    def convert_to_event(self, out_mode_data: bytes) -> Tuple[int, int, MOutEvent]:
+        _, mode_id = decode_header(out_mode_data)
+        position, indexes = decode_out_mode(out_mode_data)
+        event = self.out_modes[self.valid_out_modes[mode_id]].new_event(indexes=indexes)
+        return position[0], position[1], event
+
+    def pack_out_mode(self, out_mode: MOutFunctionality) -> bytes:
+        midi, channel, part, step, _ = self.get_current_e_pos()
+        return encode_out_mode(
+            mode_id=self.valid_out_modes.index(out_mode.name),
+            position=(midi, channel, part, step),
+            indexes=out_mode.indexes,
+        )
 
     def send_out_mode(self, out_mode: MOutFunctionality) -> None:
         if self.detached:
-            self.attached_func_queue.put(attrs.asdict(out_mode))
+            self.attached_func_pipe.send(self.pack_out_mode(out_mode=out_mode))
         else:
             self.set_step(out_mode=out_mode)
-            self.detached_func_queue.put(attrs.asdict(out_mode))
+            self.detached_func_pipe.send(self.pack_out_mode(out_mode=out_mode))
 
     def send_setting(self, setting: SFunctionality) -> None:
         if self.detached:
-            self.attached_func_queue.put(attrs.asdict(setting))
+            self.attached_func_pipe.send(encode_setting(name=setting.name, ind=setting.get_ind()))
         else:
             self.set_option(option=setting)
-            self.detached_func_queue.put(attrs.asdict(setting))
+            self.detached_func_pipe.send(encode_setting(name=setting.name, ind=setting.get_ind()))
 
     def send_delete(self) -> None:
         midi, channel, part, step, valid_out_mode = self.get_current_e_pos()
@@ -184,3 +369,13 @@ class Engine(Sequencer):
                 self.send_out_mode(t_out_mode)
         step_setting = self.settings[ValidSettings.V_STEP].update_with_value(1)
         self.send_setting(step_setting)
+
+
+def start_engine(loc: str) -> Engine:
+    with STARTUP_PROFILE.phase(name="create engine"):
+        engine = Engine(loc=loc)
+    with STARTUP_PROFILE.phase(name="start engine process"):
+        engine.detach()
+    with STARTUP_PROFILE.phase(name="init data"):
+        engine.init_data()
+    return engine
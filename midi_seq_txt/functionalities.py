@@ -2,12 +2,9 @@ import math
 import time
 from collections import defaultdict
 from copy import deepcopy
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Any, Dict, Iterable, List, Optional, Protocol, Tuple, Union
 
-import mingus.core.scales as scales
-import rtmidi
-from attrs import AttrsInstance, define
-from mingus.containers import Note
+from attrs import AttrsInstance, define, field
 
 from .configs import InitConfig
 from .const import (
@@ -22,10 +19,37 @@ from .const import (
     ValidNav,
     ValidSettings,
 )
+from .ports import PORT_REGISTRY
+
+MUSIC_VERSION_FULL: int = 1
+MUSIC_VERSION_SPARSE: int = 2
+# The notes of the default scale, which out modes are built with (mingus.core.scales).
+C_MAJOR_NOTES: List[str] = ["C", "D", "E", "F", "G", "A", "B"]
+MusicDict = Dict[int, Dict[int, Dict[int, Dict[int, Dict[str, List[List[int]]]]]]]
+
+
+class MusicTree(Protocol):
+    # Nested midi, channel, part, step and out mode keys, such as a StoreView.
+    def keys(self) -> Iterable[Any]:
+        raise NotImplementedError
+
+    def __getitem__(self, key: Any) -> Any:
+        raise NotImplementedError
+
+    def __contains__(self, key: Any) -> bool:
+        raise NotImplementedError
+
+
+MusicData = Union[MusicDict, MusicTree]
 
 
 def create_notes(scale: str) -> List[str]:
-    notes = scales.get_notes(key=scale)
+    notes = C_MAJOR_NOTES
+    if scale != "C":
+        # Imported on first use, mingus is not needed to play music.
+        import mingus.core.scales as scales
+
+        notes = scales.get_notes(key=scale)
     no_button_notes = list()
     button_notes = [ValidButtons.NA.value]
     for octave in range(1, InitConfig().octaves + 1):
@@ -59,6 +83,19 @@ class MConn(AttrsInstance):
     channel: int = -1
     is_out: bool = True
     instruments: List[str] = list()
+    # Inputs only: output midi id the notes are also played on at once (-1 for none),
+    # and its channel (-1 keeps the channel of the input, or of the message for all channels)
+    thru_midi: int = -1
+    thru_channel: int = -1
+    # Inputs only: system messages rtmidi drops before they reach Python,
+    # whether messages of other channels are dropped, statuses let in (empty for all),
+    # and whether the sequencer follows the MIDI clock of the input
+    ignore_sysex: bool = True
+    ignore_timing: bool = True
+    ignore_active_sense: bool = True
+    filter_channel: bool = False
+    statuses: List[int] = list()
+    follow_clock: bool = False
 
     def __attrs_post_init__(self):
         max_instr = InitConfig().max_instr
@@ -119,16 +156,7 @@ class MMappings(AttrsInstance):
 
     @staticmethod
     def get_port_names_comb() -> List[Tuple[int, str, bool]]:
-        midi_out = rtmidi.MidiOut()
-        midi_in = rtmidi.MidiIn()
-        out_port_names = midi_out.get_ports()
-        out_port_ids = list(range(len(out_port_names)))
-        in_port_names = midi_in.get_ports()
-        in_port_ids = list(range(len(in_port_names)))
-        port_names_comb = list(
-            zip(out_port_ids, out_port_names, [True] * len(out_port_names))
-        ) + list(zip(in_port_ids, in_port_names, [False] * len(in_port_names)))
-        return port_names_comb
+        return PORT_REGISTRY.get_port_names_comb()
 
     def init_midi_outs(self) -> Dict[int, MMiDi]:
         port_names_comb = self.get_port_names_comb()
@@ -167,7 +195,12 @@ class MMusic(AttrsInstance):
     name: str
     mappings_name: str
     comment: str
-    data: Dict[int, Dict[int, Dict[int, Dict[int, Dict[str, List[List[int]]]]]]]
+    data: MusicData
+    # Full music holds every step, sparse music only steps that differ from out mode defaults
+    version: int = MUSIC_VERSION_FULL
+
+    def is_sparse(self) -> bool:
+        return self.version >= MUSIC_VERSION_SPARSE
 
 
 @define
@@ -243,6 +276,67 @@ class SFunctionality(AttrsInstance):
         return self
 
 
+class MInCache:
+    """
+    This class keeps the in rules of an in mode compiled into flat checks per step,
+    together with the status and channel each step needs (None for any).
+    It is shared by all copies of an in mode and never pickled (it is rebuilt on demand).
+    """
+
+    # message[i] == value, message[0] >= value (else the sign flips), message[i] == previous[i]
+    equal, minimum, match = 0, 1, 2
+
+    def __init__(self):
+        self.checks: List[List[Tuple[int, int, int]]] = list()
+        self.keys: List[Tuple[Optional[int], Optional[int]]] = list()
+        # A note on followed by the note off of its key, paired in a note table
+        self.note_pair: bool = False
+        self.compiled: bool = False
+
+    def __deepcopy__(self, memo: Dict[int, object]) -> "MInCache":
+        return self
+
+    def __reduce__(self) -> Tuple[type, Tuple]:
+        return MInCache, ()
+
+    def compile(self, in_rules: List[List[Union[str, int]]]) -> "MInCache":
+        for rules in in_rules:
+            checks: List[Tuple[int, int, int]] = list()
+            status: Optional[int] = None
+            channel: Optional[int] = None
+            for i, rule in enumerate(rules):
+                if isinstance(rule, int) and rule > 0:
+                    checks.append((self.equal, i, rule))
+                    status = rule if i == 0 else status
+                    channel = rule if i == 4 else channel
+                elif isinstance(rule, int):
+                    checks.append((self.minimum, 0, abs(rule)))
+                elif rule == "match":
+                    checks.append((self.match, i, 0))
+            self.checks.append(checks)
+            self.keys.append((status, channel))
+        self.note_pair = len(self.checks) == 2 and (self.match, 1, 0) in self.checks[1]
+        self.compiled = True
+        return self
+
+    def accepts(self, exe: int, status: int, channel: int) -> bool:
+        rule_status, rule_channel = self.keys[exe]
+        return (rule_status is None or rule_status == status) and (
+            rule_channel is None or rule_channel == channel
+        )
+
+    def apply(self, exe: int, message: List[int], previous: Optional[List[int]]) -> int:
+        all_apply = 1
+        for kind, i, value in self.checks[exe]:
+            if kind == self.equal:
+                all_apply = all_apply * int(message[i] == value)
+            elif kind == self.minimum:
+                all_apply = all_apply if message[0] >= value else -all_apply
+            elif previous is not None:
+                all_apply = int(message[i] == previous[i]) if all_apply else 0
+        return all_apply
+
+
 @define
 class MInFunctionality(AttrsInstance):
     # MIDI & In Modes
@@ -256,11 +350,12 @@ class MInFunctionality(AttrsInstance):
     _t_2_: float = 0.0
     _exe_: int = 0
     _lock_: bool = True
+    _cache_: Optional[MInCache] = field(default=None, eq=False, repr=False)
 
     def new(self, lock: bool) -> "MInFunctionality":
         new = deepcopy(self)
         new._lock_ = lock
-        new._t_1_ = time.time()
+        new._t_1_ = time.perf_counter()
         new._t_2_ = 0.0
         new.data.clear()
         return new
@@ -271,7 +366,11 @@ class MInFunctionality(AttrsInstance):
         if not self._lock_:
             if self._exe_ < len(self.in_rules):
                 self.apply_time(t=t)
-                applied = self.rules_apply(self.in_rules[self._exe_], message=message)
+                applied = self.get_cache().apply(
+                    exe=self._exe_,
+                    message=message,
+                    previous=self.data[self._exe_ - 1] if self._exe_ > 0 else None,
+                )
                 if applied != 0:
                     self.data.append(message)
                     self._exe_ += 1
@@ -291,23 +390,18 @@ class MInFunctionality(AttrsInstance):
                 self._t_2_ = t[0]
         return self
 
-    def rules_apply(self, rules: List[Union[str, int]], message: List[int]) -> int:
-        all_apply = 1
-        for i, rule in enumerate(rules):
-            if isinstance(rule, int):
-                if rule > 0:
-                    all_apply = all_apply * int(message[i] == rule)
-                else:
-                    if message[0] >= abs(rule):
-                        all_apply = all_apply
-                    else:
-                        all_apply = -all_apply
-            elif isinstance(rule, str):
-                if rule == "match":
-                    all_apply = all_apply and (message[i] == self.data[self._exe_ - 1][i])
-                elif rule == "":
-                    all_apply = all_apply
-        return all_apply
+    def get_cache(self) -> MInCache:
+        if self._cache_ is None:
+            self._cache_ = MInCache()
+        if not self._cache_.compiled:
+            self._cache_.compile(in_rules=self.in_rules)
+        return self._cache_
+
+    def accepts(self, status: int, channel: int) -> bool:
+        """True if the message could be the next one of this in mode."""
+        return self.has_next() and self.get_cache().accepts(
+            exe=self._exe_, status=status, channel=channel
+        )
 
     def has_next(self) -> bool:
         return self._exe_ < len(self.in_rules)
@@ -322,24 +416,38 @@ class MInFunctionality(AttrsInstance):
     def convert_with_out_modes_and_tempo(
         self, out_modes: Dict[str, "MOutFunctionality"], tempo: int, n_quants: int
     ) -> Optional[Tuple[int, int, "MOutFunctionality"]]:
+        converted = self.convert_data_with_out_modes_and_tempo(
+            data=self.data[: self._exe_],
+            duration=self._t_2_ - self._t_1_,
+            out_modes=out_modes,
+            tempo=tempo,
+            n_quants=n_quants,
+        )
+        self.reset()
+        return converted
+
+    def convert_data_with_out_modes_and_tempo(
+        self,
+        data: List[List[int]],
+        duration: float,
+        out_modes: Dict[str, "MOutFunctionality"],
+        tempo: int,
+        n_quants: int,
+    ) -> Optional[Tuple[int, int, "MOutFunctionality"]]:
+        """Converts messages that completed the in rules, also when held outside (note table)."""
         valid_out_mode, midi_id, channel = self.out_rules[0]
-        if valid_out_mode in out_modes:
-            out_mode = out_modes[str(valid_out_mode)].new(lock=False).reset_offsets(off=0)
-            duration = self._t_2_ - self._t_1_
-            length = self.convert_duration_to_length(
-                duration=duration, tempo=tempo, n_quants=n_quants
-            )
-            self.set_length(length=length, exe=0)
-            for exe in range(self._exe_):
-                data = self.get_row_values(exe=exe)
-                for i, lab in enumerate(out_mode.get_labels()):
-                    if i < len(data) and lab != "Note" and lab != "Scale" and lab != "Button":
-                        out_mode.set_indexes_with_lab_and_val(lab=lab, val=data[i], exe=exe)
-            self.reset()
-            return int(midi_id), int(channel), out_mode
-        else:
-            self.reset()
+        if valid_out_mode not in out_modes:
             return None
+        out_mode = out_modes[str(valid_out_mode)].new(lock=False).reset_offsets(off=0)
+        data[0][3] = self.convert_duration_to_length(
+            duration=duration, tempo=tempo, n_quants=n_quants
+        )
+        for exe, message in enumerate(data):
+            values = [str(value) for value in message]
+            for i, lab in enumerate(out_mode.get_labels()):
+                if i < len(values) and lab != "Note" and lab != "Scale" and lab != "Button":
+                    out_mode.set_indexes_with_lab_and_val(lab=lab, val=values[i], exe=exe)
+        return int(midi_id), int(channel), out_mode
 
     @staticmethod
     def convert_duration_to_length(duration: float, tempo: int, n_quants: int) -> int:
@@ -350,16 +458,72 @@ class MInFunctionality(AttrsInstance):
             length = int(ValidLengths.SEXDECUPLE.value)
         return length
 
-    def set_length(self, length: int, exe: int) -> "MInFunctionality":
-        self.data[exe][3] = length
+
+class MOutCache:
+    """
+    This class keeps the data of an out mode compiled into integer lookup tables,
+    together with the messages and MIDI bytes already built from them.
+    It is shared by all copies of an out mode and never pickled (it is rebuilt on demand).
+    """
+
+    skip_labels: Tuple[str, ...] = ("Note", "Scale", "Button")
+
+    def __init__(self):
+        self.columns: List[int] = list()
+        self.tables: List[List[int]] = list()
+        self.messages: Dict[Tuple[int, ...], Tuple[int, ...]] = dict()
+        self.bytes: Dict[Tuple[Tuple[int, ...], int], Tuple[int, ...]] = dict()
+        self.but_col: int = -1
+        self.but_na: List[bool] = list()
+        self.compiled: bool = False
+
+    def __deepcopy__(self, memo: Dict[int, object]) -> "MOutCache":
         return self
 
-    def get_row_values(self, exe: int) -> List[str]:
-        values: List[str] = list()
-        if exe < len(self.data):
-            for value in self.data[exe]:
-                values.append(str(value))
-        return values
+    def __reduce__(self) -> Tuple[type, Tuple]:
+        return MOutCache, ()
+
+    def compile(self, labels: List[str], data: List[List[str]], but_col: int) -> "MOutCache":
+        for i, lab in enumerate(labels):
+            if lab not in self.skip_labels and i < len(data):
+                self.columns.append(i)
+                self.tables.append([self.to_int(value) for value in data[i]])
+        if but_col < len(data):
+            self.but_col = but_col
+            self.but_na = [value == ValidButtons.NA for value in data[but_col]]
+        self.compiled = True
+        return self
+
+    @staticmethod
+    def to_int(value: str) -> int:
+        try:
+            return int(value)
+        except ValueError:
+            return -1
+
+    def get_message(self, row: List[int]) -> Tuple[int, ...]:
+        key = tuple(row)
+        message = self.messages.get(key)
+        if message is None:
+            message = tuple(
+                self.tables[k][row[col]] for k, col in enumerate(self.columns) if col < len(row)
+            )
+            self.messages[key] = message
+        return message
+
+    def get_bytes(self, message: Tuple[int, ...], ch: int) -> Tuple[int, ...]:
+        key = (message, ch)
+        midi_bytes = self.bytes.get(key)
+        if midi_bytes is None:
+            command = (message[0] & 0xF0) | ((ch if ch else 1) - 1 & 0xF)
+            midi_bytes = (command,) + tuple(value & 0x7F for value in message[1:3])
+            self.bytes[key] = midi_bytes
+        return midi_bytes
+
+    def is_button_na(self, indexes: List[List[int]]) -> bool:
+        if len(indexes) and 0 <= self.but_col < len(indexes[0]):
+            return self.but_na[indexes[0][self.but_col]]
+        return True
 
 
 @define
@@ -378,11 +542,12 @@ class MOutFunctionality(AttrsInstance):
     _t_2_: float = 0.0
     _exe_: int = 0
     _lock_: bool = True
+    _cache_: Optional[MOutCache] = field(default=None, eq=False, repr=False)
 
     def new(self, lock: bool) -> "MOutFunctionality":
         new = deepcopy(self)
         new._lock_ = lock
-        new._t_1_ = time.time()
+        new._t_1_ = time.perf_counter()
         new._t_2_ = 0.0
         return new
 
@@ -464,6 +629,7 @@ class MOutFunctionality(AttrsInstance):
         if lab in self.labels:
             ind = self.labels.index(lab)
             self.data[ind] = data
+            self._cache_ = None
         else:
             raise ValueError(f"Label {lab} not found!")
         return self
@@ -484,6 +650,8 @@ class MOutFunctionality(AttrsInstance):
                             if lab == "Note" and "Key" in self.labels:
                                 note = self.data[off_int][ind]
                                 if "-" in note:
+                                    from mingus.containers import Note
+
                                     key = str(int(Note(note)) + 12)
                                     self.set_indexes_with_lab_and_val("Key", key)
         else:
@@ -531,22 +699,76 @@ class MOutFunctionality(AttrsInstance):
                         self.indexes[i][j] = indexes[i][j]
         return self
 
-    def get_as_message(self) -> List[int]:
+    def get_cache(self) -> MOutCache:
+        if self._cache_ is None:
+            self._cache_ = MOutCache()
+        if not self._cache_.compiled:
+            self._cache_.compile(labels=self.labels, data=self.data, but_col=self.but_ind[1])
+        return self._cache_
+
+    def new_event(self, indexes: Optional[List[List[int]]] = None) -> "MOutEvent":
+        if indexes is None:
+            indexes = self.indexes
+        return MOutEvent(proto=self, indexes=indexes, exe_=self._exe_)
+
+    def is_button_na(self, indexes: List[List[int]]) -> bool:
+        return self.get_cache().is_button_na(indexes=indexes)
+
+    def get_as_message(self) -> Tuple[int, ...]:
         if self._lock_:
             raise PermissionError(f"{self.name} out_mode is locked!")
-        values_int: List[int] = list()
+        message: Tuple[int, ...] = tuple()
         if self._exe_ < len(self.indexes):
-            values_str = self.get_row_values(exe=self._exe_)
-            labels_str = self.get_labels()
-            for i, value_str in enumerate(values_str):
-                if (
-                    labels_str[i] != "Note"
-                    and labels_str[i] != "Scale"
-                    and labels_str[i] != "Button"
-                ):
-                    values_int.append(int(value_str))
+            message = self.get_cache().get_message(row=self.indexes[self._exe_])
+        self._exe_ += 1
+        return message
+
+    def get_as_bytes(self, message: Tuple[int, ...], ch: int) -> Tuple[int, ...]:
+        return self.get_cache().get_bytes(message=message, ch=ch)
+
+
+@define
+class MOutEvent(AttrsInstance):
+    # A single play of an out mode, the data stays in the shared (never modified) prototype
+    proto: MOutFunctionality = field(repr=False)
+    indexes: List[List[int]]
+    _exe_: int = 0
+
+    @property
+    def name(self) -> str:
+        return self.proto.name
+
+    def get_exe(self) -> int:
+        return self._exe_
+
+    def has_next(self) -> bool:
+        return self._exe_ < len(self.indexes)
+
+    def get_indexes(self) -> List[List[int]]:
+        return deepcopy(self.indexes)
+
+    def get_but_label(self) -> str:
+        return self.proto.get_but_label()
+
+    def get_single_value_by_lab(self, exe: int, lab: str) -> str:
+        if exe < len(self.indexes):
+            if lab in self.proto.labels:
+                ind = self.proto.labels.index(lab)
+                if ind < len(self.indexes[exe]):
+                    return self.proto.data[ind][self.indexes[exe][ind]]
+            else:
+                raise ValueError(f"Label {lab} not found!")
+        return ValidButtons.NA
+
+    def get_as_message(self) -> Tuple[int, ...]:
+        message: Tuple[int, ...] = tuple()
+        if self._exe_ < len(self.indexes):
+            message = self.proto.get_cache().get_message(row=self.indexes[self._exe_])
         self._exe_ += 1
-        return values_int
+        return message
+
+    def get_as_bytes(self, message: Tuple[int, ...], ch: int) -> Tuple[int, ...]:
+        return self.proto.get_cache().get_bytes(message=message, ch=ch)
 
 
 class PlayN(NFunctionality):
@@ -1,11 +1,12 @@
 from collections import defaultdict
-from typing import Dict, List, Tuple
-
-from mingus.core import keys
+from copy import deepcopy
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 from .configs import InitConfig
 from .const import ValidButtons, ValidInstruments, ValidLengths, ValidNav, ValidSettings
 from .functionalities import (
+    MUSIC_VERSION_SPARSE,
     CopyN,
     CopyS,
     EChannelS,
@@ -48,10 +49,31 @@ from .functionalities import (
     VStepS,
     create_notes,
 )
+from .store import Fill, SequenceStore, StoreView
+
+# The default and the major and minor keys of mingus.core.keys, as the engine does not need mingus.
+SCALES: List[str] = [
+    "C",
+    "Cb",
+    "Gb",
+    "Db",
+    "Ab",
+    "Eb",
+    "Bb",
+    "F",
+    "C",
+    "G",
+    "D",
+    "A",
+    "E",
+    "B",
+    "F#",
+    "C#",
+] + ["ab", "eb", "bb", "f", "c", "g", "d", "a", "e", "b", "f#", "c#", "g#", "d#", "a#"]
 
 
 def create_scales() -> List[str]:
-    return ["C"] + keys.major_keys + keys.minor_keys
+    return list(SCALES)
 
 
 def create_motions() -> List[str]:
@@ -72,168 +94,202 @@ def create_motions() -> List[str]:
     return button_motions
 
 
-VOICE_1_OUT = MOutFunctionality(
-    name="GeVo1Out",
-    comment="Generic MIDI start and stop of a note",
-    instruments=[str(ValidInstruments.GENERIC_OUT)],
-    data=[
-        [str(0), str(0x90), str(0x80)],
-        [str(-1)] + [str(i) for i in range(128)],
-        [
-            str(i)
-            for i in range(
-                InitConfig().velocity_min, InitConfig().velocity_max + 1, InitConfig().velocity_step
-            )
+@lru_cache(maxsize=None)
+def create_voice_1_out() -> MOutFunctionality:
+    return MOutFunctionality(
+        name="GeVo1Out",
+        comment="Generic MIDI start and stop of a note",
+        instruments=[str(ValidInstruments.GENERIC_OUT)],
+        data=[
+            [str(0), str(0x90), str(0x80)],
+            [str(-1)] + [str(i) for i in range(128)],
+            [
+                str(i)
+                for i in range(
+                    InitConfig().velocity_min,
+                    InitConfig().velocity_max + 1,
+                    InitConfig().velocity_step,
+                )
+            ],
+            [str(x.value) for x in list(ValidLengths)],
+            create_notes(scale="C"),
+            create_scales(),
         ],
-        [str(x.value) for x in list(ValidLengths)],
-        create_notes(scale="C"),
-        create_scales(),
-    ],
-    indexes=[[1, 0, 6, 1, 0, 0], [2, 0, 0, 0, 0, 0]],
-    offsets=[1, 0, 6, 1, 1 + 8 * 3, 0],
-    labels=["Code", "Key", "Velocity", "Length", "Note", "Scale"],
-    vis_ind=[0, 1],
-    but_ind=[0, 4],
-)
+        indexes=[[1, 0, 6, 1, 0, 0], [2, 0, 0, 0, 0, 0]],
+        offsets=[1, 0, 6, 1, 1 + 8 * 3, 0],
+        labels=["Code", "Key", "Velocity", "Length", "Note", "Scale"],
+        vis_ind=[0, 1],
+        but_ind=[0, 4],
+    )
 
-VOICE_2_OUT = MOutFunctionality(
-    name="GeVo2Out",
-    comment="Generic MIDI start and stop of a note",
-    instruments=[str(ValidInstruments.GENERIC_OUT)],
-    data=[
-        [str(0), str(0x90), str(0x80)],
-        [str(-1)] + [str(i) for i in range(128)],
-        [
-            str(i * InitConfig().velocity_step)
-            for i in range(InitConfig().velocity_min, InitConfig().velocity_max + 1)
+
+@lru_cache(maxsize=None)
+def create_voice_2_out() -> MOutFunctionality:
+    return MOutFunctionality(
+        name="GeVo2Out",
+        comment="Generic MIDI start and stop of a note",
+        instruments=[str(ValidInstruments.GENERIC_OUT)],
+        data=[
+            [str(0), str(0x90), str(0x80)],
+            [str(-1)] + [str(i) for i in range(128)],
+            [
+                str(i * InitConfig().velocity_step)
+                for i in range(InitConfig().velocity_min, InitConfig().velocity_max + 1)
+            ],
+            [str(x.value) for x in list(ValidLengths)],
+            create_notes(scale="C"),
+            create_scales(),
         ],
-        [str(x.value) for x in list(ValidLengths)],
-        create_notes(scale="C"),
-        create_scales(),
-    ],
-    indexes=[[1, 0, 6, 1, 0, 0], [2, 0, 0, 0, 0, 0]],
-    offsets=[1, 0, 6, 1, 1 + 8 * 3, 0],
-    labels=["Code", "Key", "Velocity", "Length", "Note", "Scale"],
-    but_ind=[0, 4],
-    vis_ind=[0, 1],
-)
+        indexes=[[1, 0, 6, 1, 0, 0], [2, 0, 0, 0, 0, 0]],
+        offsets=[1, 0, 6, 1, 1 + 8 * 3, 0],
+        labels=["Code", "Key", "Velocity", "Length", "Note", "Scale"],
+        but_ind=[0, 4],
+        vis_ind=[0, 1],
+    )
 
-CUTOFF_EG_INT_OUT = MOutFunctionality(
-    name="VBCutEGIOut",
-    comment="Volca Bass Cutoff EG Intensity CC",
-    instruments=[str(ValidInstruments.VOLCA_BASS_OUT)],
-    data=[
-        [str(0), str(0x90), str(0x80)],
-        create_motions(),
-    ],
-    indexes=[[1, 0]],
-    offsets=[1, 1],
-    labels=["Code", "Cutoff"],
-    but_ind=[0, 1],
-    vis_ind=[0, 1],
-)
 
-VOICE_1_IN = MInFunctionality(
-    name="GeVo1In",
-    instruments=[str(ValidInstruments.GENERIC_IN)],
-    comment="",
-    data=[],
-    in_rules=[[0x90, ""], [0x80, "match"]],
-    out_rules=[["GeVo1Out", -1, -1], ["", -1, -1]],
-)
+@lru_cache(maxsize=None)
+def create_cutoff_eg_int_out() -> MOutFunctionality:
+    return MOutFunctionality(
+        name="VBCutEGIOut",
+        comment="Volca Bass Cutoff EG Intensity CC",
+        instruments=[str(ValidInstruments.VOLCA_BASS_OUT)],
+        data=[
+            [str(0), str(0x90), str(0x80)],
+            create_motions(),
+        ],
+        indexes=[[1, 0]],
+        offsets=[1, 1],
+        labels=["Code", "Cutoff"],
+        but_ind=[0, 1],
+        vis_ind=[0, 1],
+    )
 
-VOICE_2_IN = MInFunctionality(
-    name="GeVo2In",
-    in_rules=[[0x90, ""], [0x80, "match"]],
-    out_rules=[["GeVo2Out", -1, -1], ["", -1, -1]],
-    instruments=[str(ValidInstruments.GENERIC_IN)],
-    comment="",
-    data=[],
-)
 
-MMAPPINGS_00 = MMappings(
-    name="Mappings_00",
-    comment="",
-    conns=[
-        MConn(
-            midi_id=0,
-            port_name="USB MIDI Interface",
-            channel=1,
-            is_out=True,
-            instruments=[str(ValidInstruments.GENERIC_OUT)],
-        ),
-        MConn(
-            midi_id=1,
-            port_name="USB2.0-MIDI Port 2",
-            channel=1,
-            is_out=True,
-            instruments=[str(ValidInstruments.GENERIC_OUT)],
-        ),
-        MConn(
-            midi_id=2,
-            port_name="USB MIDI Interface",
-            channel=1,
-            is_out=True,
-            instruments=[str(ValidInstruments.GENERIC_OUT)],
-        ),
-        MConn(
-            midi_id=3,
-            port_name="USB2.0-MIDI Port 2",
-            channel=1,
-            is_out=True,
-            instruments=[str(ValidInstruments.GENERIC_OUT)],
-        ),
-        MConn(
-            midi_id=4,
-            port_name="USB MIDI Interface",
-            channel=1,
-            is_out=False,
-            instruments=[str(ValidInstruments.GENERIC_IN)],
-        ),
-        MConn(
-            midi_id=4,
-            port_name="USB MIDI Interface",
-            channel=2,
-            is_out=False,
-            instruments=[str(ValidInstruments.GENERIC_IN)],
-        ),
-    ],
-)
+@lru_cache(maxsize=None)
+def create_voice_1_in() -> MInFunctionality:
+    return MInFunctionality(
+        name="GeVo1In",
+        instruments=[str(ValidInstruments.GENERIC_IN)],
+        comment="",
+        data=[],
+        in_rules=[[0x90, ""], [0x80, "match"]],
+        out_rules=[["GeVo1Out", -1, -1], ["", -1, -1]],
+    )
+
+
+@lru_cache(maxsize=None)
+def create_voice_2_in() -> MInFunctionality:
+    return MInFunctionality(
+        name="GeVo2In",
+        in_rules=[[0x90, ""], [0x80, "match"]],
+        out_rules=[["GeVo2Out", -1, -1], ["", -1, -1]],
+        instruments=[str(ValidInstruments.GENERIC_IN)],
+        comment="",
+        data=[],
+    )
 
-MMAPPINGS_01 = MMappings(
-    name="Mappings_01",
-    comment="",
-    conns=[
-        MConn(
-            midi_id=0,
-            channel=1,
-            is_out=True,
-            instruments=[str(ValidInstruments.VOLCA_DRUM_OUT), str(ValidInstruments.GENERIC_OUT)],
-            port_name="",
-        ),
-        MConn(
-            midi_id=1,
-            channel=1,
-            is_out=True,
-            instruments=[str(ValidInstruments.VOLCA_BASS_OUT), str(ValidInstruments.GENERIC_OUT)],
-            port_name="",
-        ),
-        MConn(
-            midi_id=2,
-            channel=1,
-            is_out=True,
-            instruments=[str(ValidInstruments.VOLCA_KEYS_OUT), str(ValidInstruments.GENERIC_OUT)],
-            port_name="",
-        ),
-        MConn(
-            midi_id=3,
-            channel=1,
-            is_out=True,
-            instruments=[str(ValidInstruments.VOLCA_FM2_OUT), str(ValidInstruments.GENERIC_OUT)],
-            port_name="",
-        ),
-    ],
-)
+
+@lru_cache(maxsize=None)
+def create_mmappings_00() -> MMappings:
+    return MMappings(
+        name="Mappings_00",
+        comment="",
+        conns=[
+            MConn(
+                midi_id=0,
+                port_name="USB MIDI Interface",
+                channel=1,
+                is_out=True,
+                instruments=[str(ValidInstruments.GENERIC_OUT)],
+            ),
+            MConn(
+                midi_id=1,
+                port_name="USB2.0-MIDI Port 2",
+                channel=1,
+                is_out=True,
+                instruments=[str(ValidInstruments.GENERIC_OUT)],
+            ),
+            MConn(
+                midi_id=2,
+                port_name="USB MIDI Interface",
+                channel=1,
+                is_out=True,
+                instruments=[str(ValidInstruments.GENERIC_OUT)],
+            ),
+            MConn(
+                midi_id=3,
+                port_name="USB2.0-MIDI Port 2",
+                channel=1,
+                is_out=True,
+                instruments=[str(ValidInstruments.GENERIC_OUT)],
+            ),
+            MConn(
+                midi_id=4,
+                port_name="USB MIDI Interface",
+                channel=1,
+                is_out=False,
+                instruments=[str(ValidInstruments.GENERIC_IN)],
+            ),
+            MConn(
+                midi_id=4,
+                port_name="USB MIDI Interface",
+                channel=2,
+                is_out=False,
+                instruments=[str(ValidInstruments.GENERIC_IN)],
+            ),
+        ],
+    )
+
+
+@lru_cache(maxsize=None)
+def create_mmappings_01() -> MMappings:
+    return MMappings(
+        name="Mappings_01",
+        comment="",
+        conns=[
+            MConn(
+                midi_id=0,
+                channel=1,
+                is_out=True,
+                instruments=[
+                    str(ValidInstruments.VOLCA_DRUM_OUT),
+                    str(ValidInstruments.GENERIC_OUT),
+                ],
+                port_name="",
+            ),
+            MConn(
+                midi_id=1,
+                channel=1,
+                is_out=True,
+                instruments=[
+                    str(ValidInstruments.VOLCA_BASS_OUT),
+                    str(ValidInstruments.GENERIC_OUT),
+                ],
+                port_name="",
+            ),
+            MConn(
+                midi_id=2,
+                channel=1,
+                is_out=True,
+                instruments=[
+                    str(ValidInstruments.VOLCA_KEYS_OUT),
+                    str(ValidInstruments.GENERIC_OUT),
+                ],
+                port_name="",
+            ),
+            MConn(
+                midi_id=3,
+                channel=1,
+                is_out=True,
+                instruments=[
+                    str(ValidInstruments.VOLCA_FM2_OUT),
+                    str(ValidInstruments.GENERIC_OUT),
+                ],
+                port_name="",
+            ),
+        ],
+    )
 
 
 def init_nav() -> Dict[ValidNav, NFunctionality]:
@@ -292,15 +348,12 @@ def init_settings(
 def init_io_modes_and_instruments_mem() -> (
     Tuple[Dict[str, MOutFunctionality], List[str], Dict[str, MInFunctionality], List[str]]
 ):
-    out_modes: Dict[str, MOutFunctionality] = {
-        VOICE_1_OUT.name: VOICE_1_OUT,
-        VOICE_2_OUT.name: VOICE_2_OUT,
-        CUTOFF_EG_INT_OUT.name: CUTOFF_EG_INT_OUT,
-    }
-    in_modes: Dict[str, MInFunctionality] = {
-        VOICE_1_IN.name: VOICE_1_IN,
-        VOICE_2_IN.name: VOICE_2_IN,
-    }
+    out_modes: Dict[str, MOutFunctionality] = dict()
+    for out_mode in [create_voice_1_out(), create_voice_2_out(), create_cutoff_eg_int_out()]:
+        out_modes[out_mode.name] = out_mode
+    in_modes: Dict[str, MInFunctionality] = dict()
+    for in_mode in [create_voice_1_in(), create_voice_2_in()]:
+        in_modes[in_mode.name] = in_mode
     out_instruments: List[str] = list()
     in_instruments: List[str] = list()
     for out_mode in out_modes.values():
@@ -313,30 +366,85 @@ def init_io_modes_and_instruments_mem() -> (
 
 
 def init_mappings_mem() -> MMappings:
-    return MMAPPINGS_00
+    return create_mmappings_00()
 
 
-def init_music_mem(mappings: MMappings) -> MMusic:
-    sequences: Dict[int, Dict[int, Dict[int, Dict[int, Dict[str, List[List[int]]]]]]] = defaultdict(
-        lambda: defaultdict(lambda: defaultdict(lambda: defaultdict(dict)))
-    )
+def get_music_fills(mappings: MMappings) -> List[Fill]:
+    """Out mode defaults of every mapped midi, channel and out mode."""
     out_modes, _, _, _ = init_io_modes_and_instruments_mem()
     mappings_dict = mappings.to_out_dict(out_modes=out_modes)
+    fills: List[Fill] = list()
     for midi_id in sorted(mappings_dict.keys()):
         for channel in EChannelS().values:
             if int(channel) in mappings_dict[int(midi_id)]:
-                for part in EPartS().values:
-                    for step in EStepS().values:
-                        for valid_out_mode in out_modes.keys():
-                            if valid_out_mode in mappings_dict[int(midi_id)][int(channel)]:
-                                out_mode = out_modes[valid_out_mode].new(lock=False)
-                                sequences[int(midi_id)][int(channel)][int(part)][int(step)][
-                                    valid_out_mode
-                                ] = out_mode.get_indexes()
+                for valid_out_mode in out_modes.keys():
+                    if valid_out_mode in mappings_dict[int(midi_id)][int(channel)]:
+                        fills.append(
+                            (
+                                int(midi_id),
+                                int(channel),
+                                valid_out_mode,
+                                out_modes[valid_out_mode].indexes,
+                            )
+                        )
+    return fills
+
+
+def init_music_mem(mappings: MMappings, store: Optional[SequenceStore] = None) -> MMusic:
+    """Without a store the music is built as nested dicts (the layout of MMusic presets)."""
+    sequences: Dict[int, Dict[int, Dict[int, Dict[int, Dict[str, List[List[int]]]]]]] = defaultdict(
+        lambda: defaultdict(lambda: defaultdict(lambda: defaultdict(dict)))
+    )
+    fills = get_music_fills(mappings=mappings)
+    if store is not None:
+        store.load(data=dict(), fills=fills)
+    else:
+        for midi_id, channel, valid_out_mode, indexes in fills:
+            for part in EPartS().values:
+                for step in EStepS().values:
+                    sequences[midi_id][int(channel)][int(part)][int(step)][valid_out_mode] = (
+                        deepcopy(indexes)
+                    )
     m_music = MMusic(
-        name="Music_00", data=sequences, mappings_name=mappings.name, comment="Starter package"
+        name="Music_00",
+        data=sequences if store is None else StoreView(store=store),
+        mappings_name=mappings.name,
+        comment="Starter package",
     )
     return m_music
 
 
-MUSIC_00 = init_music_mem(mappings=MMAPPINGS_00)
+def init_sparse_music_mem(mappings: MMappings) -> MMusic:
+    """Music holding only out mode defaults, so nothing is left in the sparse form."""
+    return MMusic(
+        name="Music_00",
+        mappings_name=mappings.name,
+        comment="Starter package",
+        data=dict(),
+        version=MUSIC_VERSION_SPARSE,
+    )
+
+
+# Presets built on first access, so importing this module stays cheap.
+LAZY_PRESETS: Dict[str, Callable[[], Any]] = {
+    "VOICE_1_OUT": create_voice_1_out,
+    "VOICE_2_OUT": create_voice_2_out,
+    "CUTOFF_EG_INT_OUT": create_cutoff_eg_int_out,
+    "VOICE_1_IN": create_voice_1_in,
+    "VOICE_2_IN": create_voice_2_in,
+    "MMAPPINGS_00": create_mmappings_00,
+    "MMAPPINGS_01": create_mmappings_01,
+    "MUSIC_00": lambda: init_sparse_music_mem(mappings=create_mmappings_00()),
+}
+
+
+def __getattr__(name: str) -> Any:
+    if name in LAZY_PRESETS:
+        value = LAZY_PRESETS[name]()
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__() -> List[str]:
+    return sorted(set(globals().keys()) | set(LAZY_PRESETS.keys()))
@@ -0,0 +1,105 @@
+import os
+import struct
+import threading
+from collections import deque
+from multiprocessing import Pipe
+from typing import Deque, List, Optional, Tuple
+
+from .const import ValidSettings
+
+OUT_MODE: int = 1
+SETTING: int = 2
+VALID_SETTINGS: List[ValidSettings] = list(ValidSettings)
+SETTING_IDS = {valid_setting.value: i for i, valid_setting in enumerate(VALID_SETTINGS)}
+# kind, out mode or setting id
+HEADER = struct.Struct("<BB")
+# midi, channel, part, step, rows, columns (followed by rows * columns int16 indexes)
+POSITION = struct.Struct("<BBBBBB")
+# index of the setting value
+SETTING_IND = struct.Struct("<i")
+
+
+class IPCPipe:
+    """
+    This class is a one way binary channel between MSApp and the Engine process.
+    Out modes travel as mode id, position and index rows, settings as setting id and index.
+    A feeder thread of the sending process writes to the pipe, so a full pipe never blocks
+    the sender. Out modes are played as they arrive and are all kept, in order, a setting
+    replaces a pending value of the same setting.
+    """
+
+    def __init__(self):
+        self.reader, self.writer = Pipe(duplex=False)
+        self.pending: Deque[bytes] = deque()
+        self.pending_lock = threading.Condition()
+        self.feeder: Optional[threading.Thread] = None
+        self.feeder_pid = -1
+
+    def send(self, data: bytes) -> None:
+        with self.pending_lock:
+            if self.feeder is None or self.feeder_pid != os.getpid():
+                # Threads do not survive the fork of the Engine process.
+                self.feeder = threading.Thread(target=self.feed, daemon=True)
+                self.feeder_pid = os.getpid()
+                self.feeder.start()
+            key = get_merge_key(data)
+            if key is not None and len(self.pending) and get_merge_key(self.pending[-1]) == key:
+                self.pending[-1] = data
+            else:
+                self.pending.append(data)
+            self.pending_lock.notify()
+
+    def feed(self) -> None:
+        while True:
+            with self.pending_lock:
+                while not len(self.pending):
+                    self.pending_lock.wait()
+                data = self.pending.popleft()
+            self.writer.send_bytes(data)
+
+    def poll(self) -> bool:
+        return self.reader.poll()
+
+    def recv(self) -> bytes:
+        return self.reader.recv_bytes()
+
+
+def encode_out_mode(
+    mode_id: int, position: Tuple[int, int, int, int], indexes: List[List[int]]
+) -> bytes:
+    n_rows = len(indexes)
+    n_cols = len(indexes[0]) if n_rows else 0
+    flat = [ind for row in indexes for ind in row]
+    return (
+        HEADER.pack(OUT_MODE, mode_id)
+        + POSITION.pack(*position, n_rows, n_cols)
+        + struct.pack(f"<{len(flat)}h", *flat)
+    )
+
+
+def decode_out_mode(data: bytes) -> Tuple[Tuple[int, int, int, int], List[List[int]]]:
+    midi, channel, part, step, n_rows, n_cols = POSITION.unpack_from(data, HEADER.size)
+    flat = struct.unpack_from(f"<{n_rows * n_cols}h", data, HEADER.size + POSITION.size)
+    indexes = [list(flat[i * n_cols : (i + 1) * n_cols]) for i in range(n_rows)]
+    return (midi, channel, part, step), indexes
+
+
+def encode_setting(name: str, ind: int) -> bytes:
+    return HEADER.pack(SETTING, SETTING_IDS[name]) + SETTING_IND.pack(ind)
+
+
+def decode_setting(data: bytes) -> Tuple[ValidSettings, int]:
+    _, setting_id = HEADER.unpack_from(data)
+    (ind,) = SETTING_IND.unpack_from(data, HEADER.size)
+    return VALID_SETTINGS[setting_id], ind
+
+
+def decode_header(data: bytes) -> Tuple[int, int]:
+    return HEADER.unpack_from(data)
+
+
+def get_merge_key(data: bytes) -> Optional[bytes]:
+    """Kind and id of a setting, out modes are never merged."""
+    if data[0] != SETTING:
+        return None
+    return data[: HEADER.size]
@@ -0,0 +1,34 @@
+from typing import Dict, List, Optional, Tuple
+
+from .functionalities import MInFunctionality
+
+# time of the note on (s), note on message (velocity at 2), in mode it started
+ActiveNote = Tuple[float, List[int], MInFunctionality]
+
+
+class NoteTable:
+    """
+    This class keeps the notes held on one input port by channel and key,
+    so a note off finds its note on in O(1) however many notes are held.
+    """
+
+    def __init__(self):
+        self.notes: Dict[Tuple[int, int], ActiveNote] = dict()
+
+    def __len__(self) -> int:
+        return len(self.notes)
+
+    def note_on(
+        self, channel: int, key: int, t: float, message: List[int], in_mode: MInFunctionality
+    ) -> None:
+        # A key struck again before its note off starts over.
+        self.notes[(channel, key)] = (t, message, in_mode)
+
+    def get(self, channel: int, key: int) -> Optional[ActiveNote]:
+        return self.notes.get((channel, key))
+
+    def note_off(self, channel: int, key: int) -> Optional[ActiveNote]:
+        return self.notes.pop((channel, key), None)
+
+    def clear(self) -> None:
+        self.notes.clear()
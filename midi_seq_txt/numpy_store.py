@@ -0,0 +1,129 @@
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from .store import HEADER_SIZE, SequenceStore
+
+
+class NumpySequenceStore(SequenceStore):
+    """
+    This class is the SequenceStore seen through typed NumPy arrays (optional numpy extra).
+    Scans, fills and snapshots of the whole grid are vectorised.
+    """
+
+    def __init__(
+        self,
+        valid_out_modes: List[str],
+        shapes: List[Tuple[int, int]],
+        vis: List[Tuple[int, int]],
+        defaults: List[List[List[int]]],
+    ):
+        super().__init__(valid_out_modes=valid_out_modes, shapes=shapes, vis=vis, defaults=defaults)
+        self.views += [
+            "cells",
+            "present",
+            "slabs",
+            "slab_versions",
+            "vis_exes",
+            "vis_fields",
+            "default_cells",
+        ]
+
+    def map(self, buf: Optional[memoryview] = None) -> None:
+        if buf is None:
+            buf = self.get_buf()
+        super().map(buf=buf)
+        self.cells = np.ndarray(
+            (self.n_cells, self.n_exes, self.n_fields),
+            dtype=np.int16,
+            buffer=buf,
+            offset=self.values_offset,
+        )
+        self.present = np.ndarray(
+            (self.n_cells,), dtype=np.uint8, buffer=buf, offset=self.presence_offset
+        )
+        self.slabs = np.ndarray(
+            (self.n_slabs,), dtype=np.int32, buffer=buf, offset=self.occupancy_offset
+        )
+        self.slab_versions = np.ndarray(
+            (self.n_slabs,), dtype=np.int32, buffer=buf, offset=HEADER_SIZE
+        )
+        self.vis_exes = np.array([vis_exe for vis_exe, _ in self.vis], dtype=np.intp)
+        self.vis_fields = np.array([vis_field for _, vis_field in self.vis], dtype=np.intp)
+        self.default_cells = np.array(
+            [
+                self.to_array(indexes=indexes, rows=rows, cols=cols)
+                for indexes, (rows, cols) in zip(self.defaults, self.shapes)
+            ],
+            dtype=np.int16,
+        )
+
+    def unmap(self) -> None:
+        del self.cells
+        del self.present
+        del self.slabs
+        del self.slab_versions
+        super().unmap()
+
+    def get_notes(self, cells: "np.ndarray") -> "np.ndarray":
+        modes = cells % self.dims[-1]
+        notes = self.cells[cells, self.vis_exes[modes], self.vis_fields[modes]] > 0
+        return (notes & (self.present[cells] > 0)).astype(np.int32)
+
+    def get_grid(self) -> "np.ndarray":
+        """Dense (midi, channel, part, step, mode, exe, field) array over the shared block."""
+        return self.cells.reshape(self.dims + (self.n_exes, self.n_fields))
+
+    def write_cell(self, cell: int, indexes: List[List[int]]) -> bool:
+        rows, cols = self.shapes[cell % self.dims[-1]]
+        had_note = self.has_note(cell=cell)
+        self.cells[cell] = self.to_array(indexes=indexes, rows=rows, cols=cols)
+        was_present = self.present[cell]
+        self.present[cell] = 1
+        self.slabs[cell // self.slab_size] += self.has_note(cell=cell) - had_note
+        self.slab_versions[cell // self.slab_size] += 1
+        return not was_present
+
+    def fill_cells(self, cells: List[int], indexes: List[List[int]]) -> None:
+        if len(cells):
+            cells_array = np.array(cells, dtype=np.intp)
+            had_notes = self.get_notes(cells=cells_array)
+            rows, cols = self.shapes[cells[0] % self.dims[-1]]
+            self.cells[cells_array] = self.to_array(indexes=indexes, rows=rows, cols=cols)
+            self.present[cells_array] = 1
+            n_notes = self.get_notes(cells=cells_array) - had_notes
+            np.add.at(self.slabs, cells_array // self.slab_size, n_notes)
+            self.slab_versions[np.unique(cells_array // self.slab_size)] += 1
+
+    def bump_versions(self) -> None:
+        self.slab_versions += 1
+
+    def to_array(self, indexes: List[List[int]], rows: int, cols: int) -> "np.ndarray":
+        array = np.zeros((self.n_exes, self.n_fields), dtype=np.int16)
+        for i, row in enumerate(indexes[:rows]):
+            array[i, : min(cols, len(row))] = row[:cols]
+        return array
+
+    def read_cell(self, cell: int) -> List[List[int]]:
+        rows, cols = self.shapes[cell % self.dims[-1]]
+        return self.cells[cell, :rows, :cols].tolist()
+
+    def read_cells(self, cells: List[int]) -> List[List[List[int]]]:
+        values = self.cells[cells].tolist()
+        cells_indexes: List[List[List[int]]] = list()
+        for cell, cell_values in zip(cells, values):
+            rows, cols = self.shapes[cell % self.dims[-1]]
+            cells_indexes.append([row[:cols] for row in cell_values[:rows]])
+        return cells_indexes
+
+    def get_present_cells(self) -> List[int]:
+        return np.flatnonzero(self.present).tolist()
+
+    def get_occupied_slabs(self) -> List[int]:
+        return np.flatnonzero(self.slabs > 0).tolist()
+
+    def get_changed_cells(self) -> List[int]:
+        cells = np.flatnonzero(self.present)
+        defaults = self.default_cells[cells % self.dims[-1]]
+        changed = (self.cells[cells] != defaults).reshape(len(cells), -1).any(axis=1)
+        return cells[changed].tolist()
@@ -0,0 +1,82 @@
+import os
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+import rtmidi
+from rtmidi import MidiIn, MidiOut
+
+from .configs import InitConfig
+
+# port id, port name, is out
+PortNamesComb = List[Tuple[int, str, bool]]
+
+
+def find_port_id(port_names_comb: PortNamesComb, port_name: str, is_out: bool) -> Optional[int]:
+    for port_id, name, port_is_out in port_names_comb:
+        if name == port_name and port_is_out == is_out:
+            return port_id
+    return None
+
+
+class PortRegistry:
+    """
+    This class enumerates the MIDI ports once per process tree (a forked Engine inherits
+    the scan) and keeps the result. A background thread rescans them and reports when
+    devices were plugged in or unplugged.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.port_names_comb: Optional[PortNamesComb] = None
+        # rtmidi clients are not shared with a forked process, they are opened again.
+        self.clients: Optional[Tuple[MidiOut, MidiIn]] = None
+        self.clients_pid = -1
+        self.thread: Optional[threading.Thread] = None
+
+    def get_clients(self) -> Tuple[MidiOut, MidiIn]:
+        if self.clients is None or self.clients_pid != os.getpid():
+            self.clients = rtmidi.MidiOut(), rtmidi.MidiIn()
+            self.clients_pid = os.getpid()
+        return self.clients
+
+    def scan(self) -> PortNamesComb:
+        with self.lock:
+            midi_out, midi_in = self.get_clients()
+            out_port_names = midi_out.get_ports()
+            in_port_names = midi_in.get_ports()
+        port_names_comb: PortNamesComb = list(
+            zip(range(len(out_port_names)), out_port_names, [True] * len(out_port_names))
+        ) + list(zip(range(len(in_port_names)), in_port_names, [False] * len(in_port_names)))
+        return port_names_comb
+
+    def get_port_names_comb(self) -> PortNamesComb:
+        if self.port_names_comb is None:
+            port_names_comb = self.scan()
+            with self.lock:
+                if self.port_names_comb is None:
+                    self.port_names_comb = port_names_comb
+        with self.lock:
+            return list(self.port_names_comb)
+
+    def rescan(self) -> bool:
+        """Returns True if the ports changed since the last scan."""
+        port_names_comb = self.scan()
+        with self.lock:
+            changed = port_names_comb != self.port_names_comb
+            self.port_names_comb = port_names_comb
+        return changed
+
+    def start(self, on_changed: Callable[[], None]) -> None:
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, args=(on_changed,), daemon=True)
+            self.thread.start()
+
+    def run(self, on_changed: Callable[[], None]) -> None:
+        while True:
+            time.sleep(InitConfig().port_scan)
+            if self.rescan():
+                on_changed()
+
+
+PORT_REGISTRY = PortRegistry()
@@ -1,14 +1,27 @@
+import hashlib
+import marshal
 import os
+import struct
+import sys
+import threading
+import time
 from argparse import Namespace
 from glob import iglob
 from pathlib import Path
-from typing import Any, Dict, List, Set, Tuple, Type, Union
+from typing import Any, Dict, List, Optional, Set, Tuple, Type, Union
 
 import attrs
 import yaml
-from cattr import structure
+from cattr import register_structure_hook, structure
 
-from .functionalities import MInFunctionality, MMappings, MMusic, MOutFunctionality
+from .functionalities import (
+    MInFunctionality,
+    MMappings,
+    MMusic,
+    MOutFunctionality,
+    MusicData,
+    MusicDict,
+)
 
 PRESET_TYPES: Dict[
     str, Union[Type[MOutFunctionality], Type[MMappings], Type[MMusic], Type[MInFunctionality]]
@@ -18,6 +31,16 @@ PRESET_TYPES: Dict[
     "MInFunctionality": MInFunctionality,
     "MMusic": MMusic,
 }
+# The C (libyaml) loader is much faster, the pure Python one is the fallback.
+# Presets always hold music as nested dicts, store views only exist in a running sequencer.
+register_structure_hook(MusicData, lambda data, _: structure(data, MusicDict))
+YAML_LOADER: Type[yaml.Loader] = getattr(yaml, "CLoader", yaml.Loader)
+YAML_DUMPER: Type[yaml.Dumper] = getattr(yaml, "CDumper", yaml.Dumper)
+PRESET_CACHE_SUFFIX: str = ".cache"
+# The marshal format depends on the Python version.
+PRESET_CACHE_MAGIC: bytes = b"MSC" + bytes([marshal.version, *sys.version_info[:2]])
+# magic, YAML mtime (ns), YAML size, YAML blake2b digest (followed by the marshalled dict)
+PRESET_CACHE_HEADER = struct.Struct("<8sqq16s")
 
 
 def read_all_presets(
@@ -74,20 +97,59 @@ def read_all_presets(
 def read_preset(file_path: str) -> Dict[str, Any]:
     preset_dict: Dict[str, Any] = dict()
     if os.path.exists(file_path):
-        with open(file_path, "r") as fh:
-            preset_dict = yaml.load(fh, yaml.Loader)
+        with open(file_path, "rb") as fh:
+            content = fh.read()
+            mtime_ns = os.fstat(fh.fileno()).st_mtime_ns
+        header = PRESET_CACHE_HEADER.pack(
+            PRESET_CACHE_MAGIC,
+            mtime_ns,
+            len(content),
+            hashlib.blake2b(content, digest_size=16).digest(),
+        )
+        cached_dict = read_preset_cache(file_path=file_path, header=header)
+        if cached_dict is None:
+            preset_dict = yaml.load(content, YAML_LOADER)
+            write_preset_cache(file_path=file_path, header=header, preset_dict=preset_dict)
+        else:
+            preset_dict = cached_dict
     return preset_dict
 
 
+def get_preset_cache_path(file_path: str) -> str:
+    return f"{file_path}{PRESET_CACHE_SUFFIX}"
+
+
+def read_preset_cache(file_path: str, header: bytes) -> Optional[Dict[str, Any]]:
+    """Returns the cached preset dict, if the YAML file did not change since it was cached."""
+    try:
+        with open(get_preset_cache_path(file_path=file_path), "rb") as fh:
+            if fh.read(PRESET_CACHE_HEADER.size) == header:
+                return marshal.loads(fh.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    return None
+
+
+def write_preset_cache(file_path: str, header: bytes, preset_dict: Dict[str, Any]) -> None:
+    cache_path = get_preset_cache_path(file_path=file_path)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        payload = marshal.dumps(preset_dict)
+        with open(tmp_path, "wb") as fh:
+            fh.write(header + payload)
+        os.replace(tmp_path, cache_path)
+    except (OSError, ValueError):
+        # The cache is optional (read only presets, values marshal can not store).
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
 def read_preset_type(
     file_path: str,
 ) -> Union[MMappings, MOutFunctionality, MMusic, MInFunctionality]:
     path = Path(file_path)
     class_name = path.parts[-2]
-    preset_dict: Dict[str, Any] = dict()
-    if os.path.exists(file_path):
-        with open(file_path, "r") as fh:
-            preset_dict = yaml.load(fh, yaml.Loader)
+    preset_dict = read_preset(file_path=file_path)
     preset_type: Union[
         Type[MOutFunctionality], Type[MMappings], Type[MMusic], Type[MInFunctionality]
     ] = PRESET_TYPES[class_name]
@@ -109,7 +171,19 @@ def write_preset_type(
     preset_type = preset.__class__.__name__
     preset_dict = attrs.asdict(preset)
     os.makedirs(f"{loc}/{preset_type}", exist_ok=True)
-    with open(f"{loc}/{preset_type}/{preset.name}.yaml", "w") as fh:
+    file_path = f"{loc}/{preset_type}/{preset.name}.yaml"
+    # Written aside and moved over the old preset, so a failed save never leaves half a file.
+    tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        write_preset_dict(preset_dict=preset_dict, file_path=tmp_path)
+        os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_preset_dict(preset_dict: Dict[str, Any], file_path: str) -> None:
+    with open(file_path, "w") as fh:
         if "_exe_" in preset_dict:
             del preset_dict["_exe_"]
         if "_lock_" in preset_dict:
@@ -118,7 +192,9 @@ def write_preset_type(
             del preset_dict["_t_1_"]
         if "_t_2_" in preset_dict:
             del preset_dict["_t_2_"]
-        yaml.dump(preset_dict, fh)
+        if "_cache_" in preset_dict:
+            del preset_dict["_cache_"]
+        yaml.dump(preset_dict, fh, Dumper=YAML_DUMPER)
 
 
 def write_all_presets(args: Namespace) -> None:
@@ -138,3 +214,20 @@ def write_all_presets(args: Namespace) -> None:
                 presets.append(obj)
     for preset in presets:
         write_preset_type(preset=preset, loc=loc)
+
+
+def time_all_presets(args: Namespace) -> Dict[str, Tuple[float, float]]:
+    """Returns cold (YAML) and warm (cache) load times of every preset in seconds."""
+    loc: str = args.dir
+    timings: Dict[str, Tuple[float, float]] = dict()
+    for file_path in sorted(iglob(f"{loc}/*/*.yaml")):
+        cache_path = get_preset_cache_path(file_path=file_path)
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        start = time.perf_counter()
+        read_preset(file_path=file_path)
+        cold = time.perf_counter() - start
+        start = time.perf_counter()
+        read_preset(file_path=file_path)
+        timings[file_path] = (cold, time.perf_counter() - start)
+    return timings
@@ -0,0 +1,44 @@
+from typing import List, Optional, Tuple
+
+# message bytes, time (ns) of the message (rtmidi deltas added up from the first arrival)
+InMessage = Tuple[List[int], int]
+
+
+class MessageRing:
+    """
+    This class is a preallocated ring of MIDI input messages with one producer
+    (the rtmidi callback thread) and one consumer (the engine). It needs no lock,
+    as the producer only moves the tail and the consumer only moves the head.
+    Messages arriving while the ring is full are dropped and counted.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.slots: List[Optional[InMessage]] = [None] * size
+        self.head = 0
+        self.tail = 0
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return self.tail - self.head
+
+    def push(self, message: List[int], ns: int) -> bool:
+        if self.tail - self.head >= self.size:
+            self.dropped += 1
+            return False
+        self.slots[self.tail % self.size] = (message, ns)
+        # Published only after the slot is written.
+        self.tail += 1
+        return True
+
+    def drain(self) -> List[InMessage]:
+        """Returns all pending messages, oldest first."""
+        tail = self.tail
+        messages: List[InMessage] = list()
+        for i in range(self.head, tail):
+            message = self.slots[i % self.size]
+            if message is not None:
+                messages.append(message)
+            self.slots[i % self.size] = None
+        self.head = tail
+        return messages
@@ -0,0 +1,43 @@
+import threading
+import time
+from typing import Optional
+
+from .clock import Clock
+from .configs import InitConfig
+
+
+class Scheduler:
+    """
+    This class puts the engine to sleep until the next deadline.
+    Inputs and IPC can wake it up earlier with notify().
+    """
+
+    def __init__(self):
+        self.internal_config = InitConfig()
+        self.wakeup = threading.Event()
+
+    def notify(self) -> None:
+        self.wakeup.set()
+
+    def wait_until(self, deadline: Optional[int]) -> bool:
+        """Returns True if woken up before the deadline (monotonic ns)."""
+        timeout = self.internal_config.max_sleep
+        if deadline is not None:
+            timeout = min(timeout, (deadline - Clock.now_ns()) / 10**9)
+        if timeout > self.internal_config.spin_sleep:
+            if self.wakeup.wait(timeout - self.internal_config.spin_sleep):
+                self.wakeup.clear()
+                return True
+        if timeout >= self.internal_config.max_sleep:
+            # A far deadline is only spun for in the last sleep before it.
+            return False
+        return self.spin_until(deadline=deadline)
+
+    def spin_until(self, deadline: Optional[int]) -> bool:
+        # The last fraction of a millisecond is not left to the OS timer.
+        while deadline is not None and Clock.now_ns() < deadline:
+            if self.wakeup.is_set():
+                self.wakeup.clear()
+                return True
+            time.sleep(0)
+        return False
@@ -1,41 +1,64 @@
-import math
-import time
-from collections import defaultdict
-from typing import Dict, List, Optional, Set, Tuple, Type, Union
+import heapq
+import threading
+from collections import defaultdict, deque
+from operator import itemgetter
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple, Type, Union
 
 import rtmidi
 from rtmidi import MidiIn, MidiOut
 
+from .bank import MusicBank
+from .clock import Clock, ClockFollower
+from .coalesce import CCCoalescer
+from .compiler import CompiledEvent, LoopKey, PartCompiler, cut_events
 from .configs import InitConfig
 from .const import ValidButtons, ValidSettings
 from .functionalities import (
+    MUSIC_VERSION_SPARSE,
     MInFunctionality,
     MMappings,
     MMiDi,
     MMusic,
+    MOutEvent,
     MOutFunctionality,
+    MusicTree,
     SFunctionality,
 )
 from .init import (
+    get_music_fills,
     init_io_modes_and_instruments_mem,
     init_mappings_mem,
     init_music_mem,
     init_settings,
+    init_sparse_music_mem,
 )
+from .notes import NoteTable
+from .ports import PortNamesComb, find_port_id
 from .presets import read_preset_type
+from .ring import InMessage, MessageRing
+from .store import Fill, SequenceStore, StoreView, create_store
+from .timeline import Timeline
 
 DEBUG: bool = False
+# key, max part tick, events of a loop compiled ahead
+CompiledLoop = Tuple[LoopKey, int, List[CompiledEvent]]
 
 
 class Sequencer:
     def __init__(self, loc: str):
         self.loc = loc
-        self.clock_sync = 0.0
-        self.quant_interval: float = 0.0
-        self.step_interval: float = 0.0
-        self.part_interval: float = 0.0
+        self.clock = Clock()
+        # Set when an input follows an external MIDI clock, which then starts the loops.
+        self.clock_follower: Optional[ClockFollower] = None
+        self.clock_playing = False
+        self.loop_tick: int = 0
+        self.loop_ticks: int = 0
+        self.quant_ticks: int = 0
+        self.step_ticks: int = 0
+        self.part_ticks: int = 0
         self.tempo: int = 0
         self.detached = False
+        self.attached = False
         self.internal_config = InitConfig()
         self.settings: Dict[ValidSettings, SFunctionality] = dict()
         self.in_modes: Dict[str, MInFunctionality] = dict()
@@ -48,7 +71,11 @@ class Sequencer:
         self.valid_in_modes: List[str] = list()
         self.port_names_comb: List[Tuple[int, str, bool]] = list()
         self.mappings: MMappings = init_mappings_mem()
-        self.sequences: MMusic = MMusic("", "", "", dict())
+        self.store = self.create_store()
+        self.sequences: MMusic = MMusic("", "", "", StoreView(store=self.store))
+        self.music_bank: Optional[MusicBank] = None
+        self.pending_music: Optional[str] = None
+        self.pending_tick: Optional[int] = None
         self.tempo = self.internal_config.init_tempo
         self.reset_intervals()
 
@@ -56,15 +83,24 @@ class Sequencer:
         import json
 
         fh = open(f"{self.__class__.__name__}.seq.{self.detached}.json", "w")
-        json.dump(self.sequences.data, indent=2, sort_keys=True, fp=fh)
+        json.dump(self.store.to_dict(), indent=2, sort_keys=True, fp=fh)
         fh.close()
 
     def reset_intervals(self) -> None:
+        ppqn = self.internal_config.ppqn
+        n_quants = self.internal_config.n_quants
+        if ppqn % n_quants:
+            raise ValueError(f"PPQN {ppqn} is not divisible by {n_quants} quants!")
         if ValidSettings.TEMPO in self.settings:
             self.tempo = int(self.settings[ValidSettings.TEMPO].get_value())
-        self.quant_interval = round((1 / (self.tempo / 60)) / self.internal_config.n_quants, 4)
-        self.step_interval = self.quant_interval * self.internal_config.n_quants
-        self.part_interval = self.step_interval * self.internal_config.n_steps
+        if self.clock_follower is not None and self.clock_follower.timebase is not None:
+            self.tempo = self.clock_follower.get_tempo()
+            self.clock.set_timebase(timebase=self.clock_follower.timebase)
+        else:
+            self.clock.set_tempo(tempo=self.tempo)
+        self.quant_ticks = ppqn // n_quants
+        self.step_ticks = self.quant_ticks * n_quants
+        self.part_ticks = self.step_ticks * self.internal_config.n_steps
 
     def init_data(self) -> None:
         self.port_names_comb = self.mappings.get_port_names_comb()
@@ -80,7 +116,48 @@ class Sequencer:
             out_instruments=self.out_instruments,
             in_instruments=self.in_instruments,
         )
-        self.sequences = init_music_mem(mappings=self.mappings)
+        if self.attached:
+            # The store is filled by the detached process, a full grid here would be dropped.
+            self.set_music(music=init_sparse_music_mem(mappings=self.mappings))
+        else:
+            self.set_music(music=init_music_mem(mappings=self.mappings, store=self.store))
+
+    @staticmethod
+    def create_store() -> SequenceStore:
+        out_modes, _, _, _ = init_io_modes_and_instruments_mem()
+        return create_store(out_modes=out_modes)
+
+    def set_music(self, music: MMusic, rendered: Optional[bytes] = None) -> None:
+        # Only one process fills the shared store, the attached one (MSApp) just maps it.
+        if not self.attached and rendered is not None:
+            self.store.load_rendered(cells=rendered)
+        elif not self.attached and isinstance(music.data, dict):
+            self.store.load(data=music.data, fills=self.get_music_fills(music=music))
+        self.sequences = MMusic(
+            name=music.name,
+            mappings_name=music.mappings_name,
+            comment=music.comment,
+            data=StoreView(store=self.store),
+        )
+
+    def get_music_fills(self, music: MMusic) -> List[Fill]:
+        # Steps missing in sparse music hold the out mode defaults of the mappings.
+        return get_music_fills(mappings=self.mappings) if music.is_sparse() else list()
+
+    def render_music(self, music: MMusic) -> bytes:
+        """Renders the cells of a music preset away from the shared store (music bank)."""
+        if not isinstance(music.data, dict):
+            raise TypeError(f"Music {music.name} is not a preset!")
+        return self.store.render(data=music.data, fills=self.get_music_fills(music=music))
+
+    def get_music(self) -> MMusic:
+        return MMusic(
+            name=self.sequences.name,
+            mappings_name=self.sequences.mappings_name,
+            comment=self.sequences.comment,
+            data=self.store.to_dict(sparse=True),
+            version=MUSIC_VERSION_SPARSE,
+        )
 
     def get_current_e_pos(self) -> Tuple[int, int, int, int, str]:
         midi = int(self.settings[ValidSettings.E_MIDI_O].get_value())
@@ -106,7 +183,7 @@ class Sequencer:
         n_step_set = self.settings[ValidSettings.E_STEP].new()
         n_out_mode_set = self.settings[ValidSettings.E_O_MODE].new()
         exists_in = False
-        check_map: Dict[ValidSettings, Dict] = {
+        check_map: Dict[ValidSettings, MusicTree] = {
             ValidSettings.E_MIDI_O: self.sequences.data,
             ValidSettings.E_CHANNEL: self.sequences.data[int(c_midi)],
             ValidSettings.E_PART: self.sequences.data[int(c_midi)][int(c_channel)],
@@ -148,7 +225,7 @@ class Sequencer:
         n_step_set = self.settings[ValidSettings.V_STEP].new()
         n_out_mode_set = self.settings[ValidSettings.V_O_MODE].new()
         exists_in = False
-        check_map: Dict[ValidSettings, Dict] = {
+        check_map: Dict[ValidSettings, MusicTree] = {
             ValidSettings.V_MIDI_O: self.sequences.data,
             ValidSettings.V_CHANNEL: self.sequences.data[int(c_midi)],
             ValidSettings.V_PART: self.sequences.data[int(c_midi)][int(c_channel)],
@@ -223,7 +300,8 @@ class Sequencer:
         all_values = [current_out_mode.name] + out_mode_values
         return all_labels, all_values
 
-    def set_step(self, out_mode: MOutFunctionality) -> None:
+    def set_step(self, out_mode: Union[MOutFunctionality, MOutEvent], write: bool = True) -> None:
+        """The process where the edit originated writes it, the other one only follows."""
         positions_to_set: List[Tuple[int, int, int, int, str]] = list()
         if self.settings[ValidSettings.RECORD].get_value() == ValidButtons.ON:
             positions_to_set += self.get_record_positions(out_mode=out_mode)
@@ -231,11 +309,14 @@ class Sequencer:
             positions_to_set += self.get_copy_positions(out_mode=out_mode)
         for position_to_set in positions_to_set:
             midi, channel, part, step, valid_out_mode = position_to_set
-            self.sequences.data[midi][channel][part][step][valid_out_mode] = out_mode.get_indexes()
+            if write:
+                self.sequences.data[midi][channel][part][step][
+                    valid_out_mode
+                ] = out_mode.get_indexes()
         self.debug_sequence() if DEBUG else None
 
     def get_record_positions(
-        self, out_mode: MOutFunctionality
+        self, out_mode: Union[MOutFunctionality, MOutEvent]
     ) -> List[Tuple[int, int, int, int, str]]:
         button_label = out_mode.get_but_label()
         positions_to_record: List[Tuple[int, int, int, int, str]] = list()
@@ -250,7 +331,7 @@ class Sequencer:
         return positions_to_record
 
     def get_copy_positions(
-        self, out_mode: MOutFunctionality
+        self, out_mode: Union[MOutFunctionality, MOutEvent]
     ) -> List[Tuple[int, int, int, int, str]]:
         button_label = out_mode.get_but_label()
         positions_to_copy: List[Tuple[int, int, int, int, str]] = list()
@@ -301,10 +382,24 @@ class Sequencer:
 
     def load_music(self):
         music_name = str(self.settings[ValidSettings.MUS_NAME].get_value())
+        if self.music_bank is not None:
+            # Parsed in the background and switched at the next part boundary.
+            self.music_bank.prefetch(name=music_name)
+            self.pending_music = music_name
+            self.pending_tick = self.get_next_part_tick()
+            return
         file_path = f"{self.loc}/{MMusic.__name__}/{music_name}.yaml"
+        if self.attached:
+            # The Engine process fills the store, MSApp only needs the name and comment,
+            # so the YAML is parsed aside from the UI thread.
+            threading.Thread(target=self.read_music, args=(file_path,), daemon=True).start()
+        else:
+            self.read_music(file_path=file_path)
+
+    def read_music(self, file_path: str) -> None:
         preset = read_preset_type(file_path=file_path)
         if isinstance(preset, MMusic):
-            self.sequences = preset
+            self.set_music(music=preset)
 
     def load_map(self):
         map_name = str(self.settings[ValidSettings.MAP_NAME].get_value())
@@ -318,23 +413,10 @@ class Sequencer:
         midis: Set[int] = set()
         parts: Set[int] = set()
         midi_channel: Dict[int, Set[int]] = defaultdict(set)
-        for midi_id in self.sequences.data.keys():
-            for channel in self.sequences.data[midi_id].keys():
-                for part in self.sequences.data[midi_id][channel].keys():
-                    for step in self.sequences.data[midi_id][channel][part].keys():
-                        for valid_out_mode in self.sequences.data[midi_id][channel][part][
-                            step
-                        ].keys():
-                            self.apply_vis_element(
-                                midi_id=midi_id,
-                                channel=channel,
-                                part=part,
-                                parts=parts,
-                                step_data=self.sequences.data[midi_id][channel][part][step],
-                                valid_out_mode=valid_out_mode,
-                                midi_channel=midi_channel,
-                                midis=midis,
-                            )
+        for midi, channel, part in self.store.get_occupied():
+            midis.add(midi)
+            midi_channel[midi].add(channel)
+            parts.add(part)
         for midi in midis:
             for channel in midi_channel[midi]:
                 for part in parts:
@@ -357,28 +439,6 @@ class Sequencer:
             part_to_play[midi][channel][part] = True
         return part_to_play
 
-    def apply_vis_element(
-        self,
-        midi_id: int,
-        channel: int,
-        part: int,
-        valid_out_mode: str,
-        step_data: Dict[str, List[List[int]]],
-        midis: Set[int],
-        midi_channel: Dict[int, Set[int]],
-        parts: Set[int],
-    ) -> bool:
-        indexes = step_data[valid_out_mode]
-        out_mode = self.get_current_proto_mode(valid_out_mode=valid_out_mode)
-        has_vis_element = False
-        vis_index_1, vis_index_2 = out_mode.get_vis_ind()
-        has_note = indexes[vis_index_1][vis_index_2]
-        if has_note > 0:
-            midis.add(midi_id)
-            midi_channel[midi_id].add(channel)
-            parts.add(part)
-        return has_vis_element
-
     def find_parts_to_play(self) -> Dict[int, Dict[int, Dict[int, bool]]]:
         parts_to_play: Dict[int, Dict[int, Dict[int, bool]]] = defaultdict(
             lambda: defaultdict(dict)
@@ -391,23 +451,9 @@ class Sequencer:
         if self.settings[ValidSettings.VIEW_FUNCTION].get_value() == ValidButtons.VIEW_PLAY:
             midi, channel, part, step, valid_out_mode = self.get_current_v_pos()
             parts.add(part)
-        for midi_id in self.sequences.data.keys():
-            for channel in self.sequences.data[midi_id].keys():
-                for part in self.sequences.data[midi_id][channel].keys():
-                    for step in self.sequences.data[midi_id][channel][part].keys():
-                        for valid_out_mode in self.sequences.data[midi_id][channel][part][
-                            step
-                        ].keys():
-                            self.apply_vis_element(
-                                midi_id=midi_id,
-                                channel=channel,
-                                part=part,
-                                parts=set(),
-                                step_data=self.sequences.data[midi][channel][part][step],
-                                valid_out_mode=valid_out_mode,
-                                midi_channel=midi_channel,
-                                midis=midis,
-                            )
+        for midi, channel, _ in self.store.get_occupied():
+            midis.add(midi)
+            midi_channel[midi].add(channel)
         for midi in midis:
             for channel in midi_channel[midi]:
                 for part in parts:
@@ -431,15 +477,48 @@ class Sequencer:
             play_positions = self.find_view_to_play()
         if play_show_value == ValidButtons.OFF:
             play_positions = dict()
+        elif self.clock_follower is not None and not self.clock_playing:
+            # Armed, waiting for the external clock to start.
+            play_positions = dict()
         return play_positions
 
     def sync_clock(self) -> None:
         if (
-            self.clock_sync == 0.0
+            not self.clock.is_running()
             and self.settings[ValidSettings.PLAY_SHOW].get_value() == ValidButtons.ON
         ):
             self.reset_intervals()
-            self.clock_sync = float(math.ceil(time.time() + InitConfig().init_time))
+            self.clock.start(at_ns=self.clock.now_ns() + int(InitConfig().init_time * 10**9))
+
+    def get_next_part_tick(self) -> Optional[int]:
+        if (
+            not self.clock.is_running()
+            or self.settings[ValidSettings.PLAY_SHOW].get_value() != ValidButtons.ON
+        ):
+            return None
+        tick_now = self.clock.ns_to_tick(self.clock.now_ns())
+        n_parts = max(0, -(-(tick_now + 1 - self.loop_tick) // self.part_ticks))
+        return self.loop_tick + n_parts * self.part_ticks
+
+    def get_loop_tick(self, loop_ticks: int, tick: Optional[int] = None) -> Tuple[int, int]:
+        """
+        Returns the first tick of the loop an output should schedule and the first tick
+        that is still worth scheduling. All outputs share loop boundaries on one anchor.
+        A loop compiled ahead asks for the loop that starts at its tick instead of now.
+        """
+        tick_now = self.clock.ns_to_tick(self.clock.now_ns())
+        if tick is None:
+            tick = tick_now
+        if self.loop_tick <= tick < self.loop_tick + self.loop_ticks:
+            if tick == self.loop_tick:
+                self.loop_ticks = loop_ticks
+            return self.loop_tick, tick
+        next_tick = self.loop_tick + self.loop_ticks
+        if not next_tick <= tick < next_tick + self.step_ticks:
+            next_tick = max(0, -(-tick // self.step_ticks) * self.step_ticks)
+        self.loop_tick = next_tick
+        self.loop_ticks = loop_ticks
+        return next_tick, next_tick
 
 
 class MiDiIn:
@@ -453,13 +532,143 @@ class MiDiIn:
         self.midi_in: Optional[MidiIn] = None
         self.in_modes: List[MInFunctionality] = list()
         self.allowed_valid_in_modes: List[str] = list()
+        self.notes = NoteTable()
+        # (status, channel) -> in modes with a step that takes it
+        self.dispatch: Dict[Tuple[int, int], List[MInFunctionality]] = dict()
+        # False while the device of the port is unplugged
+        self.connected = True
+        self.ring = MessageRing(size=self.internal_config.in_ring_size)
+        self.coalescer: CCCoalescer[InMessage] = CCCoalescer(
+            window=self.internal_config.in_cc_window * 10**9
+        )
+        self.on_input: Optional[Callable[[], None]] = None
+        # input channel -> output and channel its notes are played on at once
+        # (-1 for the channel of the message)
+        self.thru: Dict[int, Tuple["MiDiOut", int]] = dict()
+        # sysex, timing, active sense dropped by rtmidi
+        self.ignore_types: Tuple[bool, bool, bool] = (True, True, True)
+        # status bytes (with channel) let in, None for all
+        self.accepted: Optional[Set[int]] = None
+        self.filtered = 0
+        self.follow_clock = False
+        self.clock_follower: Optional[ClockFollower] = None
+        # time (ns) of the last message, rtmidi deltas add up from it (-1 before the first)
+        self.last_ns = -1
 
-    def attach(self, sequencer: Sequencer) -> None:
+    def attach(self, sequencer: Sequencer, on_input: Optional[Callable[[], None]] = None) -> None:
         self.sequencer = sequencer
+        self.on_input = on_input
         self.midi_in = rtmidi.MidiIn()
+        self.reset_filter()
+        sysex, timing, active_sense = self.ignore_types
+        self.midi_in.ignore_types(sysex=sysex, timing=timing, active_sense=active_sense)
+        if self.follow_clock and sequencer.clock_follower is None:
+            sequencer.clock_follower = ClockFollower(
+                ppqn=self.internal_config.ppqn, on_transport=on_input
+            )
+            self.clock_follower = sequencer.clock_follower
+        self.midi_in.set_callback(self.receive)
         self.midi_in.open_port(self.port_id)
         self.reset_in_modes()
 
+    def receive(self, message_delta: Tuple[List[int], float], data: object = None) -> None:
+        # Runs on the rtmidi thread, the engine is only woken up to drain the ring.
+        message, delta = message_delta
+        ns = self.get_message_ns(delta=delta)
+        if message[0] >= 0xF8:
+            # Real time messages are not recorded, the clock is followed right here.
+            if self.clock_follower is not None:
+                self.clock_follower.receive(status=message[0], ns=ns)
+            return
+        if self.accepted is not None and message[0] < 0xF0 and message[0] not in self.accepted:
+            self.filtered += 1
+            return
+        if len(self.thru) and len(message) == 3 and message[0] & 0xE0 == 0x80:
+            thru = self.thru.get((message[0] & 0x0F) + 1)
+            if thru is not None:
+                midi_out, channel = thru
+                status = message[0] & 0xF0 | (channel - 1 if channel > 0 else message[0] & 0x0F)
+                midi_out.send_thru(message=(status, *message[1:]))
+        self.ring.push(message=message, ns=ns)
+        if self.on_input is not None:
+            self.on_input()
+
+    def get_message_ns(self, delta: float) -> int:
+        """
+        Adds rtmidi's delta up from the first arrival, so the callback and GIL delays
+        do not spread a burst out. A time past the arrival anchors on the arrival again.
+        """
+        arrival_ns = Clock.now_ns()
+        ns = self.last_ns + int(delta * 10**9)
+        if self.last_ns < 0 or ns > arrival_ns:
+            ns = arrival_ns
+        self.last_ns = ns
+        return ns
+
+    def reattach(self, port_names_comb: PortNamesComb) -> None:
+        """Follows the port by name, after MIDI devices were plugged in or unplugged."""
+        port_id = find_port_id(
+            port_names_comb=port_names_comb, port_name=self.port_name, is_out=False
+        )
+        if self.midi_in is None or (port_id == self.port_id and self.connected):
+            return
+        self.midi_in.close_port()
+        self.connected = port_id is not None
+        if port_id is not None:
+            self.port_id = port_id
+            self.midi_in.open_port(self.port_id)
+            self.last_ns = -1
+            # Closing the port cancelled the callback.
+            self.midi_in.set_callback(self.receive)
+
+    def reset_thru(self, midi_outs: Dict[int, "MiDiOut"]) -> None:
+        """A conn of all channels (-1) routes the channels no conn of their own routes."""
+        thru: Dict[int, Tuple[MiDiOut, int]] = dict()
+        if self.sequencer is not None:
+            for conn in self.sequencer.mappings.get_sorted():
+                if conn.is_out or conn.midi_id != self.midi_id or conn.thru_midi not in midi_outs:
+                    continue
+                channel = conn.thru_channel if conn.thru_channel > 0 else conn.channel
+                if conn.channel > 0:
+                    thru[conn.channel] = (midi_outs[conn.thru_midi], channel)
+                    continue
+                for in_channel in range(1, self.internal_config.n_channels + 1):
+                    thru.setdefault(in_channel, (midi_outs[conn.thru_midi], channel))
+        self.thru = thru
+
+    def reset_filter(self) -> None:
+        """A message type or status is let in if any input conn of this midi lets it in."""
+        ignore_types = [True, True, True]
+        follow_clock = False
+        all_statuses = range(0x80, 0xF0, 0x10)
+        accepted: Set[int] = set()
+        if self.sequencer is not None:
+            for conn in self.sequencer.mappings.get_sorted():
+                if conn.is_out or conn.midi_id != self.midi_id:
+                    continue
+                ignore_types[0] &= conn.ignore_sysex
+                ignore_types[1] &= conn.ignore_timing and not conn.follow_clock
+                follow_clock |= conn.follow_clock
+                ignore_types[2] &= conn.ignore_active_sense
+                channels = range(1, self.internal_config.n_channels + 1)
+                if conn.filter_channel and conn.channel > 0:
+                    channels = range(conn.channel, conn.channel + 1)
+                statuses = {status & 0xF0 for status in conn.statuses} or set(all_statuses)
+                accepted.update(
+                    status | (channel - 1) for status in statuses for channel in channels
+                )
+        self.ignore_types = (ignore_types[0], ignore_types[1], ignore_types[2])
+        self.follow_clock = follow_clock
+        everything = len(accepted) == len(all_statuses) * self.internal_config.n_channels
+        self.accepted = None if everything or not len(accepted) else accepted
+
+    def get_counts(self) -> Dict[str, int]:
+        return {
+            "filtered": self.filtered,
+            "ring_dropped": self.ring.dropped,
+            "cc_dropped": self.coalescer.dropped,
+        }
+
     def reset_in_modes(self):
         if self.sequencer is not None:
             allowed_instruments: List[str] = list()
@@ -475,24 +684,35 @@ class MiDiIn:
                             self.in_modes.append(
                                 self.sequencer.in_modes[in_mode.name].new(lock=False)
                             )
+            self.reset_dispatch()
+
+    def reset_dispatch(self) -> None:
+        """Maps every status and channel to the in modes that have a step for it."""
+        self.dispatch = dict()
+        for status in range(0x80, 0x100, 0x10):
+            for channel in range(1, self.internal_config.n_channels + 1):
+                in_modes: List[MInFunctionality] = list()
+                for in_mode in self.in_modes:
+                    cache = in_mode.get_cache()
+                    if any(
+                        cache.accepts(exe=exe, status=status, channel=channel)
+                        for exe in range(len(in_mode.in_rules))
+                    ):
+                        in_modes.append(in_mode)
+                if len(in_modes):
+                    self.dispatch[(status, channel)] = in_modes
 
     def run_message_bus(
         self, out_midi: int, out_channel: int
     ) -> List[Tuple[int, int, MOutFunctionality]]:
         midi_ch_out_modes: List[Tuple[int, int, MOutFunctionality]] = list()
-        if self.sequencer is not None and self.midi_in is not None:
+        if self.sequencer is not None and (len(self.ring) or len(self.coalescer.held)):
             messages: List[List[int]] = list()
             ts: List[float] = list()
-            while True:
-                message_t = self.midi_in.get_message()
-                if message_t is None:
-                    break
-                else:
-                    message, t = message_t
-                    messages.append(message)
-                    ts.append(t)
-            if len(ts):
-                ts[0] = 0.0
+            drained = self.ring.drain()
+            for message, ns in self.coalescer.coalesce_in(messages=drained, now_ns=Clock.now_ns()):
+                messages.append(message)
+                ts.append(ns / 10**9)
             for midi, channel, out_mode in self.translate_ins_to_outs(messages=messages, ts=ts):
                 if midi < 0:
                     midi = out_midi
@@ -501,44 +721,98 @@ class MiDiIn:
                 midi_ch_out_modes.append((midi, channel, out_mode))
         return midi_ch_out_modes
 
+    def get_next_deadline(self) -> Optional[int]:
+        """Right after the window of a held control change ends."""
+        window_end = self.coalescer.get_window_end()
+        return None if window_end is None else int(window_end) + 1
+
     def translate_ins_to_outs(
         self,
         messages: List[List[int]],
         ts: List[float],
     ) -> List[Tuple[int, int, MOutFunctionality]]:
+        """
+        Translates a batch in arrival order, in one pass. In modes and held notes keep
+        their partial state for the batches to come.
+        """
+        if self.sequencer is None:
+            raise ValueError("Sequencer is not ready!")
         midi_ch_out_modes: List[Tuple[int, int, MOutFunctionality]] = list()
-        while len(messages):
-            midi_ch_out_mode = self.translate_ins_to_out(messages=messages, ts=ts)
+        for message, t in zip(messages, ts):
+            self.fix_command_length_channel(message=message)
+            midi_ch_out_mode = self.translate_in_to_out(message=message, t=t)
             if midi_ch_out_mode is not None:
                 midi_ch_out_modes.append(midi_ch_out_mode)
         return midi_ch_out_modes
 
-    def translate_ins_to_out(
-        self, messages: List[List[int]], ts: List[float]
+    def translate_in_to_out(
+        self, message: List[int], t: float
     ) -> Optional[Tuple[int, int, MOutFunctionality]]:
-        if self.sequencer is not None:
-            t1 = time.time()
-            while len(messages):
-                message = messages.pop()
-                self.fix_command_length_channel(message=message)
-                t2 = ts.pop()
-                for in_mode in self.in_modes:
-                    in_mode.set_with_message_and_time(message=message, t=(t1, t2))
-                    if not in_mode.has_next():
-                        return in_mode.convert_with_out_modes_and_tempo(
-                            out_modes=self.sequencer.out_modes,
-                            tempo=self.sequencer.tempo,
-                            n_quants=self.internal_config.n_quants,
-                        )
+        if self.sequencer is None:
             return None
-        else:
-            raise ValueError("Sequencer is not ready!")
+        status, channel = message[0], message[4]
+        for in_mode in self.dispatch.get((status, channel), list()):
+            if in_mode.get_cache().note_pair:
+                taken, converted = self.translate_note(in_mode=in_mode, message=message, t=t)
+                if taken:
+                    return converted
+                continue
+            if not in_mode.accepts(status=status, channel=channel):
+                continue
+            in_mode.set_with_message_and_time(message=message, t=(t, 0.0))
+            if not in_mode.has_next():
+                return in_mode.convert_with_out_modes_and_tempo(
+                    out_modes=self.sequencer.out_modes,
+                    tempo=self.sequencer.tempo,
+                    n_quants=self.internal_config.n_quants,
+                )
+        return None
+
+    def translate_note(
+        self, in_mode: MInFunctionality, message: List[int], t: float
+    ) -> Tuple[bool, Optional[Tuple[int, int, MOutFunctionality]]]:
+        """Returns whether the message was taken, and the out mode once a note off ends a note."""
+        cache = in_mode.get_cache()
+        status, key, channel = message[0], message[1], message[4]
+        for exe in range(2):
+            if not cache.accepts(exe=exe, status=status, channel=channel):
+                continue
+            note = self.notes.get(channel=channel, key=key) if exe else None
+            if exe and (note is None or note[2] is not in_mode):
+                continue
+            applied = cache.apply(exe=exe, message=message, previous=note[1] if note else None)
+            if applied == 0:
+                continue
+            if applied < 0:
+                in_mode.out_rules.append(in_mode.out_rules.pop(0))
+            if note is None:
+                self.notes.note_on(channel=channel, key=key, t=t, message=message, in_mode=in_mode)
+                return True, None
+            self.notes.note_off(channel=channel, key=key)
+            return True, self.convert_note(in_mode=in_mode, data=[note[1], message], t=t - note[0])
+        return False, None
+
+    def convert_note(
+        self, in_mode: MInFunctionality, data: List[List[int]], t: float
+    ) -> Optional[Tuple[int, int, MOutFunctionality]]:
+        if self.sequencer is None:
+            return None
+        return in_mode.convert_data_with_out_modes_and_tempo(
+            data=data,
+            duration=t,
+            out_modes=self.sequencer.out_modes,
+            tempo=self.sequencer.tempo,
+            n_quants=self.internal_config.n_quants,
+        )
 
     @staticmethod
     def fix_command_length_channel(message: List[int]) -> None:
         command = message[0]
         channel = (command & 0x0F) + 1
         command = command & 0xF0
+        if command == 0x90 and len(message) > 2 and message[2] == 0:
+            # A note on without velocity is a note off (running status).
+            command = 0x80
         message[0] = command
         message.append(0)
         message.append(channel)
@@ -554,21 +828,36 @@ class MiDiOut:
         self.internal_config = InitConfig()
         self.sequencer: Optional[Sequencer] = None
         self.allowed_valid_out_modes: List[str] = list()
-        self.unscheduled_step: List[Tuple[int, MOutFunctionality]] = list()
-        self.scheduled_steps: Dict[float, Dict[int, List[MOutFunctionality]]] = dict()
-        self.max_part_tick = 0.0
+        self.unscheduled_step: List[Tuple[int, MOutEvent]] = list()
+        self.scheduled_steps = Timeline()
+        self.compiler: Optional[PartCompiler] = None
+        self.compiled: Deque[CompiledEvent] = deque()
+        self.next_loop: Optional[CompiledLoop] = None
+        # True while the parts of the next loop are compiled, one per pass
+        self.compiling = False
+        self.loop_tick = 0
+        self.max_part_tick = 0
+        # False while the device of the port is unplugged
+        self.connected = True
+        # Sends come from the engine and from input threads (thru).
+        self.lock = threading.Lock()
+        self.coalescer: CCCoalescer[CompiledEvent] = CCCoalescer(
+            window=self.internal_config.out_cc_ticks
+        )
+        # (channel, key) of the notes played thru and not released yet
+        self.thru_notes: Set[Tuple[int, int]] = set()
 
     def debug_midi(
         self,
-        time_now: float,
+        time_ns: int,
         midi_id: int,
         channel: int,
-        step_tick: float,
-        offset_time: float,
-        next_tick: float,
+        step_tick: int,
+        late_ns: int,
+        next_tick: int,
         valid_out_mode: str,
         exe: int,
-        message: List[int],
+        message: Tuple[int, ...],
     ) -> None:
         if self.sequencer is not None:
             fh = open(
@@ -577,7 +866,7 @@ class MiDiOut:
                 "a",
             )
             fh.write(
-                f"{offset_time} {round(time_now,3)} {step_tick} "
+                f"{late_ns} {time_ns} {step_tick} "
                 f"{next_tick} {midi_id} {channel} {valid_out_mode} {exe} {message}\n"
             )
             fh.close()
@@ -585,10 +874,60 @@ class MiDiOut:
     def attach(self, sequencer: Sequencer) -> None:
         self.sequencer = sequencer
         self.unscheduled_step = list()
-        self.scheduled_steps = defaultdict(lambda: defaultdict(list))
+        self.scheduled_steps = Timeline()
+        self.compiled = deque()
+        self.next_loop = None
+        self.compiling = False
         self.midi_out = rtmidi.MidiOut()
         self.midi_out.open_port(self.port_id)
         self.reset_out_modes()
+        self.compiler = PartCompiler(
+            port_id=self.port_id,
+            midi_id=self.midi_id,
+            store=sequencer.store,
+            out_modes=sequencer.out_modes,
+            allowed_valid_out_modes=self.allowed_valid_out_modes,
+            quant_ticks=sequencer.quant_ticks,
+            step_ticks=sequencer.step_ticks,
+        )
+
+    def reattach(self, port_names_comb: PortNamesComb) -> None:
+        """Follows the port by name, after MIDI devices were plugged in or unplugged."""
+        port_id = find_port_id(
+            port_names_comb=port_names_comb, port_name=self.port_name, is_out=True
+        )
+        if self.midi_out is None or (port_id == self.port_id and self.connected):
+            return
+        self.release_thru()
+        with self.lock:
+            self.midi_out.close_port()
+            self.connected = port_id is not None
+            if port_id is not None:
+                self.port_id = port_id
+        self.open_port()
+
+    def open_port(self) -> None:
+        if self.midi_out is not None and self.connected and not self.midi_out.is_port_open():
+            with self.lock:
+                self.midi_out.open_port(self.port_id)
+
+    def send_thru(self, message: Tuple[int, ...]) -> None:
+        """Plays an input note at once, from the rtmidi input thread."""
+        with self.lock:
+            if self.midi_out is not None and self.connected and self.midi_out.is_port_open():
+                self.midi_out.send_message(message)
+                if message[0] & 0xF0 == 0x90 and message[2] > 0:
+                    self.thru_notes.add((message[0] & 0x0F, message[1]))
+                else:
+                    self.thru_notes.discard((message[0] & 0x0F, message[1]))
+
+    def release_thru(self) -> None:
+        """Sends all notes off on the channels with thru notes still sounding."""
+        with self.lock:
+            if self.midi_out is not None and self.connected and self.midi_out.is_port_open():
+                for channel in sorted({channel for channel, _ in self.thru_notes}):
+                    self.midi_out.send_message([0xB0 | channel, 0x7B, 0])
+            self.thru_notes.clear()
 
     def reset_out_modes(self):
         if self.sequencer is not None:
@@ -605,170 +944,262 @@ class MiDiOut:
     # - - SCHEDULE - - #
 
     def add_parts_to_step_schedule(self) -> None:
-        if self.sequencer is not None:
-            play_positions = self.sequencer.get_play_positions()
-            time_now = time.time()
-            if (
-                len(play_positions)
-                and len(self.scheduled_steps) == 0
-                and time_now >= self.max_part_tick + self.sequencer.clock_sync
+        if self.sequencer is not None and self.compiler is not None:
+            clock = self.sequencer.clock
+            time_ns = clock.now_ns()
+            if time_ns >= clock.tick_to_ns(self.max_part_tick):
+                self.start_loop()
+            elif self.next_loop is None and time_ns >= clock.tick_to_ns(
+                self.max_part_tick - self.sequencer.part_ticks
             ):
-                self.sequencer.clock_sync = 0.0
+                # One part ahead, so the next loop is ready at the loop boundary.
+                self.next_loop = self.compile_next_loop()
+
+    def compile_next_loop(self) -> Optional[CompiledLoop]:
+        """
+        Compiles one changed part per pass, so no pass of the engine compiles a whole loop,
+        and the next loop from the compiled parts once none is left.
+        """
+        if self.sequencer is not None and self.compiler is not None:
+            play_positions = self.sequencer.get_play_positions()
+            self.compiling = self.compiler.compile_stale_part(play_positions=play_positions)
+            if not self.compiling:
+                return self.compile_loop(tick=self.max_part_tick)
+        return None
+
+    def compile_loop(self, tick: Optional[int] = None) -> Optional[CompiledLoop]:
+        if self.sequencer is not None and self.compiler is not None:
+            play_positions = self.sequencer.get_play_positions()
+            if len(play_positions):
                 self.sequencer.sync_clock()
-                self.max_part_tick = 0.0
-                for midi in play_positions.keys():
-                    for channel in play_positions[midi].keys():
-                        for part in play_positions[midi][channel].keys():
-                            part_tick = self.sequencer.part_interval * (part - 1)
-                            self.add_steps_to_step_schedule(
-                                midi=midi, channel=channel, part=part, part_tick=part_tick
-                            )
-                            last_part_tick = self.sequencer.part_interval * (part + 0)
-                            if last_part_tick > self.max_part_tick:
-                                self.max_part_tick = last_part_tick
+                loop_ticks = self.get_loop_ticks(play_positions=play_positions)
+                loop_tick, from_tick = self.sequencer.get_loop_tick(
+                    loop_ticks=loop_ticks, tick=tick
+                )
+                key, events = self.compiler.compile_loop(
+                    play_positions=play_positions,
+                    loop_tick=loop_tick,
+                    from_tick=from_tick,
+                    part_ticks=self.sequencer.part_ticks,
+                )
+                return key, loop_tick + loop_ticks, events
+        return None
 
-    def add_steps_to_step_schedule(
-        self, midi: int, channel: int, part: int, part_tick: float
-    ) -> None:
-        if midi == self.midi_id and self.sequencer is not None:
-            for step in self.sequencer.sequences.data[midi][channel][part].keys():
-                step_tick = part_tick + (step - 1) * self.sequencer.step_interval
-                for valid_out_mode in self.sequencer.sequences.data[midi][channel][part][
-                    step
-                ].keys():
-                    indexes = self.sequencer.sequences.data[midi][channel][part][step][
-                        valid_out_mode
-                    ]
-                    out_mode = self.sequencer.get_current_new_out_mode(
-                        valid_out_mode=valid_out_mode
-                    )
-                    out_mode.set_indexes(indexes=indexes)
-                    button_label = out_mode.get_but_label()
-                    if out_mode.get_single_value_by_lab(exe=0, lab=button_label) != ValidButtons.NA:
-                        self.scheduled_steps[step_tick][channel].append(out_mode)
+    def start_loop(self) -> None:
+        next_loop, self.next_loop = self.next_loop, None
+        self.compiling = False
+        if self.sequencer is not None and self.compiler is not None and next_loop is not None:
+            # The music or the play positions could have changed since the loop was compiled.
+            key, max_part_tick, events = next_loop
+            loop_tick, from_tick, _ = key
+            play_positions = self.sequencer.get_play_positions()
+            if self.get_loop_ticks(play_positions=play_positions) != max_part_tick - loop_tick:
+                next_loop = self.compile_loop(tick=loop_tick)
+            elif self.compiler.get_loop_key(play_positions, loop_tick, from_tick) != key:
+                next_loop = self.compile_loop(tick=loop_tick)
+        else:
+            next_loop = self.compile_loop()
+        if next_loop is not None:
+            key, self.max_part_tick, events = next_loop
+            self.loop_tick = key[0]
+            self.compiled = deque(heapq.merge(self.compiled, events, key=itemgetter(0)))
+
+    def reschedule(self, from_tick: int) -> None:
+        """Compiles the rest of the current loop again, after the music was switched."""
+        if self.sequencer is not None and self.compiler is not None:
+            kept = cut_events(events=self.compiled, from_tick=from_tick)
+            _, events = self.compiler.compile_loop(
+                play_positions=self.sequencer.get_play_positions(),
+                loop_tick=self.loop_tick,
+                from_tick=from_tick,
+                part_ticks=self.sequencer.part_ticks,
+                until_tick=self.max_part_tick,
+            )
+            self.compiled = deque(heapq.merge(kept, events, key=itemgetter(0)))
+            self.next_loop = None
+            self.compiling = False
+
+    def stop_loop(self, restart: bool) -> None:
+        """
+        Drops what was compiled from now on, after the external clock stopped or
+        (re)started. Note offs of sounding notes still play, at once on a restart,
+        as the tick numbering jumps to the song position. Thru notes end on a stop.
+        """
+        if self.sequencer is not None:
+            time_ns = self.sequencer.clock.now_ns()
+            kept = cut_events(
+                events=self.compiled, from_tick=self.sequencer.clock.ns_to_tick(time_ns)
+            )
+            self.compiled = deque(kept)
+            while restart and len(self.compiled):
+                self.play_compiled(time_ns=time_ns, event=self.compiled.popleft())
+            self.next_loop = None
+            self.compiling = False
+            self.max_part_tick = 0
+        if not restart:
+            self.release_thru()
+
+    def get_loop_ticks(self, play_positions: Dict[int, Dict[int, Dict[int, bool]]]) -> int:
+        loop_ticks = 0
+        if self.sequencer is not None:
+            for midi in play_positions.keys():
+                for channel in play_positions[midi].keys():
+                    for part in play_positions[midi][channel].keys():
+                        last_part_tick = self.sequencer.part_ticks * part
+                        if last_part_tick > loop_ticks:
+                            loop_ticks = last_part_tick
+        return loop_ticks
 
     def play_later_and_schedule(self) -> None:
         self.add_parts_to_step_schedule()
         if self.sequencer is not None:
-            offset_time = self.sequencer.clock_sync
-            old_schedule: Dict[float, Dict[int, List[int]]] = defaultdict(lambda: defaultdict(list))
-            new_schedule: Dict[float, Dict[int, List[MOutFunctionality]]] = defaultdict(
-                lambda: defaultdict(list)
+            self.open_port()
+            clock = self.sequencer.clock
+            time_ns = clock.now_ns()
+            tick = clock.ns_to_tick(time_ns)
+            due: List[CompiledEvent] = list()
+            while len(self.compiled) and self.compiled[0][0] <= tick:
+                due.append(self.compiled.popleft())
+            for compiled_event in self.coalescer.coalesce_compiled(events=due, tick=tick):
+                self.play_compiled(time_ns=time_ns, event=compiled_event)
+            for step_tick, channel, event in self.scheduled_steps.pop_due(tick=tick):
+                self.play_now(
+                    step_tick=step_tick,
+                    time_ns=time_ns,
+                    late_ns=clock.record_lateness(tick=step_tick, ns=time_ns),
+                    channel=channel,
+                    event=event,
+                )
+
+    def play_compiled(self, time_ns: int, event: CompiledEvent) -> None:
+        if self.sequencer is not None and self.midi_out is not None and self.connected:
+            step_tick, _, status, data_1, data_2 = event
+            late_ns = self.sequencer.clock.record_lateness(tick=step_tick, ns=time_ns)
+            with self.lock:
+                self.midi_out.send_message((status, data_1, data_2))
+            (
+                self.debug_midi(
+                    midi_id=self.midi_id,
+                    channel=(status & 0xF) + 1,
+                    time_ns=time_ns,
+                    step_tick=step_tick,
+                    next_tick=0,
+                    late_ns=late_ns,
+                    exe=-1,
+                    valid_out_mode="",
+                    message=(status, data_1, data_2),
+                )
+                if DEBUG
+                else None
             )
-            if self.midi_out is not None and not self.midi_out.is_port_open():
-                self.midi_out.open_port(self.port_id)
-            for step_tick in sorted(self.scheduled_steps.keys()):
-                time_now = time.time()
-                if time_now >= (step_tick + offset_time):
-                    for channel in self.scheduled_steps[step_tick].keys():
-                        self.play_now(
-                            step_tick=step_tick,
-                            time_now=time_now,
-                            offset_time=offset_time,
-                            channel=channel,
-                            out_modes=self.scheduled_steps[step_tick][channel],
-                            old_schedule=old_schedule,
-                            new_schedule=new_schedule,
-                        )
-                    break
-            self.update_step_schedule(old_schedule=old_schedule, new_schedule=new_schedule)
 
     def play_now_and_schedule(self) -> None:
-        time_now = time.time()
-        old_schedule: Dict[float, Dict[int, List[int]]] = defaultdict(lambda: defaultdict(list))
-        new_schedule: Dict[float, Dict[int, List[MOutFunctionality]]] = defaultdict(
-            lambda: defaultdict(list)
-        )
-        if self.midi_out is not None and not self.midi_out.is_port_open():
-            self.midi_out.open_port(self.port_id)
+        self.open_port()
         if self.sequencer is not None:
             self.sequencer.reset_intervals()
+            clock = self.sequencer.clock
+            time_ns = clock.now_ns()
+            if len(self.unscheduled_step) and not clock.is_running():
+                clock.start(at_ns=time_ns)
             while len(self.unscheduled_step):
-                channel, out_mode = self.unscheduled_step.pop()
+                channel, event = self.unscheduled_step.pop()
                 self.play_now(
-                    step_tick=0,
-                    time_now=time_now,
+                    step_tick=clock.ns_to_tick(time_ns),
+                    time_ns=time_ns,
+                    late_ns=0,
                     channel=channel,
-                    old_schedule=old_schedule,
-                    new_schedule=new_schedule,
-                    out_modes=[out_mode],
-                    offset_time=0.0,
+                    event=event,
                 )
-                self.sequencer.clock_sync = time_now
-            self.update_step_schedule(old_schedule=old_schedule, new_schedule=new_schedule)
 
     def play_now(
         self,
-        step_tick: float,
-        time_now: float,
-        offset_time: float,
+        step_tick: int,
+        time_ns: int,
+        late_ns: int,
         channel: int,
-        out_modes: List["MOutFunctionality"],
-        old_schedule: Dict[float, Dict[int, List[int]]],
-        new_schedule: Dict[float, Dict[int, List[MOutFunctionality]]],
+        event: MOutEvent,
     ) -> None:
-        for i, out_mode in enumerate(out_modes):
-            if out_mode.name in self.allowed_valid_out_modes:
-                message: List[int] = out_mode.get_as_message()
-                if len(message) >= 3 and min(message) >= 0:
-                    self.channel_message(
-                        midi_out=self.midi_out,
-                        command=message[0],
-                        ch=channel,
-                        data=message[1:3],
+        if event.name in self.allowed_valid_out_modes:
+            message = event.get_as_message()
+            if (
+                len(message) >= 3
+                and min(message) >= 0
+                and self.midi_out is not None
+                and self.connected
+            ):
+                with self.lock:
+                    self.midi_out.send_message(event.get_as_bytes(message=message, ch=channel))
+                (
+                    self.debug_midi(
+                        midi_id=self.midi_id,
+                        channel=channel,
+                        time_ns=time_ns,
+                        step_tick=step_tick,
+                        next_tick=0,
+                        late_ns=late_ns,
+                        exe=event.get_exe(),
+                        valid_out_mode=event.name,
+                        message=message,
                     )
+                    if DEBUG
+                    else None
+                )
+            if len(message) > 3 and min(message) >= 0 and event.has_next():
+                if self.sequencer is not None:
+                    next_tick = step_tick + message[3] * self.sequencer.quant_ticks
+                    self.scheduled_steps.push(tick=next_tick, channel=channel, event=event)
                     (
                         self.debug_midi(
                             midi_id=self.midi_id,
-                            channel=channel,
-                            time_now=time_now,
+                            channel=-channel,
+                            time_ns=time_ns,
                             step_tick=step_tick,
-                            next_tick=0.0,
-                            offset_time=offset_time,
-                            exe=out_mode.get_exe(),
-                            valid_out_mode=out_mode.name,
+                            next_tick=next_tick,
+                            late_ns=late_ns,
+                            exe=event.get_exe(),
+                            valid_out_mode=event.name,
                             message=message,
                         )
                         if DEBUG
                         else None
                     )
-                if len(message) > 3 and min(message) >= 0 and out_mode.has_next():
-                    if self.sequencer is not None:
-                        next_tick = step_tick + float(message[3] * self.sequencer.quant_interval)
-                        new_schedule[next_tick][channel].append(out_mode.new(lock=False))
-                        (
-                            self.debug_midi(
-                                midi_id=self.midi_id,
-                                channel=-channel,
-                                time_now=time_now,
-                                step_tick=step_tick,
-                                next_tick=next_tick,
-                                offset_time=offset_time,
-                                exe=out_mode.get_exe(),
-                                valid_out_mode=out_mode.name,
-                                message=message,
-                            )
-                            if DEBUG
-                            else None
-                        )
-                old_schedule[step_tick][channel].append(i)
 
-    def update_step_schedule(
-        self,
-        old_schedule: Dict[float, Dict[int, List[int]]],
-        new_schedule: Dict[float, Dict[int, List[MOutFunctionality]]],
-    ) -> None:
-        if len(old_schedule) or len(new_schedule):
-            for step_tick in self.scheduled_steps.keys():
-                for channel in self.scheduled_steps[step_tick].keys():
-                    for i, out_mode in enumerate(self.scheduled_steps[step_tick][channel]):
-                        if (
-                            step_tick not in old_schedule
-                            and channel not in old_schedule[step_tick]
-                            and i not in old_schedule[step_tick][channel]
-                        ):
-                            new_schedule[step_tick][channel].append(out_mode)
-            self.scheduled_steps = new_schedule
+    def peek(self) -> Optional[int]:
+        next_tick = self.scheduled_steps.peek()
+        if len(self.compiled) and (next_tick is None or self.compiled[0][0] < next_tick):
+            next_tick = self.compiled[0][0]
+        # A held control change passes at the end of its window.
+        window_end = self.coalescer.get_window_end()
+        if window_end is not None and (next_tick is None or window_end < next_tick):
+            next_tick = int(window_end)
+        return next_tick
+
+    def get_next_deadline(self) -> Optional[int]:
+        if self.sequencer is None:
+            return None
+        clock = self.sequencer.clock
+        if len(self.unscheduled_step) or self.compiling:
+            return clock.now_ns()
+        next_tick = self.peek()
+        if self.sequencer.settings[ValidSettings.PLAY_SHOW].get_value() == ValidButtons.ON:
+            if (
+                self.next_loop is not None
+                and clock.tick_to_ns(self.max_part_tick) <= clock.now_ns()
+            ):
+                # The loop compiled ahead is due already.
+                return clock.now_ns()
+            loop_tick = self.max_part_tick
+            if self.next_loop is None:
+                loop_tick -= self.sequencer.part_ticks
+            if clock.tick_to_ns(loop_tick) <= clock.now_ns():
+                loop_tick = self.max_part_tick
+            if clock.tick_to_ns(loop_tick) > clock.now_ns() and (
+                next_tick is None or loop_tick < next_tick
+            ):
+                next_tick = loop_tick
+        if next_tick is not None:
+            return clock.tick_to_ns(next_tick)
+        return None
 
     # - - BOTH - - #
 
@@ -776,10 +1207,3 @@ class MiDiOut:
         if self.sequencer is not None:
             self.play_now_and_schedule()
             self.play_later_and_schedule()
-
-    @staticmethod
-    def channel_message(midi_out: MidiOut, command: int, data: List[int], ch=None):
-        """Send a MIDI channel out_mode message."""
-        command = (command & 0xF0) | ((ch if ch else 1) - 1 & 0xF)
-        msg = [command] + [value & 0x7F for value in data]
-        midi_out.send_message(msg)
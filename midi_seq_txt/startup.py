@@ -0,0 +1,47 @@
+import importlib
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Tuple
+
+# Imported in this order, so each phase only holds what the previous ones did not import.
+STARTUP_IMPORTS: List[Tuple[str, str]] = [
+    ("import presets (yaml, cattrs)", "midi_seq_txt.presets"),
+    ("import store (numpy)", "midi_seq_txt.store"),
+    ("import engine (rtmidi)", "midi_seq_txt.engine"),
+]
+# Only the app and presets commands build the UI.
+APP_IMPORTS: List[Tuple[str, str]] = [("import app (textual)", "midi_seq_txt.app")]
+
+
+class StartupProfile:
+    """
+    This class records the wall time of the import and init phases of startup,
+    in the order they ran.
+    """
+
+    def __init__(self):
+        self.phases: List[Tuple[str, float]] = list()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    def import_modules(self, imports: List[Tuple[str, str]]) -> None:
+        for name, module in imports:
+            with self.phase(name=name):
+                importlib.import_module(module)
+
+    def report(self) -> str:
+        lines: List[str] = list()
+        for name, seconds in self.phases:
+            lines.append(f"{name:<32} {1000 * seconds:9.3f} ms")
+        total = sum(seconds for _, seconds in self.phases)
+        lines.append(f"{'total':<32} {1000 * total:9.3f} ms")
+        return "\n".join(lines)
+
+
+STARTUP_PROFILE = StartupProfile()
@@ -0,0 +1,498 @@
+import atexit
+import time
+from copy import copy
+from multiprocessing import Lock, shared_memory
+from types import ModuleType
+from typing import Dict, List, Optional, Sequence, Tuple, Type, Union, cast
+
+from .configs import InitConfig
+from .functionalities import MOutFunctionality, MusicDict
+
+np: Optional[ModuleType]
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# midi, channel, part, step, out mode
+Position = Tuple[int, int, int, int, str]
+Step = Tuple[int, int, int, int]
+# any first levels of a position
+Prefix = Tuple[Union[int, str], ...]
+KeyTree = Dict[int, Dict[int, Dict[int, Dict[int, List[str]]]]]
+# midi, channel, out mode and the indexes it holds in every part and step
+Fill = Tuple[int, int, str, List[List[int]]]
+
+# generation (odd while a write is in progress), layout (bumped when cells appear or vanish)
+HEADER_SIZE: int = 16
+Slab = Tuple[int, int, int]
+
+
+class SequenceStore:
+    """
+    This class keeps the music grid (midi x channel x part x step x mode x exe x field)
+    in a single shared memory block mapped by MSApp and the Engine process.
+    Writers take a lock and bump a generation counter (seqlock), so readers never see
+    half written steps and the data is never copied between processes.
+    Writers also keep the number of notes and a version per (midi, channel, part) slab.
+    """
+
+    def __init__(
+        self,
+        valid_out_modes: List[str],
+        shapes: List[Tuple[int, int]],
+        vis: List[Tuple[int, int]],
+        defaults: List[List[List[int]]],
+    ):
+        config = InitConfig()
+        self.valid_out_modes = valid_out_modes
+        self.mode_ids: Dict[str, int] = {name: i for i, name in enumerate(valid_out_modes)}
+        self.shapes = shapes
+        self.vis = vis
+        self.defaults = defaults
+        self.dims: Tuple[int, ...] = (
+            config.max_midis,
+            config.n_channels,
+            config.n_parts,
+            config.n_steps,
+            len(valid_out_modes),
+        )
+        self.n_exes = max([rows for rows, _ in shapes], default=1)
+        self.n_fields = max([cols for _, cols in shapes], default=1)
+        self.n_cells = 1
+        for dim in self.dims:
+            self.n_cells *= dim
+        self.cell_size = self.n_exes * self.n_fields
+        self.slab_size = self.dims[3] * self.dims[4]
+        self.n_slabs = self.n_cells // self.slab_size
+        self.occupancy_offset = HEADER_SIZE + 4 * self.n_slabs
+        self.presence_offset = self.occupancy_offset + 4 * self.n_slabs
+        self.values_offset = self.presence_offset + self.n_cells + self.n_cells % 2
+        self.size = self.values_offset + 2 * self.n_cells * self.cell_size
+        self.shm = shared_memory.SharedMemory(create=True, size=self.size)
+        self.lock = Lock()
+        self.read_timeout = int(config.store_read_timeout * 10**9)
+        self.layout: int = -1
+        self.tree: KeyTree = dict()
+        self.views: List[str] = [
+            "header",
+            "versions",
+            "cells_buf",
+            "occupancy",
+            "presence",
+            "values",
+        ]
+        self.map()
+        atexit.register(self.close)
+
+    def __getstate__(self) -> Dict[str, object]:
+        state = self.__dict__.copy()
+        for view in self.views:
+            del state[view]
+        return state
+
+    def __setstate__(self, state: Dict[str, object]) -> None:
+        self.__dict__.update(state)
+        self.map()
+
+    def get_buf(self) -> memoryview:
+        buf = self.shm.buf
+        assert buf is not None
+        return buf
+
+    def map(self, buf: Optional[memoryview] = None) -> None:
+        """Maps the views on the shared block, or on a private one to render music in."""
+        if buf is None:
+            buf = self.get_buf()
+        self.header = buf[:HEADER_SIZE].cast("q")
+        self.versions = buf[HEADER_SIZE : self.occupancy_offset].cast("i")
+        # occupancy, presence and values, everything a load replaces
+        self.cells_buf = buf[self.occupancy_offset : self.size]
+        self.occupancy = buf[self.occupancy_offset : self.presence_offset].cast("i")
+        self.presence = buf[self.presence_offset : self.presence_offset + self.n_cells]
+        self.values = buf[self.values_offset :].cast("h")
+
+    def unmap(self) -> None:
+        for view in [
+            self.header,
+            self.versions,
+            self.cells_buf,
+            self.occupancy,
+            self.presence,
+            self.values,
+        ]:
+            view.release()
+
+    def close(self) -> None:
+        self.unmap()
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+    def get_cell(self, position: Position) -> Optional[int]:
+        midi, channel, part, step, valid_out_mode = position
+        mode_id = self.mode_ids.get(valid_out_mode, -1)
+        coords = (midi, channel - 1, part - 1, step - 1, mode_id)
+        cell = 0
+        for coord, dim in zip(coords, self.dims):
+            if not 0 <= coord < dim:
+                return None
+            cell = cell * dim + coord
+        return cell
+
+    def get_position(self, cell: int) -> Position:
+        coords: List[int] = list()
+        for dim in reversed(self.dims):
+            cell, coord = divmod(cell, dim)
+            coords.append(coord)
+        mode_id, step, part, channel, midi = coords
+        return midi, channel + 1, part + 1, step + 1, self.valid_out_modes[mode_id]
+
+    def get_slab(self, slab: int) -> Slab:
+        slab, part = divmod(slab, self.dims[2])
+        midi, channel = divmod(slab, self.dims[1])
+        return midi, channel + 1, part + 1
+
+    def get_slab_id(self, slab: Slab) -> Optional[int]:
+        cell = self.get_cell(position=slab + (1, self.valid_out_modes[0]))
+        if cell is None:
+            return None
+        return cell // self.slab_size
+
+    def get_read_deadline(self) -> int:
+        return time.monotonic_ns() + self.read_timeout
+
+    def begin_read(self, deadline: int) -> int:
+        """Waits for the end of a write in progress and returns the generation to check."""
+        while True:
+            generation = self.header[0]
+            if not generation % 2:
+                return generation
+            self.check_read_deadline(deadline=deadline)
+            time.sleep(0)
+
+    def end_read(self, generation: int, deadline: int) -> bool:
+        """Returns True if no write happened since the generation was taken."""
+        if self.header[0] == generation:
+            return True
+        self.check_read_deadline(deadline=deadline)
+        return False
+
+    def check_read_deadline(self, deadline: int) -> None:
+        if time.monotonic_ns() > deadline:
+            raise TimeoutError("Store was written to during the whole read!")
+
+    def begin_write(self) -> None:
+        self.lock.acquire()
+        self.header[0] += 1
+
+    def end_write(self, layout_changed: bool) -> None:
+        if layout_changed:
+            self.header[1] += 1
+        self.header[0] += 1
+        self.lock.release()
+
+    def has_note(self, cell: int) -> bool:
+        vis_exe, vis_field = self.vis[cell % self.dims[-1]]
+        return bool(self.presence[cell]) and (
+            self.values[cell * self.cell_size + vis_exe * self.n_fields + vis_field] > 0
+        )
+
+    def write_cell(self, cell: int, indexes: List[List[int]]) -> bool:
+        rows, cols = self.shapes[cell % self.dims[-1]]
+        had_note = self.has_note(cell=cell)
+        base = cell * self.cell_size
+        for i in range(rows):
+            row = indexes[i] if i < len(indexes) else list()
+            start = base + i * self.n_fields
+            for j in range(cols):
+                self.values[start + j] = row[j] if j < len(row) else 0
+        was_present = self.presence[cell]
+        self.presence[cell] = 1
+        self.occupancy[cell // self.slab_size] += self.has_note(cell=cell) - had_note
+        self.versions[cell // self.slab_size] += 1
+        return not was_present
+
+    def write(self, position: Position, indexes: List[List[int]]) -> None:
+        cell = self.get_cell(position=position)
+        if cell is None:
+            raise KeyError(position)
+        self.begin_write()
+        layout_changed = False
+        try:
+            layout_changed = self.write_cell(cell=cell, indexes=indexes)
+        finally:
+            self.end_write(layout_changed=layout_changed)
+
+    def fill_cells(self, cells: List[int], indexes: List[List[int]]) -> None:
+        for cell in cells:
+            self.write_cell(cell=cell, indexes=indexes)
+
+    def get_fill_cells(self, midi: int, channel: int, valid_out_mode: str) -> List[int]:
+        cells: List[int] = list()
+        for part in range(1, self.dims[2] + 1):
+            for step in range(1, self.dims[3] + 1):
+                cell = self.get_cell(position=(midi, channel, part, step, valid_out_mode))
+                if cell is not None:
+                    cells.append(cell)
+        return cells
+
+    def fill(self, midi: int, channel: int, valid_out_mode: str, indexes: List[List[int]]) -> None:
+        """Sets the same indexes in every part and step of a midi, channel and out mode."""
+        cells = self.get_fill_cells(midi=midi, channel=channel, valid_out_mode=valid_out_mode)
+        self.begin_write()
+        try:
+            self.fill_cells(cells=cells, indexes=indexes)
+        finally:
+            self.end_write(layout_changed=True)
+
+    def bump_versions(self) -> None:
+        # Versions only ever grow, so compiled copies of replaced slabs become stale.
+        for slab in range(self.n_slabs):
+            self.versions[slab] += 1
+
+    def clear_cells(self) -> None:
+        self.bump_versions()
+        self.cells_buf[: self.values_offset - self.occupancy_offset] = bytes(
+            self.values_offset - self.occupancy_offset
+        )
+
+    def clear(self) -> None:
+        self.begin_write()
+        try:
+            self.clear_cells()
+        finally:
+            self.end_write(layout_changed=True)
+
+    def load(self, data: MusicDict, fills: Sequence[Fill] = tuple()) -> None:
+        """
+        Replaces all cells with the fills (out mode defaults of sparse music) and the music
+        data over them, in one write, so readers never see the grid half loaded.
+        """
+        fill_cells = self.get_fills_cells(fills=fills)
+        self.begin_write()
+        try:
+            self.clear_cells()
+            self.load_cells(data=data, fill_cells=fill_cells)
+        finally:
+            self.end_write(layout_changed=True)
+
+    def render(self, data: MusicDict, fills: Sequence[Fill] = tuple()) -> bytes:
+        """
+        Loads music into a private block, away from the shared one and its lock, and
+        returns its cells for load_rendered.
+        """
+        rendered = copy(self)
+        rendered.map(buf=memoryview(bytearray(self.size)))
+        try:
+            rendered.load_cells(data=data, fill_cells=self.get_fills_cells(fills=fills))
+            return bytes(rendered.cells_buf)
+        finally:
+            rendered.unmap()
+
+    def load_rendered(self, cells: bytes) -> None:
+        """Replaces all cells with rendered ones, a single copy within the write."""
+        self.begin_write()
+        try:
+            self.bump_versions()
+            self.cells_buf[:] = cells
+        finally:
+            self.end_write(layout_changed=True)
+
+    def get_fills_cells(self, fills: Sequence[Fill]) -> List[Tuple[List[int], List[List[int]]]]:
+        return [
+            (self.get_fill_cells(midi=midi, channel=channel, valid_out_mode=mode), indexes)
+            for midi, channel, mode, indexes in fills
+        ]
+
+    def load_cells(
+        self, data: MusicDict, fill_cells: List[Tuple[List[int], List[List[int]]]]
+    ) -> None:
+        for cells, indexes in fill_cells:
+            self.fill_cells(cells=cells, indexes=indexes)
+        for midi in data.keys():
+            for channel in data[midi].keys():
+                for part in data[midi][channel].keys():
+                    for step in data[midi][channel][part].keys():
+                        self.load_step(
+                            step_position=(midi, channel, part, step),
+                            step_data=data[midi][channel][part][step],
+                        )
+
+    def load_step(self, step_position: Step, step_data: Dict[str, List[List[int]]]) -> None:
+        for valid_out_mode, indexes in step_data.items():
+            cell = self.get_cell(position=step_position + (valid_out_mode,))
+            if cell is not None:
+                self.write_cell(cell=cell, indexes=indexes)
+
+    def read_cell(self, cell: int) -> List[List[int]]:
+        rows, cols = self.shapes[cell % self.dims[-1]]
+        base = cell * self.cell_size
+        return [
+            self.values[base + i * self.n_fields : base + i * self.n_fields + cols].tolist()
+            for i in range(rows)
+        ]
+
+    def read(self, position: Position) -> List[List[int]]:
+        cell = self.get_cell(position=position)
+        if cell is None:
+            raise KeyError(position)
+        deadline = self.get_read_deadline()
+        while True:
+            generation = self.begin_read(deadline=deadline)
+            indexes = self.read_cell(cell=cell) if self.presence[cell] else None
+            if self.end_read(generation=generation, deadline=deadline):
+                break
+        if indexes is None:
+            raise KeyError(position)
+        return indexes
+
+    def get_version(self, slab: Slab) -> int:
+        slab_id = self.get_slab_id(slab=slab)
+        if slab_id is None:
+            raise KeyError(slab)
+        return self.versions[slab_id]
+
+    def read_slab(self, slab: Slab) -> Tuple[int, List[Tuple[int, str, List[List[int]]]]]:
+        """Returns the version and (step, out mode, indexes) of all present cells of a slab."""
+        slab_id = self.get_slab_id(slab=slab)
+        if slab_id is None:
+            raise KeyError(slab)
+        first = slab_id * self.slab_size
+        deadline = self.get_read_deadline()
+        while True:
+            generation = self.begin_read(deadline=deadline)
+            version = self.versions[slab_id]
+            cells = [cell for cell in range(first, first + self.slab_size) if self.presence[cell]]
+            cells_indexes = self.read_cells(cells=cells)
+            if self.end_read(generation=generation, deadline=deadline):
+                break
+        steps: List[Tuple[int, str, List[List[int]]]] = list()
+        for cell, indexes in zip(cells, cells_indexes):
+            _, _, _, step, valid_out_mode = self.get_position(cell=cell)
+            steps.append((step, valid_out_mode, indexes))
+        return version, steps
+
+    def get_occupied_slabs(self) -> List[int]:
+        return [slab for slab, n_notes in enumerate(self.occupancy) if n_notes > 0]
+
+    def get_occupied(self) -> List[Slab]:
+        """Returns (midi, channel, part) of every slab with at least one note."""
+        deadline = self.get_read_deadline()
+        while True:
+            generation = self.begin_read(deadline=deadline)
+            slabs = self.get_occupied_slabs()
+            if self.end_read(generation=generation, deadline=deadline):
+                return [self.get_slab(slab=slab) for slab in slabs]
+
+    def get_present_cells(self) -> List[int]:
+        cells: List[int] = list()
+        presence = bytes(self.presence)
+        cell = presence.find(1)
+        while cell >= 0:
+            cells.append(cell)
+            cell = presence.find(1, cell + 1)
+        return cells
+
+    def get_tree(self) -> KeyTree:
+        # The tree of present keys is only rebuilt after cells appear or vanish.
+        deadline = self.get_read_deadline()
+        while self.layout != self.header[1]:
+            generation = self.begin_read(deadline=deadline)
+            layout = self.header[1]
+            tree: KeyTree = dict()
+            for cell in self.get_present_cells():
+                midi, channel, part, step, valid_out_mode = self.get_position(cell=cell)
+                tree.setdefault(midi, dict()).setdefault(channel, dict()).setdefault(
+                    part, dict()
+                ).setdefault(step, list()).append(valid_out_mode)
+            if self.end_read(generation=generation, deadline=deadline):
+                self.tree, self.layout = tree, layout
+        return self.tree
+
+    def get_keys(self, prefix: Prefix) -> List[Union[int, str]]:
+        node: Union[Dict, List[str]] = self.get_tree()
+        for key in prefix:
+            if not isinstance(node, dict) or key not in node:
+                return list()
+            node = node[key]
+        return list(node)
+
+    def read_cells(self, cells: List[int]) -> List[List[List[int]]]:
+        return [self.read_cell(cell=cell) for cell in cells]
+
+    def get_changed_cells(self) -> List[int]:
+        return [
+            cell
+            for cell in self.get_present_cells()
+            if self.read_cell(cell=cell) != self.defaults[cell % self.dims[-1]]
+        ]
+
+    def to_dict(self, sparse: bool = False) -> MusicDict:
+        """Returns all present cells, or only the ones that differ from out mode defaults."""
+        deadline = self.get_read_deadline()
+        while True:
+            generation = self.begin_read(deadline=deadline)
+            data: MusicDict = dict()
+            cells = self.get_changed_cells() if sparse else self.get_present_cells()
+            for cell, indexes in zip(cells, self.read_cells(cells=cells)):
+                midi, channel, part, step, valid_out_mode = self.get_position(cell=cell)
+                data.setdefault(midi, dict()).setdefault(channel, dict()).setdefault(
+                    part, dict()
+                ).setdefault(step, dict())[valid_out_mode] = indexes
+            if self.end_read(generation=generation, deadline=deadline):
+                return data
+
+
+def create_store(out_modes: Dict[str, MOutFunctionality]) -> SequenceStore:
+    store_type: Type[SequenceStore] = SequenceStore
+    if np is not None:
+        from .numpy_store import NumpySequenceStore
+
+        store_type = NumpySequenceStore
+    return store_type(
+        valid_out_modes=list(out_modes.keys()),
+        shapes=[(len(mode.indexes), len(mode.indexes[0])) for mode in out_modes.values()],
+        vis=[(mode.vis_ind[0], mode.vis_ind[1]) for mode in out_modes.values()],
+        defaults=[mode.get_indexes() for mode in out_modes.values()],
+    )
+
+
+class StoreView:
+    """
+    This class gives the nested dict interface of MMusic.data on top of a SequenceStore.
+    The last level (out mode) reads and writes index rows.
+    """
+
+    def __init__(self, store: SequenceStore, prefix: Prefix = tuple()):
+        self.store = store
+        self.prefix = prefix
+
+    def keys(self) -> List[Union[int, str]]:
+        return self.store.get_keys(prefix=self.prefix)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def __contains__(self, key: Union[int, str]) -> bool:
+        return key in self.keys()
+
+    def __getitem__(self, key: Union[int, str]) -> Union["StoreView", List[List[int]]]:
+        position = self.prefix + (key,)
+        if len(position) == len(self.store.dims):
+            return self.store.read(position=cast(Position, position))
+        return StoreView(store=self.store, prefix=position)
+
+    def __setitem__(self, key: str, indexes: List[List[int]]) -> None:
+        position = self.prefix + (key,)
+        if len(position) != len(self.store.dims):
+            raise TypeError(f"Only out mode indexes can be set, not {position}!")
+        self.store.write(position=cast(Position, position), indexes=indexes)
+
+    def to_dict(self) -> MusicDict:
+        return self.store.to_dict()
@@ -0,0 +1,37 @@
+import heapq
+from itertools import count
+from typing import Iterator, List, Optional, Tuple
+
+from .functionalities import MOutEvent
+
+
+class Timeline:
+    """
+    This class keeps scheduled out mode events in a heap ordered by their due (integer) tick.
+    Ties are resolved in the order of scheduling.
+    """
+
+    def __init__(self):
+        self.heap: List[Tuple[int, int, int, MOutEvent]] = list()
+        self.counter: Iterator[int] = count()
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def push(self, tick: int, channel: int, event: MOutEvent) -> None:
+        heapq.heappush(self.heap, (tick, next(self.counter), channel, event))
+
+    def peek(self) -> Optional[int]:
+        if len(self.heap):
+            return self.heap[0][0]
+        return None
+
+    def pop_due(self, tick: float) -> List[Tuple[int, int, MOutEvent]]:
+        due: List[Tuple[int, int, MOutEvent]] = list()
+        while len(self.heap) and self.heap[0][0] <= tick:
+            step_tick, _, channel, event = heapq.heappop(self.heap)
+            due.append((step_tick, channel, event))
+        return due
+
+    def clear(self) -> None:
+        self.heap.clear()
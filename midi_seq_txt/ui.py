@@ -1,14 +1,18 @@
-from typing import Any, Callable, Dict, List, Optional, Tuple
+from copy import deepcopy
+from functools import partial
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 from textual.app import ComposeResult
 from textual.timer import Timer
 from textual.widgets import Label, Sparkline, Static
+from textual.worker import Worker, WorkerState
 
 from .configs import InitConfig
 from .const import ValidButtons, ValidNav, ValidSettings
 from .engine import Engine
-from .functionalities import MOutFunctionality, SFunctionality
+from .functionalities import MMappings, MMusic, MOutFunctionality, SFunctionality
 from .init import create_notes, init_nav
+from .ipc import OUT_MODE, decode_header
 from .presets import write_preset_type
 
 
@@ -71,16 +75,13 @@ class KeysUI(Static):
         self.pos_top_label.update(pos_label)
 
     def handle_queues(self):
-        self.seq_step = 0
         while not self.sequencer.current_step_id.empty():
-            seq_step = self.sequencer.current_step_id.get()
-            if seq_step > self.seq_step:
-                self.seq_step = seq_step
-        if not self.sequencer.attached_func_queue.empty():
-            func_dict: Dict[str, Any] = self.sequencer.attached_func_queue.get()
-            if "indexes" in func_dict:
-                out_mode = self.sequencer.convert_to_out_mode(func_dict)
-                self.sequencer.set_step(out_mode=out_mode)
+            self.seq_step = self.sequencer.current_step_id.get()
+        while self.sequencer.attached_func_pipe.poll():
+            func_data = self.sequencer.attached_func_pipe.recv()
+            if decode_header(func_data)[0] == OUT_MODE:
+                _, _, event = self.sequencer.convert_to_event(func_data)
+                self.sequencer.set_step(out_mode=event, write=False)
 
     def update_bottom(self) -> None:
         self.handle_queues()
@@ -384,7 +385,7 @@ class NavigationUI(Static):
     def save_music(self) -> None:
         music_name = str(self.sequencer.settings[ValidSettings.MUS_NAME].get_value())
         self.sequencer.sequences.name = music_name
-        write_preset_type(preset=self.sequencer.sequences, loc=self.loc)
+        self.save_preset(preset=self.sequencer.get_music())
         presets = self.config_setting(
             ValidSettings.PRESETS, str(ValidButtons.PRESETS_S_MUSIC.value)
         )
@@ -397,10 +398,31 @@ class NavigationUI(Static):
     def save_map(self) -> None:
         map_name = str(self.sequencer.settings[ValidSettings.MAP_NAME].get_value())
         self.sequencer.mappings.name = map_name
-        write_preset_type(preset=self.sequencer.mappings, loc=self.loc)
+        self.save_preset(preset=deepcopy(self.sequencer.mappings))
         presets = self.config_setting(ValidSettings.PRESETS, str(ValidButtons.PRESETS_S_MAP.value))
         self.sequencer.send_setting(presets)
 
+    def save_preset(self, preset: Union[MMusic, MMappings]) -> None:
+        # The preset is a snapshot, so edits made during the save neither wait nor end up in it.
+        self.run_worker(
+            partial(write_preset_type, preset=preset, loc=self.loc),
+            name=preset.name,
+            group="presets",
+            description=f"{preset.__class__.__name__[1:]} {preset.name}",
+            exit_on_error=False,
+            thread=True,
+        )
+
+    def on_worker_state_changed(self, event: Worker.StateChanged) -> None:
+        if event.worker.group == "presets":
+            if event.state == WorkerState.SUCCESS:
+                self.notify(f"Saved {event.worker.description}")
+            elif event.state == WorkerState.ERROR:
+                self.notify(
+                    f"Saving {event.worker.description} failed: {event.worker.error}",
+                    severity="error",
+                )
+
     def edit_map_on(self) -> None:
         self.navigate(direction=1)
         presets = self.config_setting(
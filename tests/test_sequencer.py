@@ -0,0 +1,718 @@
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from copy import deepcopy
+from multiprocessing import Process
+from typing import Dict, List, Tuple, Type, Union
+
+import attrs
+import pytest
+import yaml
+
+from midi_seq_txt.bank import MusicBank
+from midi_seq_txt.benchmarks import get_as_message_uncached
+from midi_seq_txt.clock import (
+    MIDI_CLOCK,
+    MIDI_CONTINUE,
+    MIDI_START,
+    MIDI_STOP,
+    Clock,
+    ClockFollower,
+)
+from midi_seq_txt.coalesce import CCCoalescer
+from midi_seq_txt.compiler import CompiledEvent, PartCompiler
+from midi_seq_txt.engine import Engine
+from midi_seq_txt.functionalities import C_MAJOR_NOTES, MInFunctionality, MMiDi, MMusic
+from midi_seq_txt.init import create_scales, init_music_mem, init_sparse_music_mem
+from midi_seq_txt.ipc import (
+    VALID_SETTINGS,
+    IPCPipe,
+    decode_out_mode,
+    decode_setting,
+    encode_out_mode,
+    encode_setting,
+)
+from midi_seq_txt.ports import PortRegistry
+from midi_seq_txt.presets import (
+    get_preset_cache_path,
+    read_preset,
+    read_preset_type,
+    write_preset_dict,
+    write_preset_type,
+)
+from midi_seq_txt.sequencer import MiDiIn, MiDiOut, Sequencer
+from midi_seq_txt.store import SequenceStore
+from midi_seq_txt.timeline import Timeline
+
+
+@pytest.fixture
+def midi_in(tmpdir) -> MiDiIn:
+    sequencer = Sequencer(loc=str(tmpdir))
+    sequencer.init_data()
+    midi_in = MiDiIn(midi=MMiDi(midi_id=4, port_id=0, port_name="", is_out=False))
+    midi_in.sequencer = sequencer
+    midi_in.reset_in_modes()
+    return midi_in
+
+
+def stamp(messages: List[Tuple[List[int], float]]) -> List[Tuple[List[int], int]]:
+    # Arrival times in ns from deltas in s.
+    stamped: List[Tuple[List[int], int]] = list()
+    ns = Clock.now_ns()
+    for message, delta in messages:
+        ns += int(delta * 10**9)
+        stamped.append((message, ns))
+    return stamped
+
+
+def play(midi_in: MiDiIn, messages: List[Tuple[List[int], float]]) -> List[Tuple[int, int]]:
+    for message, ns in stamp(messages):
+        midi_in.ring.push(message=message, ns=ns)
+    keys_lengths: List[Tuple[int, int]] = list()
+    for _, _, out_mode in midi_in.run_message_bus(out_midi=0, out_channel=1):
+        values = out_mode.get_row_values(exe=0)
+        keys_lengths.append((int(values[1]), int(values[3])))
+    return keys_lengths
+
+
+def test_held_notes_stress(midi_in):
+    # Every key of two channels held at once, released in reverse order.
+    notes = [(channel, key) for channel in [0, 1] for key in range(128)]
+    assert play(midi_in, [([0x90 | ch, key, 100], 0.0) for ch, key in notes]) == list()
+    assert len(midi_in.notes) == len(notes)
+    released = play(midi_in, [([0x80 | ch, key, 0], 0.0) for ch, key in reversed(notes)])
+    assert len(midi_in.notes) == 0
+    assert [key for key, _ in released] == [key for _, key in reversed(notes)]
+
+
+def test_legato_lengths(midi_in):
+    # Each note starts before the previous one ends, a note on without velocity ends a note.
+    quant = 60 / midi_in.sequencer.tempo / midi_in.internal_config.n_quants
+    released: List[Tuple[int, int]] = list()
+    released += play(midi_in, [([0x90, 60, 100], 0.0)])
+    released += play(midi_in, [([0x90, 62, 100], 0.0), ([0x80, 60, 0], 1.5 * quant)])
+    released += play(midi_in, [([0x90, 64, 100], 0.0), ([0x90, 62, 0], 3.5 * quant)])
+    assert released == [(60, 2), (62, 4)]
+    assert len(midi_in.notes) == 1
+
+
+def test_input_throughput(midi_in):
+    # Overlapping notes replayed in batches that split notes, in modes carry over between them.
+    n_notes = 2000
+    events: List[Tuple[List[int], float]] = [([0x90, 0, 100], 0.0)]
+    for note in range(1, n_notes):
+        events.append(([0x90, note % 128, 100], 0.001))
+        events.append(([0x80, (note - 1) % 128, 0], 0.001))
+    events.append(([0x80, (n_notes - 1) % 128, 0], 0.001))
+    released: List[Tuple[int, int]] = list()
+    for i in range(0, len(events), 333):
+        released += play(midi_in, events[i : i + 333])
+    assert [key for key, _ in released] == [note % 128 for note in range(n_notes)]
+    assert len(midi_in.notes) == 0
+
+
+def test_cc_coalescing(midi_in):
+    # The first and the latest value of each 10 ms window of a knob sweep pass, even drained
+    # one by one as the engine wakes up on each message. A note closes the last window.
+    sweep = [([0xB0, 74, value], 0.001) for value in range(100)]
+    note = [([0x90, 60, 100], 0.0), ([0xB0, 74, 127], 0.001), ([0x80, 60, 0], 0.001)]
+    stamped = stamp(sweep + note)
+    coalesced = [
+        kept
+        for message in stamped
+        for kept in midi_in.coalescer.coalesce_in(messages=[message], now_ns=message[1])
+    ]
+    # Kept messages keep their arrival times.
+    kept = sorted([*range(0, 99, 11), *range(10, 99, 11), 99, 100, 101, 102])
+    assert coalesced == [stamped[i] for i in kept]
+    assert midi_in.coalescer.get_counts() == {"received": 103, "dropped": 81}
+    # A held value passes once its window ended, without another message.
+    knob = stamp([([0xB1, 1, value], 0.001) for value in range(3)])
+    assert midi_in.coalescer.coalesce_in(messages=knob, now_ns=knob[-1][1]) == knob[:1]
+    deadline = midi_in.get_next_deadline()
+    assert deadline == knob[0][1] + 10**7 + 1
+    assert midi_in.coalescer.coalesce_in(messages=list(), now_ns=deadline) == knob[-1:]
+    coalescer: CCCoalescer[CompiledEvent] = CCCoalescer(window=0)
+    # Data entry is never coalesced, knobs only within a tick.
+    for tick in [0, 1]:
+        burst = [(tick, 0, 0xB0, cc, value) for cc in [74, 6] for value in [1, 2, 3]]
+        assert coalescer.coalesce_compiled(events=burst, tick=tick) == [
+            (tick, 0, 0xB0, cc, value) for cc, value in [(74, 1), (74, 3), (6, 1), (6, 2), (6, 3)]
+        ]
+
+
+def test_input_times(midi_in):
+    # Times add rtmidi's deltas up from the first arrival, however late the callbacks run.
+    midi_in.receive(([0x90, 60, 100], 0.0))
+    time.sleep(0.005)
+    for delta in [0.002, 0.0, 0.001]:
+        midi_in.receive(([0x90, 60, 100], delta))
+    times = [ns for _, ns in midi_in.ring.drain()]
+    assert [ns - times[0] for ns in times] == [0, 2 * 10**6, 2 * 10**6, 3 * 10**6]
+    # A time past the arrival anchors on the arrival again.
+    midi_in.receive(([0x90, 60, 100], 1.0))
+    ((_, ns),) = midi_in.ring.drain()
+    assert times[-1] < ns <= Clock.now_ns()
+
+
+def test_input_filter(midi_in):
+    # Notes of the mapped channels (1 and 2) pass, system messages are left to rtmidi
+    # and real time messages are never recorded.
+    midi_in.sequencer.mappings = deepcopy(midi_in.sequencer.mappings)
+    for conn in midi_in.sequencer.mappings.conns:
+        if not conn.is_out and conn.midi_id == midi_in.midi_id:
+            conn.filter_channel = True
+            conn.statuses = [0x90, 0x80]
+            conn.ignore_timing = conn.channel != 1
+    midi_in.reset_filter()
+    assert midi_in.ignore_types == (True, False, True)
+    messages = [[0x90, 60, 100], [0x91, 60, 100], [0x92, 60, 100], [0xB0, 74, 1], [0xF8]]
+    for message in messages:
+        midi_in.receive((message, 0.0))
+    assert [message for message, _ in midi_in.ring.drain()] == [messages[0], messages[1]]
+    assert midi_in.get_counts()["filtered"] == 2
+
+
+def rules_apply(rules: List[Union[str, int]], message: List[int], previous: List[int]) -> int:
+    # The in rules interpreter the compiled checks replaced.
+    all_apply = 1
+    for i, rule in enumerate(rules):
+        if isinstance(rule, int):
+            if rule > 0:
+                all_apply = all_apply * int(message[i] == rule)
+            elif message[0] < abs(rule):
+                all_apply = -all_apply
+        elif rule == "match":
+            all_apply = all_apply and (message[i] == previous[i])
+    return all_apply
+
+
+def test_in_rules(midi_in):
+    # The compiled checks and the dispatch table agree with the in rules of the shipped presets.
+    presets = os.path.join(os.path.dirname(__file__), "..", "presets", "MInFunctionality")
+    midi_in.in_modes = list()
+    for file_name in sorted(os.listdir(presets)):
+        if file_name.endswith(".yaml"):
+            # Parsed aside, so no preset cache is written next to the shipped files.
+            with open(os.path.join(presets, file_name)) as fh:
+                in_mode = MInFunctionality(**yaml.safe_load(fh))
+            midi_in.in_modes.append(in_mode.new(lock=False))
+    assert len(midi_in.in_modes)
+    midi_in.reset_dispatch()
+    rng = random.Random(0)
+    matched = 0
+    for in_mode in midi_in.in_modes:
+        cache = in_mode.get_cache()
+        for _ in range(2000):
+            message = [
+                rng.choice([0x80, 0x90, 0xB0, 0xE0]) | rng.randrange(16),
+                rng.choice([60, 61, rng.randrange(128)]),
+                rng.randrange(128),
+            ]
+            MiDiIn.fix_command_length_channel(message=message)
+            status, channel = message[0], message[4]
+            previous = [0x90, rng.choice([60, 61]), 100, 0, channel]
+            for exe, rules in enumerate(in_mode.in_rules):
+                applied = rules_apply(rules=rules, message=message, previous=previous)
+                assert cache.apply(exe=exe, message=message, previous=previous) == applied
+                if not cache.accepts(exe=exe, status=status, channel=channel):
+                    assert applied == 0
+                matched += applied != 0
+            dispatched = midi_in.dispatch.get((status, channel), list())
+            assert any(other is in_mode for other in dispatched) == any(
+                cache.accepts(exe=exe, status=status, channel=channel)
+                for exe in range(len(in_mode.in_rules))
+            )
+    assert matched
+
+
+class FakeMidiIn:
+    """Stands for rtmidi.MidiIn, closing the port cancels the callback as rtmidi does."""
+
+    def __init__(self):
+        self.callback = None
+        self.port_id = None
+
+    def open_port(self, port_id):
+        self.port_id = port_id
+
+    def close_port(self):
+        self.port_id = None
+        self.callback = None
+
+    def set_callback(self, callback):
+        self.callback = callback
+
+
+def test_reattach_input(midi_in):
+    # A device plugged in again on another port keeps feeding the ring.
+    midi_in.port_name = "Keys"
+    fake = FakeMidiIn()
+    midi_in.midi_in = fake
+    midi_in.reattach(port_names_comb=[(0, "Other", False)])
+    assert not midi_in.connected and fake.callback is None
+    midi_in.reattach(port_names_comb=[(0, "Other", False), (1, "Keys", False)])
+    assert midi_in.connected and fake.port_id == 1 and fake.callback is not None
+    fake.callback(([0x90, 60, 100], 0.0))
+    assert [message for message, _ in midi_in.ring.drain()] == [[0x90, 60, 100]]
+
+
+class FakeMidiOut:
+    def __init__(self):
+        self.sent: List[List[int]] = list()
+
+    def is_port_open(self):
+        return True
+
+    def close_port(self):
+        pass
+
+    def open_port(self, port_id):
+        pass
+
+    def send_message(self, message):
+        self.sent.append(list(message))
+
+
+def test_out_mode_bytes(midi_in):
+    # The cached messages and bytes are the ones the string based path used to send.
+    rng = random.Random(0)
+    sent = 0
+    for proto in midi_in.sequencer.out_modes.values():
+        out_mode = proto.new(lock=False)
+        for _ in range(200):
+            row = [rng.randrange(len(values)) for values in proto.data]
+            out_mode.indexes = [row]
+            out_mode._exe_ = 0
+            message = out_mode.get_as_message()
+            out_mode._exe_ = 0
+            try:
+                values = get_as_message_uncached(out_mode=out_mode)
+            except ValueError:
+                # Never sent: the string path fails and the cached one is negative.
+                assert min(message) < 0
+                continue
+            assert list(message) == values
+            if len(values) < 3 or min(values) < 0:
+                continue
+            for ch in range(17):
+                command = (values[0] & 0xF0) | ((ch if ch else 1) - 1 & 0xF)
+                baseline = [command] + [value & 0x7F for value in values[1:3]]
+                assert list(out_mode.get_as_bytes(message=message, ch=ch)) == baseline
+                sent += 1
+    assert sent
+
+
+class FakePorts:
+    def __init__(self, ports: List[str]):
+        self.ports = ports
+
+    def get_ports(self) -> List[str]:
+        return list(self.ports)
+
+
+def test_port_rescan(monkeypatch):
+    # A rescan reports a change only when ports were plugged in, unplugged or moved.
+    registry = PortRegistry()
+    outs, ins = FakePorts(ports=["Synth"]), FakePorts(ports=["Keys"])
+    monkeypatch.setattr(registry, "get_clients", lambda: (outs, ins))
+    assert registry.get_port_names_comb() == [(0, "Synth", True), (0, "Keys", False)]
+    assert [registry.rescan() for _ in range(2)] == [False, False]
+    ins.ports.append("Pads")
+    assert [registry.rescan() for _ in range(2)] == [True, False]
+    assert registry.get_port_names_comb()[-1] == (1, "Pads", False)
+    ins.ports.reverse()
+    assert [registry.rescan() for _ in range(2)] == [True, False]
+    outs.ports.clear()
+    assert [registry.rescan() for _ in range(2)] == [True, False]
+    assert registry.get_port_names_comb() == [(0, "Pads", False), (1, "Keys", False)]
+
+
+def test_thru(midi_in):
+    # Every channel of an all channels conn plays thru on its own channel.
+    midi_in.sequencer.mappings = deepcopy(midi_in.sequencer.mappings)
+    for conn in midi_in.sequencer.mappings.conns:
+        if not conn.is_out and conn.midi_id == midi_in.midi_id:
+            conn.channel, conn.thru_midi, conn.thru_channel = -1, 0, -1
+    midi_out = MiDiOut(midi=MMiDi(midi_id=0, port_id=0, port_name="Synth", is_out=True))
+    fake = FakeMidiOut()
+    midi_out.midi_out = fake
+    midi_in.reset_thru(midi_outs={0: midi_out})
+    assert sorted(midi_in.thru) == list(range(1, midi_in.internal_config.n_channels + 1))
+    for message in [[0x90, 60, 100], [0x95, 62, 100], [0x85, 62, 0], [0x9F, 64, 100]]:
+        midi_in.receive((message, 0.0))
+    assert fake.sent == [[0x90, 60, 100], [0x95, 62, 100], [0x85, 62, 0], [0x9F, 64, 100]]
+    # Notes still sounding end when the output is plugged into another port.
+    midi_out.reattach(port_names_comb=[(1, "Synth", True)])
+    assert fake.sent[4:] == [[0xB0, 0x7B, 0], [0xBF, 0x7B, 0]] and not midi_out.thru_notes
+
+
+def test_timeline_ties(midi_in):
+    # Events due at the same tick come out in the order they were scheduled.
+    out_mode = midi_in.sequencer.out_modes[midi_in.sequencer.store.valid_out_modes[0]]
+    events = [out_mode.new_event() for _ in range(6)]
+    timeline = Timeline()
+    for tick, channel, event in zip([96, 0, 96, 0, 96, 48], [1, 2, 3, 4, 5, 6], events):
+        timeline.push(tick=tick, channel=channel, event=event)
+    assert timeline.peek() == 0
+    due = timeline.pop_due(tick=95.5)
+    assert [(tick, channel) for tick, channel, _ in due] == [(0, 2), (0, 4), (48, 6)]
+    assert all(event is other for (_, _, event), other in zip(due, events[1::2]))
+    timeline.push(tick=96, channel=7, event=events[1])
+    due = timeline.pop_due(tick=96)
+    assert [channel for _, channel, _ in due] == [1, 3, 5, 7]
+    # The events compare equal by value, so check which object came out.
+    expected = [events[0], events[2], events[4], events[1]]
+    assert all(event is other for (_, _, event), other in zip(due, expected))
+    assert len(timeline) == 0 and timeline.peek() is None
+
+
+def test_tick_ns_round_trip():
+    # Each tick maps to the first ns of it and back, at tick lengths that are not whole ns.
+    clock = Clock()
+    clock.start(at_ns=10**9 + 7)
+    for tempo in [60, 120, 127, 333]:
+        clock.set_tempo(tempo=tempo)
+        for tick in range(clock.anchor_tick - 500, clock.anchor_tick + 5000, 7):
+            ns = clock.tick_to_ns(tick)
+            assert clock.ns_to_tick(ns) == tick and clock.ns_to_tick(ns - 1) == tick - 1
+
+
+def test_clock_anchor(monkeypatch):
+    # A tempo change moves the anchor to the current tick, the position does not jump.
+    now_ns = [0]
+    monkeypatch.setattr(Clock, "now_ns", staticmethod(lambda: now_ns[0]))
+    clock = Clock()
+    clock.start(at_ns=10**9)
+    tick = 1000
+    now_ns[0] = clock.tick_to_ns(tick)
+    clock.set_tempo(tempo=140)
+    assert clock.anchor_tick == tick and clock.ns_to_tick(now_ns[0]) == tick
+    beat_ns = clock.tick_to_ns(tick + clock.internal_config.ppqn) - now_ns[0]
+    assert beat_ns == -(-60 * 10**9 // 140)
+    now_ns[0] += 10**6 + 3
+    tick = clock.ns_to_tick(now_ns[0])
+    clock.set_tempo(tempo=90)
+    assert clock.ns_to_tick(now_ns[0]) - tick in [0, 1]
+    # Lateness of played ticks adds up, early events count negative.
+    for late_ns in [10**6, 3 * 10**6, -5 * 10**5]:
+        assert clock.record_lateness(tick=tick, ns=clock.tick_to_ns(tick) + late_ns) == late_ns
+    assert clock.get_lateness() == pytest.approx(
+        {"count": 3, "mean_ms": 3.5 / 3, "max_ms": 3.0, "last_ms": -0.5}
+    )
+
+
+def test_clock_follower():
+    # A 125 BPM clock with up to 2 ms of jitter, stopped and continued after 4 beats.
+    rng = random.Random(0)
+    period_ns = 60 * 10**9 // (125 * 24)
+    follower = ClockFollower(ppqn=96)
+    clock = Clock()
+    for pulse in range(4 * 24):
+        follower.receive(status=MIDI_CLOCK, ns=pulse * period_ns + rng.randrange(2 * 10**6))
+    assert not follower.playing and follower.timebase is None
+    follower.receive(status=MIDI_START, ns=0)
+    errors = list()
+    for pulse in range(4 * 24, 12 * 24):
+        if pulse == 8 * 24:
+            follower.receive(status=MIDI_STOP, ns=0)
+            assert not follower.playing and follower.song_pulse == 4 * 24 - 1
+            follower.receive(status=MIDI_CONTINUE, ns=0)
+        follower.receive(status=MIDI_CLOCK, ns=pulse * period_ns + rng.randrange(2 * 10**6))
+        assert follower.timebase is not None
+        clock.set_timebase(timebase=follower.timebase)
+        errors.append(clock.tick_to_ns((pulse - 4 * 24) * 4) - pulse * period_ns)
+    assert follower.playing and follower.transports == 3
+    assert follower.get_tempo() == 125
+    # Past the first beat, pulses are placed within the jitter, around its mean.
+    assert all(0 < error < 2 * 10**6 for error in errors[24:])
+    # A PPQN the pulses do not divide would follow at the wrong tempo.
+    with pytest.raises(ValueError):
+        ClockFollower(ppqn=100)
+
+
+def test_ipc_merge():
+    # Many more out modes than the pipe holds are queued while nobody reads it, and all of
+    # them arrive in order. Only pending values of one setting are merged.
+    pipe = IPCPipe()
+    sent = [
+        encode_out_mode(mode_id=0, position=(0, 1, 1, 1), indexes=[[value]])
+        for value in range(20000)
+    ]
+    settings = [encode_setting(name=VALID_SETTINGS[0].value, ind=ind) for ind in range(3)]
+
+    def send() -> None:
+        for data in sent + settings:
+            pipe.send(data)
+
+    sender = threading.Thread(target=send, daemon=True)
+    sender.start()
+    sender.join(timeout=30.0)
+    assert not sender.is_alive()
+    received = [pipe.recv() for _ in range(len(sent))]
+    assert received == sent
+    assert decode_out_mode(received[-1]) == ((0, 1, 1, 1), [[19999]])
+    while pipe.reader.poll(1.0):
+        received.append(pipe.recv())
+    assert decode_setting(received[-1]) == (VALID_SETTINGS[0], 2)
+    assert len(received) < len(sent) + len(settings)
+
+
+def test_store_read_timeout(midi_in):
+    # A writer that never finishes makes readers give up instead of spinning forever.
+    store = midi_in.sequencer.store
+    store.read_timeout = 10**7
+    store.header[0] += 1
+    try:
+        with pytest.raises(TimeoutError):
+            store.get_occupied()
+    finally:
+        store.header[0] -= 1
+    assert store.get_occupied() == list()
+
+
+def test_occupancy(midi_in):
+    # The note counts of the slabs follow random writes, deletes, fills and clears.
+    out_modes = midi_in.sequencer.out_modes
+    store_types: List[Type[SequenceStore]] = [SequenceStore]
+    if type(midi_in.sequencer.store) is not SequenceStore:
+        store_types.append(type(midi_in.sequencer.store))
+    for store_type in store_types:
+        store = store_type(
+            valid_out_modes=list(out_modes.keys()),
+            shapes=[(len(mode.indexes), len(mode.indexes[0])) for mode in out_modes.values()],
+            vis=[(mode.vis_ind[0], mode.vis_ind[1]) for mode in out_modes.values()],
+            defaults=[mode.get_indexes() for mode in out_modes.values()],
+        )
+        rng = random.Random(0)
+        notes: Dict[int, bool] = dict()
+        for _ in range(300):
+            mode_id = rng.randrange(len(store.valid_out_modes))
+            valid_out_mode = store.valid_out_modes[mode_id]
+            # A key of 0 is what a delete writes: the out mode defaults.
+            indexes = out_modes[valid_out_mode].get_indexes()
+            vis_exe, vis_field = store.vis[mode_id]
+            indexes[vis_exe][vis_field] = rng.choice([0, 0, 5])
+            midi, channel = rng.randrange(2), rng.randint(1, 2)
+            action = rng.random()
+            if action < 0.01:
+                store.clear()
+                notes.clear()
+            elif action < 0.05:
+                store.fill(
+                    midi=midi, channel=channel, valid_out_mode=valid_out_mode, indexes=indexes
+                )
+                for fill_cell in store.get_fill_cells(
+                    midi=midi, channel=channel, valid_out_mode=valid_out_mode
+                ):
+                    notes[fill_cell] = indexes[vis_exe][vis_field] > 0
+            else:
+                position = (midi, channel, rng.randint(1, 2), rng.randint(1, 16))
+                store.write(position=position + (valid_out_mode,), indexes=indexes)
+                cell = store.get_cell(position=position + (valid_out_mode,))
+                assert cell is not None
+                notes[cell] = indexes[vis_exe][vis_field] > 0
+            counts: Dict[int, int] = dict()
+            for cell, note in notes.items():
+                if note:
+                    counts[cell // store.slab_size] = counts.get(cell // store.slab_size, 0) + 1
+            occupancy = {slab: n for slab, n in enumerate(store.occupancy.tolist()) if n}
+            assert occupancy == counts
+            assert store.get_occupied() == [store.get_slab(slab=slab) for slab in sorted(counts)]
+
+
+def test_incremental_compile(midi_in):
+    # The parts of a loop are compiled one per call, then the loop only reads them.
+    sequencer = midi_in.sequencer
+    store = sequencer.store
+    valid_out_mode = store.valid_out_modes[0]
+    out_mode = sequencer.out_modes[valid_out_mode].new(lock=False)
+    out_mode.set_indexes_with_lab_and_off(lab="Note", sub_ind=1, exe=None)
+    for part in [1, 2]:
+        store.write(position=(0, 1, part, 1, valid_out_mode), indexes=out_mode.indexes)
+    compiler = PartCompiler(
+        port_id=0,
+        midi_id=0,
+        store=store,
+        out_modes=sequencer.out_modes,
+        allowed_valid_out_modes=list(sequencer.out_modes),
+        quant_ticks=sequencer.quant_ticks,
+        step_ticks=sequencer.step_ticks,
+    )
+    play_positions = {0: {1: {1: True, 2: True}}}
+    assert [compiler.compile_stale_part(play_positions=play_positions) for _ in range(3)] == [
+        True,
+        True,
+        False,
+    ]
+    _, events = compiler.compile_loop(
+        play_positions=play_positions, loop_tick=0, from_tick=0, part_ticks=sequencer.part_ticks
+    )
+    assert len(events) and events == sorted(events, key=lambda event: event[0])
+    store.write(position=(0, 1, 2, 2, valid_out_mode), indexes=out_mode.indexes)
+    assert compiler.compile_stale_part(play_positions=play_positions)
+    assert not compiler.compile_stale_part(play_positions=play_positions)
+
+
+def test_preset_cache(tmpdir, monkeypatch):
+    # The cache is used while the YAML file is unchanged, any change or damage parses it again.
+    file_path = str(tmpdir.join("preset.yaml"))
+    cache_path = get_preset_cache_path(file_path=file_path)
+    parsed: List[bytes] = list()
+    load = yaml.load
+
+    def parse(content, loader):
+        parsed.append(content)
+        return load(content, loader)
+
+    monkeypatch.setattr(yaml, "load", parse)
+
+    def read(expected_parses: int) -> dict:
+        preset_dict = read_preset(file_path=file_path)
+        assert len(parsed) == expected_parses
+        # Written again when parsed, so the next read is a cache hit.
+        assert read_preset(file_path=file_path) == preset_dict and len(parsed) == expected_parses
+        return preset_dict
+
+    write_preset_dict(preset_dict={"name": "a", "value": 1}, file_path=file_path)
+    assert read(expected_parses=1) == {"name": "a", "value": 1}
+    # Same size and mtime, other content.
+    mtime_ns = os.stat(file_path).st_mtime_ns
+    write_preset_dict(preset_dict={"name": "a", "value": 2}, file_path=file_path)
+    os.utime(file_path, ns=(mtime_ns, mtime_ns))
+    assert read(expected_parses=2) == {"name": "a", "value": 2}
+    # Same content, other mtime.
+    os.utime(file_path, ns=(mtime_ns + 10**9, mtime_ns + 10**9))
+    assert read(expected_parses=3) == {"name": "a", "value": 2}
+    # Truncated and corrupted caches.
+    with open(cache_path, "rb") as cache_fh:
+        cache = cache_fh.read()
+    for damaged in [cache[:-3], cache[:10], b"garbage" * 10]:
+        with open(cache_path, "wb") as damaged_fh:
+            damaged_fh.write(damaged)
+        assert read(expected_parses=len(parsed) + 1) == {"name": "a", "value": 2}
+
+
+def test_failed_save(midi_in, monkeypatch):
+    # A save that fails halfway leaves the old preset as it was and nothing next to it.
+    loc = midi_in.sequencer.loc
+    out_mode = deepcopy(midi_in.sequencer.out_modes[midi_in.sequencer.store.valid_out_modes[0]])
+    write_preset_type(preset=out_mode, loc=loc)
+    file_path = f"{loc}/MOutFunctionality/{out_mode.name}.yaml"
+    with open(file_path) as fh:
+        saved = fh.read()
+
+    def dump(data, stream, Dumper):
+        stream.write("name: half")
+        stream.flush()
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(yaml, "dump", dump)
+    out_mode.comment = "Changed"
+    with pytest.raises(OSError):
+        write_preset_type(preset=out_mode, loc=loc)
+    with open(file_path) as fh:
+        assert fh.read() == saved
+    assert os.listdir(os.path.dirname(file_path)) == [os.path.basename(file_path)]
+    assert read_preset_type(file_path=file_path).comment != "Changed"
+
+
+def test_music_versions(tmpdir):
+    # A full (version 1) music file still loads, sparse music saves and loads the same steps.
+    sequencer = Sequencer(loc=str(tmpdir))
+    sequencer.init_data()
+    full = init_music_mem(mappings=sequencer.mappings)
+    midi = min(full.data.keys())
+    channel = min(full.data[midi].keys())
+    valid_out_mode = next(iter(full.data[midi][channel][1][1]))
+    out_mode = sequencer.out_modes[valid_out_mode].new(lock=False)
+    out_mode.set_indexes_with_lab_and_off(lab="Note", sub_ind=1, exe=None)
+    full.data[midi][channel][2][3][valid_out_mode] = out_mode.get_indexes()
+    full_dict = attrs.asdict(full)
+    del full_dict["version"]
+    os.makedirs(f"{tmpdir}/MMusic")
+    write_preset_dict(preset_dict=full_dict, file_path=f"{tmpdir}/MMusic/{full.name}.yaml")
+    music = read_preset_type(file_path=f"{tmpdir}/MMusic/{full.name}.yaml")
+    assert isinstance(music, MMusic) and not music.is_sparse()
+    sequencer.set_music(music=music)
+    assert sequencer.store.to_dict() == full.data
+    sparse = sequencer.get_music()
+    assert sparse.data == {midi: {channel: {2: {3: {valid_out_mode: out_mode.indexes}}}}}
+    write_preset_type(preset=sparse, loc=str(tmpdir))
+    music = read_preset_type(file_path=f"{tmpdir}/MMusic/{sparse.name}.yaml")
+    assert isinstance(music, MMusic) and music.is_sparse()
+    sequencer.set_music(music=init_sparse_music_mem(mappings=sequencer.mappings))
+    sequencer.set_music(music=music)
+    assert sequencer.store.to_dict() == full.data
+
+
+def test_rendered_switch(tmpdir, monkeypatch):
+    # The next music is rendered by the bank and swapped in as loading it in place would.
+    sequencer = Sequencer(loc=str(tmpdir))
+    sequencer.init_data()
+    store = sequencer.store
+    valid_out_mode = store.valid_out_modes[0]
+    out_mode = sequencer.out_modes[valid_out_mode].new(lock=False)
+    out_mode.set_indexes_with_lab_and_off(lab="Note", sub_ind=1, exe=None)
+    store.write(position=(0, 1, 4, 2, valid_out_mode), indexes=out_mode.indexes)
+    music = sequencer.get_music()
+    music.name = "Music_01"
+    write_preset_type(preset=music, loc=str(tmpdir))
+    loaded = store.to_dict()
+    sequencer.set_music(music=init_sparse_music_mem(mappings=sequencer.mappings))
+    bank = MusicBank(
+        loc=str(tmpdir), names=[music.name], on_loaded=lambda: None, render=sequencer.render_music
+    )
+    bank.fetch(name=music.name)
+    assert bank.is_ready(name=music.name) and bank.get_rendered(name=music.name) is None
+    bank.prefetch(name=music.name)
+    assert not bank.is_ready(name=music.name)
+    bank.fetch(name=bank.requests.get())
+    # Only the bank thread looks at the file.
+    monkeypatch.setattr(os, "stat", None)
+    assert bank.is_ready(name=music.name)
+    fetched = bank.get(name=music.name)
+    assert fetched is not None
+    version = store.get_version(slab=(0, 1, 4))
+    sequencer.set_music(music=fetched, rendered=bank.get_rendered(name=music.name))
+    monkeypatch.undo()
+    assert store.to_dict() == loaded
+    assert store.get_occupied() == [(0, 1, 4)]
+    assert store.get_version(slab=(0, 1, 4)) > version
+
+
+def test_engine_startup(tmpdir):
+    # The engine starts without mingus (its defaults match it) nor textual.
+    from mingus.core import keys, scales
+
+    assert create_scales() == ["C"] + keys.major_keys + keys.minor_keys
+    assert C_MAJOR_NOTES == scales.get_notes(key="C")
+    code = f"import sys; from midi_seq_txt.engine import Engine; Engine(loc={str(tmpdir)!r})"
+    code += "; print(sorted({name.split('.')[0] for name in sys.modules} & {'mingus', 'textual'}))"
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+    assert output.stdout.strip() == "[]", output.stderr
+    # An engine process that ended before filling the store is not waited for.
+    engine = Engine(loc=str(tmpdir))
+    engine.process = Process(target=int)
+    engine.process.start()
+    with pytest.raises(RuntimeError):
+        engine.wait_data_ready()
+
+
+def test_engine_stats(tmpdir, monkeypatch):
+    # Input counts and output coalescer counts are reported along with the lateness.
+    engine = Engine(loc=str(tmpdir))
+    stats = engine.get_stats()
+    assert sorted(stats) == sorted(
+        ["lateness"]
+        + [f"in.{midi_id}" for midi_id in engine.midi_ins]
+        + [f"out.{midi_id}" for midi_id in engine.midi_outs]
+    )
+    for midi_id, midi_in in engine.midi_ins.items():
+        assert stats[f"in.{midi_id}"] == midi_in.get_counts()
+    monkeypatch.chdir(tmpdir)
+    engine.debug_stats()
+    assert os.path.exists(f"Engine.stats.{engine.detached}.json")
@@ -4,7 +4,7 @@ import pytest
 from textual.pilot import Pilot
 
 from midi_seq_txt.app import MSApp
-from midi_seq_txt.cli import main
+from midi_seq_txt.cli import parse_args
 
 
 @pytest.mark.asyncio
@@ -12,7 +12,7 @@ async def test_record_and_copy(command_line_args):
     import midi_seq_txt.sequencer
 
     setattr(midi_seq_txt.sequencer, "DEBUG", True)
-    ms_app: MSApp = main()
+    ms_app: MSApp = MSApp(parse_args())
     pilot: Pilot
     async with ms_app.run_test() as pilot:  # noqa
         await pilot.press("a")  # tempo
@@ -92,7 +92,7 @@ async def test_map_presets(command_line_args):
     import midi_seq_txt.sequencer
 
     setattr(midi_seq_txt.sequencer, "DEBUG", True)
-    ms_app: MSApp = main()
+    ms_app: MSApp = MSApp(parse_args())
     pilot: Pilot
     async with ms_app.run_test() as pilot:  # noqa
         time.sleep(0.01)
@@ -141,7 +141,7 @@ async def test_music_presets(command_line_args):
     import midi_seq_txt.sequencer
 
     setattr(midi_seq_txt.sequencer, "DEBUG", True)
-    ms_app: MSApp = main()
+    ms_app: MSApp = MSApp(parse_args())
     pilot: Pilot
     async with ms_app.run_test() as pilot:  # noqa
         time.sleep(0.01)
@@ -161,7 +161,7 @@ async def test_tempo(command_line_args):
     import midi_seq_txt.sequencer
 
     setattr(midi_seq_txt.sequencer, "DEBUG", False)
-    ms_app: MSApp = main()
+    ms_app: MSApp = MSApp(parse_args())
     pilot: Pilot
     async with ms_app.run_test() as pilot:  # noqa
         await pilot.press("b")  # copy
@@ -184,7 +184,7 @@ async def test_view(command_line_args):
     import midi_seq_txt.sequencer
 
     setattr(midi_seq_txt.sequencer, "DEBUG", False)
-    ms_app: MSApp = main()
+    ms_app: MSApp = MSApp(parse_args())
     pilot: Pilot
     async with ms_app.run_test() as pilot:  # noqa
         await pilot.press("b")  # copy
@@ -206,7 +206,7 @@ async def test_buttons(command_line_args):
     import midi_seq_txt.sequencer
 
     setattr(midi_seq_txt.sequencer, "DEBUG", False)
-    ms_app: MSApp = main()
+    ms_app: MSApp = MSApp(parse_args())
     pilot: Pilot
     async with ms_app.run_test() as pilot:  # noqa
         for binding in ms_app.BINDINGS: